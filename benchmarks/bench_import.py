@@ -0,0 +1,60 @@
+"""CLIの起動時間を測る
+
+    python benchmarks/bench_import.py --repeat 10
+
+新しいPythonプロセスでbqflowの読み込みと`--help`, `validate`を実行し, 所要時間の中央値と
+重い依存モジュールが読み込まれたかを表示する.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SAMPLE = Path(__file__).parents[1] / "sample" / "complex.yaml"
+HEAVY = ["abq", "google.cloud.bigquery", "httpx", "pyarrow", "pydantic", "yaml", "sqlparse"]
+
+CASES = {
+    "import bqflow": "import bqflow",
+    "import bqflow.main": "import bqflow.main",
+    "bqflow --help": "from bqflow.main import cmd; cmd(['--help'])",
+    "bqflow validate": f"from bqflow.main import cmd; cmd(['validate', {str(SAMPLE)!r}])",
+}
+
+# 計測するコードの後に読み込まれたモジュールを出力する
+REPORT = f"""
+import atexit, json, sys
+atexit.register(lambda: print(json.dumps([m for m in {HEAVY!r} if m in sys.modules])))
+"""
+
+
+def measure(code: str, repeat: int) -> tuple[float, list[str]]:
+    times = []
+    loaded: list[str] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = subprocess.run(
+            [sys.executable, "-c", REPORT + code], capture_output=True, text=True, check=False
+        )
+        times.append(time.perf_counter() - start)
+        loaded = json.loads(res.stdout.strip().splitlines()[-1])
+    return statistics.median(times), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline, _ = measure("pass", args.repeat)
+    print(f"{'python -c pass':>20}: {baseline * 1000:7.1f} ms")
+    for name, code in CASES.items():
+        elapsed, loaded = measure(code, args.repeat)
+        print(f"{name:>20}: {elapsed * 1000:7.1f} ms  {', '.join(loaded)}")
+
+
+if __name__ == "__main__":
+    main()
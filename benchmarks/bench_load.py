@@ -0,0 +1,76 @@
+"""ワークフローの読み込みとコンパイルの時間を測る
+
+    python benchmarks/bench_load.py --size 2000
+
+size個のscriptのタスクを持つyamlを一時ディレクトリに作り,
+キャッシュなしの読み込み, キャッシュからの読み込み, yamlのLoaderの違いを比べる.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+from bqflow.load import Loader, load_plan
+
+
+def make_workflow(directory: Path, size: int) -> Path:
+    tasks = []
+    templates = []
+    for i in range(size):
+        (directory / f"q{i}.sql").write_text(f"SELECT {i} AS x, @p AS p\n")
+        deps = [f"t{i - 1}"] if i % 10 else []
+        tasks.append({"name": f"t{i}", "template": f"q{i}", "dependencies": deps})
+        templates.append(
+            {
+                "name": f"q{i}",
+                "script": f"q{i}.sql",
+                "inputs": {"parameters": [{"name": "p", "type": "INT64"}]},
+            }
+        )
+    root = {"name": "main", "dag": {"tasks": tasks}}
+    wf = {
+        "entrypoint": "main",
+        "arguments": {"parameters": [{"name": "p", "type": "INT64", "value": 1}]},
+        "templates": [root] + templates,
+    }
+    path = directory / "wf.yaml"
+    path.write_text(yaml.dump(wf))
+    return path
+
+
+def timeit(f, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        os.chdir(d)
+        path = make_workflow(Path(d), args.size)
+        text = path.read_text()
+        results = {
+            "yaml FullLoader": lambda: yaml.load(text, Loader=yaml.FullLoader),
+            f"yaml {Loader.__name__}": lambda: yaml.load(text, Loader=Loader),
+            "load_plan (no cache)": lambda: load_plan(path, use_cache=False),
+        }
+        load_plan(path)
+        results["load_plan (cached)"] = lambda: load_plan(path)
+        for name, f in results.items():
+            print(f"{name:>22}: {timeit(f, args.repeat) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""実行計画とスケジューラの状態のノードあたりのメモリとCPU時間を測る
+
+    python benchmarks/bench_memory.py --kind items --size 20000
+
+合成ワークフローの実行計画を作り, 全てのタスクを展開して開始し, 順に完了させる.
+実行計画, 全タスクを開始したときの状態, 全タスクのクエリのそれぞれで確保したメモリを
+ノード数で割って表示する.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from bqflow.plan import Plan
+from bqflow.testing import WORKFLOWS
+from bqflow.tracer import TreeTracer
+
+
+def measure(args) -> dict:
+    wf = WORKFLOWS[args.kind](args.size)
+    tracemalloc.start()
+    cpu = time.process_time()
+    base, _ = tracemalloc.get_traced_memory()
+    plan = Plan(wf).expand_all()
+    after_plan, _ = tracemalloc.get_traced_memory()
+    tt = TreeTracer(wf, plan=plan)
+    tasks = tt.get_tasks()
+    after_start, _ = tracemalloc.get_traced_memory()
+    queue = [t.name for t in tasks]
+    while queue:
+        queue += [t.name for t in tt.task_done(queue.pop())]
+    after_done, peak = tracemalloc.get_traced_memory()
+    cpu = time.process_time() - cpu
+    tracemalloc.stop()
+
+    nodes = len(plan)
+    return {
+        "nodes": nodes,
+        "plan_bytes_per_node": (after_plan - base) / nodes,
+        "state_bytes_per_node": (after_start - after_plan) / nodes,
+        "total_bytes_per_node": (after_done - base) / nodes,
+        "peak_mb": peak / 1024 ** 2,
+        "cpu": cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kind", choices=list(WORKFLOWS), default="items")
+    parser.add_argument("--size", type=int, default=20000)
+    args = parser.parse_args()
+
+    for key, value in measure(args).items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"{key:>22}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""偽のBigQueryで合成ワークフローを実行し, スケジューラの性能を測る
+
+    python benchmarks/bench_scheduler.py --kind diamond --size 1000 --concurrency 50
+
+makespanと理想的な実行時間の下限の比, スケジューラのCPU時間,
+ピークメモリ, APIの呼び出し回数, キューでの平均待ち時間とジョブの平均PENDING時間を表示する.
+--traceを指定するとタイムラインも書き出す.
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+from pathlib import Path
+
+from bqflow.limiter import AIMDLimiter, ConcurrencyLimiter
+from bqflow.plan import Plan
+from bqflow.priority import critical_path_lengths
+from bqflow.options import FAILURE_POLICIES, TRACE_FORMATS
+from bqflow.procon import ProCon
+from bqflow.testing import WORKFLOWS, FakeBQ
+from bqflow.trace import write_trace
+
+
+def mean(values) -> float:
+    values = list(values)
+    return sum(values) / len(values) if values else float("nan")
+
+
+def ideal_makespan(plan: Plan, reports) -> float:
+    """実際のジョブの実行時間で計算したクリティカルパス長"""
+    durations = {tuple(r.name): r.duration for r in reports}
+    weights = {node.id: durations.get(node.key, 0.0) for node in plan.leaves()}
+    priorities = critical_path_lengths(plan, weights)
+    return max(priorities.values(), default=0.0)
+
+
+def run(args) -> dict:
+    wf = WORKFLOWS[args.kind](args.size, batchable=args.batch > 1)
+    bq = FakeBQ(
+        latency=(args.latency_min, args.latency_max),
+        failure_rate=args.failure_rate,
+        max_concurrent=args.backend_cap,
+        job_overhead=args.job_overhead,
+        bytes_per_job=0,
+        seed=args.seed,
+    )
+    if args.concurrency == "auto":
+        limiter = AIMDLimiter(maximum=args.max_concurrency)
+    else:
+        limiter = ConcurrencyLimiter(int(args.concurrency))
+
+    tracemalloc.start()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    pc = ProCon(
+        wf,
+        "fake-project",
+        limiter=limiter,
+        failure_policy=args.on_failure,
+        bq=bq,
+        poll_interval=args.poll_interval,
+        batch_size=args.batch,
+    )
+    reports = asyncio.run(pc.execute())
+    makespan = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # 偽のジョブの実行時間はレポートのdurationに入っている.
+    # 下限はクリティカルパス長と, 総実行時間を同時実行数で割った値の大きい方
+    critical_path = ideal_makespan(pc.tt.plan, reports)
+    ideal = max(critical_path, sum(r.duration for r in reports) / limiter.maximum)
+    if args.trace is not None:
+        write_trace(Path(args.trace), reports, args.trace_format)
+    timings = [r.timing for r in reports if r.timing is not None and r.timing.dequeued]
+    return {
+        "tasks": len(pc.tt.plan.leaves()),
+        "done": sum(r.state == "done" for r in reports),
+        "failed": sum(r.state == "failed" for r in reports),
+        "makespan": makespan,
+        "critical_path": critical_path,
+        "lower_bound": ideal,
+        "ratio": makespan / ideal if ideal else float("nan"),
+        "cpu": cpu,
+        "peak_memory_mb": peak / 1024 ** 2,
+        "queue_wait": mean(t.dequeued - t.ready for t in timings if t.ready is not None),
+        "pending": mean(t.started - t.submitted for t in timings if t.started and t.submitted),
+        "peak_running": bq.peak_running,
+        "calls": dict(sorted(bq.calls.items())),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kind", choices=list(WORKFLOWS), default="fanout")
+    parser.add_argument(
+        "--size", type=int, default=100, help="タスク数. nestedではネストの深さ"
+    )
+    parser.add_argument("--concurrency", default="10", help="同時実行数. autoでAIMD")
+    parser.add_argument("--max-concurrency", type=int, default=50)
+    parser.add_argument("--latency-min", type=float, default=0.01)
+    parser.add_argument("--latency-max", type=float, default=0.05)
+    parser.add_argument(
+        "--job-overhead", type=float, default=0.0, help="ジョブの作成から実行開始までの秒数"
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--backend-cap", type=int, default=None, help="偽のBigQueryの同時実行数")
+    parser.add_argument("--on-failure", choices=FAILURE_POLICIES, default="fail-fast")
+    parser.add_argument("--batch", type=int, default=1, help="1つのスクリプトにまとめるタスク数")
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="タイムラインを書き出すパス")
+    parser.add_argument("--trace-format", choices=TRACE_FORMATS, default="chrome")
+    args = parser.parse_args()
+
+    result = run(args)
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"{key:>15}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""HTTPの接続を共有するクライアントとabqのクライアントを比べる
+
+    python benchmarks/bench_session.py --queries 50 --concurrency 10
+
+ローカルの偽のBigQueryのREST APIに対して, 短いクエリを投げてジョブの完了を確かめる処理を繰り返し,
+所要時間, リクエストあたりの時間, サーバーが受け付けた接続の数を表示する.
+ローカルなのでTLSのハンドシェイクの分は含まれず, 実際のAPIでは差がより大きくなる.
+"""
+
+import argparse
+import asyncio
+import time
+
+from abq import BQ
+from abq.bq import Credential, EndPoint
+
+from bqflow.session import Session, SessionBQ
+from bqflow.testing import FakeRESTServer
+
+
+async def workload(bq: BQ, queries: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            job = await bq.query(sql="SELECT 1")
+            await job.update()
+
+    await asyncio.gather(*[one() for _ in range(queries)])
+
+
+def measure(name: str, make_bq, args):
+    with FakeRESTServer(latency=args.latency) as server:
+        EndPoint.endpoint = server.endpoint
+        start = time.perf_counter()
+        asyncio.run(workload(make_bq(), args.queries, args.concurrency))
+        elapsed = time.perf_counter() - start
+    per_request = elapsed / server.requests * 1000
+    print(
+        f"{name:>8}: {elapsed:6.2f} s  {per_request:6.2f} ms/request  "
+        f"{server.requests} requests  {server.connections} connections"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.002, help="サーバーの応答の秒数")
+    args = parser.parse_args()
+
+    # 認証情報なしで比べるため, abqのアクセストークンの取得を省く
+    Credential.get_headers = classmethod(lambda cls, headers=None: {"Accept": "application/json"})
+    measure("abq", lambda: BQ(project_id="fake-project"), args)
+    measure("session", lambda: SessionBQ("fake-project", session=Session()), args)
+
+
+if __name__ == "__main__":
+    main()
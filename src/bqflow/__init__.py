@@ -1,16 +1,34 @@
 __version__ = "0.1.1"
 
-from pathlib import Path
+import json
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-from pydantic import BaseSettings
+if TYPE_CHECKING:
+    from bqflow.settings import Env
 
 
-class Env(BaseSettings):
-    GOOGLE_APPLICATION_CREDENTIALS: Path
+@lru_cache(maxsize=None)
+def get_env() -> "Env":
+    """環境変数と.envから設定を読む. 認証情報が必要になるまで読まない"""
+    from bqflow.settings import Env
 
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
+    return Env()
 
 
-env = Env()
+@lru_cache(maxsize=None)
+def read_credential() -> dict:
+    """GOOGLE_APPLICATION_CREDENTIALSの認証情報のjson. プロセスの中で一度だけ読む"""
+    with open(get_env().GOOGLE_APPLICATION_CREDENTIALS, "r") as f:
+        return json.load(f)
+
+
+def __getattr__(name: str):
+    # 以前のバージョンのbqflow.envとbqflow.Envを使うコードのため
+    if name == "env":
+        return get_env()
+    if name == "Env":
+        from bqflow.settings import Env
+
+        return Env
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
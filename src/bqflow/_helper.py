@@ -24,3 +24,18 @@ T = TypeVar("T")
 
 def ifnull(x: Optional[T], default: T) -> T:
     return x if x is not None else default
+
+
+def parse_size(size: str) -> int:
+    """convert_sizeの逆変換
+
+    Examples:
+        parse_size("1024") >>> 1024
+        parse_size("1.5 GB") >>> 1610612736
+    """
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    text = size.strip().upper()
+    for i, unit in reversed(list(enumerate(size_name))):
+        if text.endswith(unit):
+            return int(float(text[: -len(unit)].strip()) * math.pow(1024, i))
+    return int(text)
@@ -0,0 +1,163 @@
+"""小さなクエリをまとめて1つのBigQueryスクリプトとして実行する
+
+ジョブの作成, 待ち, ポーリングのオーバーヘッドをタスクごとに払わずに済むように,
+batchableなタスクのSQLを順に連結して1つのジョブにする.
+スクリプトの各文は子ジョブとして実行されるので, 子ジョブの行番号からタスクごとの結果を求める.
+"""
+
+import re
+from typing import Optional
+
+from abq import BQ
+from abq.bq import JobResult
+from pydantic import BaseModel
+from sqlparse import lexer
+from sqlparse import tokens as T
+
+from bqflow.fields import Parameter
+from bqflow.jobs import slot_ms
+from bqflow.task import Query
+
+# スクリプトの先頭にしか書けない文
+LEADING_ONLY = {"DECLARE"}
+# エラーメッセージ中の位置 [行:列]
+ERROR_POSITION = re.compile(r"\[(\d+):(\d+)\]")
+
+
+class Script(BaseModel):
+    """連結したスクリプトと各タスクの行の範囲"""
+
+    sql: str
+    # タスクごとの(開始行, 終了行). 行番号は1始まり
+    lines: list[tuple[int, int]]
+
+    def task_index(self, line: int) -> Optional[int]:
+        for i, (start, end) in enumerate(self.lines):
+            if start <= line <= end:
+                return i
+        return None
+
+
+class StatementStats(BaseModel):
+    duration: float = 0
+    total_bytes_billed: int = 0
+    statements: int = 0
+    # 最初の文の開始時刻と最後の文の終了時刻(UNIX時間の秒)
+    started: Optional[float] = None
+    ended: Optional[float] = None
+    slot_ms: int = 0
+
+
+def can_batch(task: Query) -> bool:
+    """他のタスクと連結してよいか
+
+    結果を出力するタスクと, DECLAREのようにスクリプトの先頭にしか書けない文を含むタスクは連結しない.
+    """
+    if not task.batchable or task.output is not None:
+        return False
+    for ttype, value in lexer.tokenize(task.sql):
+        if ttype in T.Keyword and value.upper() in LEADING_ONLY:
+            return False
+    return True
+
+
+def compatible(parameters: dict[str, Parameter], task: Query) -> bool:
+    """スクリプト全体で共有するパラメータと値が衝突しないか"""
+    return all(parameters.get(p.name, p) == p for p in task.parameters)
+
+
+def terminate(sql: str) -> str:
+    """SQLの末尾を;で終える
+
+    末尾がコメントのときは;がコメントに含まれないように次の行に置く.
+    """
+    last, commented = None, False
+    for ttype, value in lexer.tokenize(sql):
+        if ttype in T.Whitespace:
+            continue
+        if ttype in T.Comment:
+            commented = True
+            continue
+        last, commented = value, False
+    if last == ";":
+        return sql
+    return sql + ("\n;" if commented else ";")
+
+
+def build_script(tasks: list[Query]) -> Script:
+    """タスクのSQLを順に連結する
+
+    Args:
+        tasks (list[Query]): 依存関係の順に並んだタスク
+
+    Returns:
+        Script: 連結したスクリプト
+    """
+    blocks = []
+    lines = []
+    start = 1
+    for task in tasks:
+        sql = terminate(task.sql.strip())
+        end = start + sql.count("\n")
+        blocks.append(sql)
+        lines.append((start, end))
+        start = end + 1
+    return Script(sql="\n".join(blocks), lines=lines)
+
+
+async def child_jobs(bq: BQ, job: JobResult) -> list[dict]:
+    """スクリプトのジョブが実行した子ジョブを作成順に返す"""
+    res = await bq.get_job_list(projectId=job.project_id, parentJobId=job.job_id, maxResults=1000)
+    children = res.get("jobs", [])
+    return sorted(children, key=lambda x: int(x.get("statistics", {}).get("creationTime", 0)))
+
+
+def _child_line(child: dict) -> Optional[int]:
+    frames = child.get("statistics", {}).get("scriptStatistics", {}).get("stackFrames", [])
+    if not frames:
+        return None
+    return int(frames[0]["startLine"])
+
+
+def statement_stats(script: Script, children: list[dict]) -> list[StatementStats]:
+    """子ジョブの統計をタスクごとに集計する"""
+    stats = [StatementStats() for _ in script.lines]
+    for child in children:
+        line = _child_line(child)
+        i = script.task_index(line) if line is not None else None
+        if i is None:
+            continue
+        statistics = child.get("statistics", {})
+        if "startTime" in statistics and "endTime" in statistics:
+            started, ended = int(statistics["startTime"]) / 1000, int(statistics["endTime"]) / 1000
+            _add_time(stats[i], started, ended)
+        billed = statistics.get("query", {}).get("totalBytesBilled")
+        stats[i].total_bytes_billed += int(billed or 0)
+        stats[i].slot_ms += slot_ms(child) or 0
+        stats[i].statements += 1
+    return stats
+
+
+def _add_time(stat: StatementStats, started: float, ended: float):
+    stat.duration += ended - started
+    stat.started = started if stat.started is None else min(stat.started, started)
+    stat.ended = ended if stat.ended is None else max(stat.ended, ended)
+
+
+def failed_index(script: Script, children: list[dict], message: str) -> int:
+    """失敗したタスクの位置
+
+    エラーになった子ジョブの行, エラーメッセージ中の行の順に探し,
+    見つからなければ子ジョブが実行されていない最初のタスク, 全て実行されていれば最後のタスクとする.
+    """
+    for child in children:
+        if child.get("status", {}).get("errorResult") is not None:
+            line = _child_line(child)
+            if line is not None and script.task_index(line) is not None:
+                return script.task_index(line)
+    m = ERROR_POSITION.search(message)
+    if m is not None and script.task_index(int(m.group(1))) is not None:
+        return script.task_index(int(m.group(1)))
+    executed = {script.task_index(line) for line in map(_child_line, children) if line is not None}
+    default = len(script.lines) - 1
+    return next((i for i in range(len(script.lines)) if i not in executed), default)
@@ -0,0 +1,100 @@
+"""コンパイル済みの実行計画のディスクキャッシュ
+
+yamlと参照する全てのscriptのファイルが変わっていなければ, yamlの解析, Workflowの検証,
+SQLファイルの読み込みを省略して前回の実行計画を使う.
+ファイルはまず更新時刻とサイズで比較し, 異なる場合だけハッシュで比較する.
+
+キャッシュはpickleで保存するので, ワークフローのディレクトリではなく,
+他のユーザーが書き込めないユーザーごとのディレクトリに置く.
+"""
+
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Optional
+
+from pydantic import BaseModel
+
+from bqflow import __version__
+from bqflow.plan import Plan
+
+# 実行計画の構造を変えたら上げる
+CACHE_VERSION = 7
+
+
+def cache_dir() -> Path:
+    """ユーザーごとのキャッシュのディレクトリ
+
+    `XDG_CACHE_HOME`が設定されていればその下, なければ`~/.cache/bqflow`を使う.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "bqflow"
+
+
+def _sha256(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class FileStamp(BaseModel):
+    path: Path
+    mtime_ns: int
+    size: int
+    sha256: str
+
+    @classmethod
+    def of(cls, path: Path) -> "FileStamp":
+        stat = path.stat()
+        return cls(path=path, mtime_ns=stat.st_mtime_ns, size=stat.st_size, sha256=_sha256(path))
+
+    def is_fresh(self) -> bool:
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return False
+        if stat.st_mtime_ns == self.mtime_ns and stat.st_size == self.size:
+            return True
+        return _sha256(self.path) == self.sha256
+
+
+class PlanCache:
+    """yamlのパスとentrypointごとにコンパイル済みの実行計画を保存する
+
+    Args:
+        directory (Path): キャッシュを置くディレクトリ
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def _path(self, workflow_path: Path, entrypoint: Optional[str]) -> Path:
+        # scriptの相対パスは作業ディレクトリから解決されるので作業ディレクトリもキーに含める
+        key = f"{__version__}:{CACHE_VERSION}:{Path.cwd()}:{workflow_path.resolve()}:{entrypoint}"
+        return self.directory / f"{hashlib.sha256(key.encode()).hexdigest()[:16]}.pickle"
+
+    def get(self, workflow_path: Path, entrypoint: Optional[str] = None) -> Optional[Plan]:
+        """変更のないキャッシュがあれば実行計画を返す"""
+        path = self._path(workflow_path, entrypoint)
+        try:
+            with open(path, "rb") as f:
+                stamps, plan = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, AttributeError, EOFError, ImportError):
+            # キャッシュがない, または古いバージョンのbqflowで作られた
+            return None
+        if not all(stamp.is_fresh() for stamp in stamps):
+            return None
+        return plan
+
+    def put(self, workflow_path: Path, plan: Plan, entrypoint: Optional[str] = None):
+        """実行計画と, yamlおよび参照する全てのscriptのファイルの状態を保存する"""
+        files = [workflow_path] + plan.sources()
+        stamps = [FileStamp.of(p.resolve()) for p in files]
+        path = self._path(workflow_path, entrypoint)
+        # 他のユーザーがキャッシュを差し替えられないように本人だけが読み書きできるようにする
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # 書き込み途中のファイルを読まないように置き換える
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump((stamps, plan), f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(path)
@@ -1,37 +1,66 @@
-import asyncio
-import json
 from pathlib import Path
 from typing import Optional
 
-from abq import BQ
+from abq import QueryException
 
-from bqflow._helper import convert_size, mkdir_if_not_exists
+from bqflow._helper import convert_size
+from bqflow.dryrun import Estimate, estimate_plan, format_estimates, total_bytes
+from bqflow.export import export_result, writer_class
+from bqflow.plan import Plan
+from bqflow.session import SessionBQ, run
 
 
 class Client:
     def __init__(self, project_id: Optional[str]):
-        self.bq = BQ(project_id=project_id)
+        self.bq = SessionBQ(project_id)
 
-    def execute_query(self, sql_path: Path, output: Optional[Path] = None, nowait: bool = False):
+    def execute_query(
+        self,
+        sql_path: Path,
+        output: Optional[Path] = None,
+        nowait: bool = False,
+        dry_run: bool = False,
+        maximum_bytes_billed: Optional[int] = None,
+        echo: bool = True,
+    ):
         with open(sql_path, "r") as f:
             sql = f.read()
+        if output is not None:
+            # 実行してから拡張子の誤りに気づかないように先に確認する
+            writer_class(output)
 
         async def query():
             byte = await self.bq.dry_query(sql=sql)
             print("Processed:", convert_size(int(byte)))
-            job = await self.bq.query(sql=sql)
-            if not nowait:
+            if dry_run:
+                return
+            check_budget(int(byte), maximum_bytes_billed)
+            job = await self.bq.query(sql=sql, maximumBytesBilled=maximum_bytes_billed)
+            if not nowait or output is not None:
                 await job.wait()
-            return job
+            if output is not None:
+                rows = await export_result(job, output, echo=echo)
+                print(f"{rows} rows -> {output}")
 
-        job = asyncio.run(query())
+        run(query())
 
-        if output is not None:
-            result = asyncio.run(job.result())
+    def estimate_workflow(
+        self, plan: Plan, concurrency: int = 10, maximum_bytes_billed: Optional[int] = None
+    ) -> list[Estimate]:
+        """ワークフローの全クエリをドライランして見積もりを表示する
+
+        Returns:
+            list[Estimate]: クエリごとの見積もり
+        """
+        estimates = run(estimate_plan(self.bq, plan, concurrency=concurrency))
+        print(format_estimates(estimates))
+        check_budget(total_bytes(estimates), maximum_bytes_billed)
+        return estimates
 
-            mkdir_if_not_exists(output)
-            with open(output, "w") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-            from pprint import pprint
 
-            pprint(result)
+def check_budget(byte: int, maximum_bytes_billed: Optional[int]):
+    if maximum_bytes_billed is not None and byte > maximum_bytes_billed:
+        raise QueryException(
+            f"見積もり({convert_size(byte)})が"
+            f"--max-bytes-billed({convert_size(maximum_bytes_billed)})を超えています"
+        )
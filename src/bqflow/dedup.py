@@ -0,0 +1,86 @@
+"""同じクエリを1回だけ実行する
+
+ネストしたstepsやdagから同じtemplateが同じパラメータで複数回呼ばれると,
+task_namesが異なるだけの同じクエリになる.
+SQLとパラメータの値が一致するタスクは最初のタスクのジョブの完了を待ち, その結果を使って完了にする.
+"""
+
+import asyncio
+import hashlib
+import json
+from typing import NamedTuple, Optional
+
+from abq.bq import JobResult
+
+from bqflow.fields import Parameter
+from bqflow.task import Query
+
+
+class SharedJob(NamedTuple):
+    """他のタスクと共有するジョブの結果"""
+
+    task_names: list[str]
+    job: JobResult
+    # ジョブの実行秒数
+    duration: float
+
+
+def _canonical(param: Parameter) -> dict:
+    # クエリに渡るのは名前, 型, 値だけなので, defaultなどの違いは無視する
+    return {"name": param.name, "type": param.type, "value": param.value}
+
+
+def query_key(task: Query) -> str:
+    """SQLとパラメータの値から計算したクエリのキー"""
+    parameters = sorted((_canonical(p) for p in task.parameters), key=lambda p: p["name"])
+    text = json.dumps(
+        {"sql": task.sql, "parameters": parameters},
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class QueryMemo:
+    """実行中または完了したジョブをクエリのキーごとに保持する
+
+    最初のタスクがclaimで登録したfutureは, ジョブが成功したらSharedJob,
+    失敗したら例外, ジョブを投げられなかったらNoneで解決する.
+    """
+
+    def __init__(self):
+        self.futures: dict[str, "asyncio.Future[Optional[SharedJob]]"] = {}
+        # 最初に実行したタスク
+        self.leaders: dict[str, list[str]] = {}
+
+    def get(self, task: Query) -> Optional["asyncio.Future[Optional[SharedJob]]"]:
+        """同じクエリのジョブがあればその完了を表すfutureを返す"""
+        return self.futures.get(query_key(task))
+
+    def leader(self, task: Query) -> Optional[list[str]]:
+        return self.leaders.get(query_key(task))
+
+    def claim(self, task: Query) -> "asyncio.Future[Optional[SharedJob]]":
+        """taskを同じクエリの最初の実行として登録する"""
+        key = query_key(task)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[key] = future
+        self.leaders[key] = task.name
+        return future
+
+    def resolve(self, future: "asyncio.Future[Optional[SharedJob]]", shared: SharedJob):
+        future.set_result(shared)
+
+    def fail(self, future: "asyncio.Future[Optional[SharedJob]]", e: BaseException):
+        future.set_exception(e)
+        # 待っているタスクがなくても警告を出さないように取り出し済みにする
+        future.exception()
+
+    def abandon(self, task: Query, future: "asyncio.Future[Optional[SharedJob]]"):
+        """ジョブを投げられなかったので, 待っているタスクにはそれぞれ実行させる"""
+        key = query_key(task)
+        if self.futures.get(key) is future:
+            del self.futures[key]
+            del self.leaders[key]
+        future.set_result(None)
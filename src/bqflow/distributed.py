@@ -0,0 +1,344 @@
+"""共有するキューを使って複数のプロセスでワークフローを実行する
+
+Coordinatorはワークフローの依存関係を辿り, 実行可能になったタスクをSharedQueueに積む.
+Workerはどのワークフローのタスクかを問わずリースを取ってジョブを投げ, 結果を書き戻す.
+Coordinatorは書き戻された結果を受け取って次に実行可能になったタスクを積む.
+"""
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+from logging import getLogger
+from typing import Callable, Optional
+
+from abq import BQ
+from abq.async_retry import TooManyTriesException
+from abq.bq import JobResult
+
+from bqflow._helper import ifnull
+from bqflow.export import export_result
+from bqflow.fields import RetryStrategy, Workflow
+from bqflow.jobs import (
+    JobTimeout,
+    cancel_job,
+    error_message,
+    is_rate_limited,
+    is_retryable,
+    job_options,
+    raise_for_job_error,
+    rate_limit_delay,
+    slot_ms,
+)
+from bqflow.journal import new_run_id
+from bqflow.monitor import JobMonitor
+from bqflow.options import FailurePolicy
+from bqflow.parameter import parse_param
+from bqflow.plan import Plan
+from bqflow.priority import critical_path_lengths, priority_of, task_weights
+from bqflow.procon import skipped_reports
+from bqflow.report import TaskReport, TaskTiming
+from bqflow.session import SessionBQ
+from bqflow.sharedqueue import LeasedTask, SharedQueue
+from bqflow.task import Query
+from bqflow.tracer import TreeTracer
+
+logger = getLogger(__name__)
+
+
+class Coordinator:
+    """ワークフローのタスクを共有するキューに積み, workerの実行結果で依存関係を辿る
+
+    Args:
+        run_id (Optional[str]): 再開するrun id. 省略すると新しく実行する
+        poll_interval (float): キューの結果を確認する間隔の秒数
+        timeout (Optional[float]): templateで指定されていないタスクのtimeout
+        retry (Optional[RetryStrategy]): templateで指定されていないタスクの再実行の設定
+        maximum_bytes_billed (Optional[int]): 各ジョブのスキャン量の上限
+    """
+
+    def __init__(
+        self,
+        wf: Workflow,
+        project: str,
+        queue: SharedQueue,
+        run_id: Optional[str] = None,
+        failure_policy: FailurePolicy = "fail-fast",
+        plan: Optional[Plan] = None,
+        poll_interval: float = 0.5,
+        estimates: Optional[dict[tuple[str, ...], int]] = None,
+        timeout: Optional[float] = None,
+        retry: Optional[RetryStrategy] = None,
+        maximum_bytes_billed: Optional[int] = None,
+    ):
+        self.tt = TreeTracer(wf, plan=plan)
+        self.project = project
+        self.queue = queue
+        self.run_id = run_id
+        self.failure_policy = failure_policy
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.retry = retry
+        self.maximum_bytes_billed = maximum_bytes_billed
+        self.halted = False
+        weights = task_weights(self.tt.plan, estimates=estimates)
+        self.priorities = critical_path_lengths(self.tt.plan, weights)
+
+    def run(self) -> list[TaskReport]:
+        self.start()
+        return self.wait()
+
+    def start(self) -> str:
+        """実行を始め, 最初に実行可能なタスクを積む
+
+        Returns:
+            str: run id
+        """
+        if self.run_id is None:
+            self.run_id = new_run_id()
+            self.queue.create_run(self.run_id, self.project)
+        else:
+            if self.queue.reset(self.run_id) is None:
+                raise FileNotFoundError(f"run id {self.run_id}はキューに存在しませんでした")
+            self.tt.restore(self.queue.completed(self.run_id))
+        self.put(self.tt.get_tasks())
+        return self.run_id
+
+    def put(self, tasks: list[Query]):
+        if self.halted or not tasks:
+            return
+        priorities = [priority_of(self.priorities, task.name) for task in tasks]
+        # workerは実行計画を持たないので, 既定の設定はタスクに含めて渡す
+        tasks = [
+            task.copy(
+                update={
+                    "timeout": ifnull(task.timeout, self.timeout),
+                    "retry": ifnull(task.retry, self.retry),
+                    "maximum_bytes_billed": self.maximum_bytes_billed,
+                }
+            )
+            for task in tasks
+        ]
+        self.queue.put(self.run_id, tasks, priorities)
+
+    def wait(self) -> list[TaskReport]:
+        """全てのタスクが終わるまでworkerの結果を反映し続ける"""
+        while True:
+            # 先に数えておけば, 結果を反映して積んだタスクがなく0なら全て終わっている
+            pending = self.queue.pending(self.run_id)
+            reports = self.queue.finished(self.run_id)
+            for report in reports:
+                if report.state == "done":
+                    self.put(self.tt.task_done(report.name))
+                else:
+                    self.fail(report)
+            if self.tt.statuses.get_root_task().done or (pending == 0 and not reports):
+                break
+            time.sleep(self.poll_interval)
+        self.queue.finish_run(self.run_id)
+        reports = self.queue.reports(self.run_id)
+        return reports + skipped_reports(self.tt, reports)
+
+    def fail(self, report: TaskReport):
+        if report.state == "cancelled" or self.failure_policy == "continue-independent-branches":
+            return
+        self.halted = True
+        self.queue.halt(self.run_id, cancel=self.failure_policy == "fail-fast")
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:4]}"
+
+
+class Worker:
+    """共有するキューからタスクを取り出して実行する
+
+    Args:
+        queue (SharedQueue): タスクを取り出すキュー
+        concurrency (int): このworkerが同時に実行するジョブの数
+        lease (float): リースの秒数. この秒数の1/3ごとに延長する
+        poll_interval (float): 実行できるタスクがないときにキューを確認する間隔の秒数
+        bq (Optional[Callable[[str], BQ]]): プロジェクトIDからクライアントを作る. テストでは偽のBigQueryにする
+        worker_id (Optional[str]): リースの持ち主として記録する名前
+        job_poll_interval (float): ジョブの状態を確認する最小の間隔の秒数
+    """
+
+    def __init__(
+        self,
+        queue: SharedQueue,
+        concurrency: int = 10,
+        lease: float = 30.0,
+        poll_interval: float = 0.5,
+        bq: Optional[Callable[[str], BQ]] = None,
+        worker_id: Optional[str] = None,
+        job_poll_interval: float = 0.5,
+    ):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.make_bq = bq if bq is not None else SessionBQ
+        self.worker_id = worker_id if worker_id is not None else default_worker_id()
+        self.job_poll_interval = job_poll_interval
+        self.clients: dict[str, tuple[BQ, JobMonitor]] = {}
+        self.monitors: list[asyncio.Task] = []
+        # 実行中のタスクとジョブ
+        self.active: dict[int, asyncio.Task] = {}
+        self.jobs: dict[int, tuple[BQ, JobResult]] = {}
+        self.cancelled: set[int] = set()
+        self.background: set[asyncio.Task] = set()
+        self.executed = 0
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def run(self, exit_when_idle: bool = False):
+        """タスクを取り出して実行し続ける
+
+        Args:
+            exit_when_idle (bool): 実行中のワークフローがなくなったら終了する
+        """
+        self._wakeup = asyncio.Event()
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            while True:
+                self._wakeup.clear()
+                free = self.concurrency - len(self.active)
+                tasks = self.queue.claim(self.worker_id, free, self.lease) if free else []
+                for task in tasks:
+                    self.active[task.seq] = asyncio.create_task(self.execute(task))
+                if tasks:
+                    continue
+                if exit_when_idle and not self.active and not self.queue.has_active_runs():
+                    break
+                # タスクが終わって枠が空いたらすぐに取り出す
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # 止められたときは実行中のタスクを他のworkerがすぐに取れるようにする
+            for seq, task in list(self.active.items()):
+                task.cancel()
+                self.queue.release(seq, self.worker_id)
+            heartbeat.cancel()
+            await asyncio.gather(*self.background, return_exceptions=True)
+            for bq, monitor in self.clients.values():
+                monitor.stop()
+            await asyncio.gather(heartbeat, *self.monitors, return_exceptions=True)
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+
+    def client(self, project: str) -> tuple[BQ, JobMonitor]:
+        if project not in self.clients:
+            bq = self.make_bq(project)
+            interval = self.job_poll_interval
+            monitor = JobMonitor(bq, min_interval=interval, max_interval=max(interval, 10.0))
+            self.clients[project] = (bq, monitor)
+            self.monitors.append(asyncio.create_task(monitor.run()))
+        return self.clients[project]
+
+    async def heartbeat(self):
+        """実行中のタスクのリースを延長し, キャンセルを求められたジョブをキャンセルする"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                cancels = self.queue.heartbeat(self.worker_id, list(self.active), self.lease)
+            except Exception as e:
+                logger.warning(f"リースを延長できませんでした: {e}")
+                continue
+            for seq in cancels:
+                if seq in self.jobs and seq not in self.cancelled:
+                    self.cancelled.add(seq)
+                    bq, job = self.jobs[seq]
+                    self.spawn(self.cancel(bq, job))
+
+    async def cancel(self, bq: BQ, job: JobResult):
+        try:
+            await cancel_job(bq, job)
+        except Exception as e:
+            logger.warning(f"ジョブ{job.job_id}をキャンセルできませんでした: {e}")
+
+    async def execute(self, task: LeasedTask):
+        """タスクを実行して結果をキューに書き戻す"""
+        timing = TaskTiming(ready=task.ready_at, dequeued=time.time())
+        try:
+            report = await self.attempt(task, timing)
+            timing.finished = time.time()
+            report.timing = timing
+            if not self.queue.complete(task.seq, self.worker_id, report):
+                logger.warning(f"{task.query.name}のリースが切れていたので結果を捨てました")
+            self.executed += 1
+        finally:
+            self.active.pop(task.seq, None)
+            self.cancelled.discard(task.seq)
+            self._wakeup.set()
+
+    async def attempt(self, task: LeasedTask, timing: TaskTiming) -> TaskReport:
+        """一時的なエラーで失敗したらリースを持ったまま再実行する"""
+        query = task.query
+        strategy = query.retry if query.retry is not None else RetryStrategy()
+        retries, rate_limited, lost = 0, 0, 0.0
+        while True:
+            started = time.time()
+            try:
+                report = await self.run_query(task, timing)
+                break
+            except (Exception, TooManyTriesException) as e:
+                error = error_message(e)
+                if task.seq in self.cancelled:
+                    report = TaskReport(name=query.name, state="cancelled", error=error)
+                    break
+                delay = rate_limit_delay(rate_limited) if is_rate_limited(e) else None
+                if delay is not None:
+                    rate_limited += 1
+                    logger.warning(f"{query.name}がレート制限に当たったので{delay:.1f}秒後に再実行します")
+                    await asyncio.sleep(delay)
+                    continue
+                if not is_retryable(e) or retries >= strategy.limit:
+                    report = TaskReport(name=query.name, state="failed", error=error)
+                    break
+                retries += 1
+                delay = strategy.delay(retries)
+                lost += time.time() - started + delay
+                logger.warning(f"{query.name}を{delay:.1f}秒後に再実行します: {error}")
+                await asyncio.sleep(delay)
+        report.retries, report.lost = retries, lost
+        return report
+
+    async def run_query(self, task: LeasedTask, timing: TaskTiming) -> TaskReport:
+        query = task.query
+        bq, monitor = self.client(task.project)
+        timing.submitted = time.time()
+        job: JobResult = await bq.query(
+            sql=query.sql,
+            parameters=[parse_param(p) for p in query.parameters],
+            maximumBytesBilled=query.maximum_bytes_billed,
+            **job_options(query),
+        )
+        self.jobs[task.seq] = (bq, job)
+        try:
+            future = monitor.watch(job)
+            try:
+                json = await asyncio.wait_for(future, query.timeout)
+            except asyncio.TimeoutError:
+                monitor.forget(job)
+                self.spawn(self.cancel(bq, job))
+                raise JobTimeout(query.timeout) from None
+        finally:
+            self.jobs.pop(task.seq, None)
+        timing.slot_ms = slot_ms(json)
+        raise_for_job_error(json)
+
+        statistics = job.info.statistics
+        timing.started = statistics.startTime / 1000
+        timing.ended = statistics.endTime / 1000
+        if query.output is not None:
+            await export_result(job, query.output)
+        return TaskReport(
+            name=query.name,
+            duration=(statistics.endTime - statistics.startTime) / 1000,
+            total_bytes_billed=ifnull(statistics.query.totalBytesBilled, 0),
+        )
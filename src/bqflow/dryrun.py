@@ -0,0 +1,62 @@
+"""ワークフロー全体のドライランによるスキャン量の見積もり"""
+
+import asyncio
+from typing import Optional
+
+from abq import BQ
+from pydantic import BaseModel
+
+from bqflow._helper import convert_size
+from bqflow.parameter import parse_param
+from bqflow.plan import Plan
+from bqflow.task import Query
+
+
+class Estimate(BaseModel):
+    name: list[str]
+    total_bytes_processed: Optional[int] = None
+    # 上流タスクが作るテーブルを参照しているなど, ドライランに失敗した理由
+    error: Optional[str] = None
+
+
+async def estimate_query(bq: BQ, query: Query, semaphore: asyncio.Semaphore) -> Estimate:
+    async with semaphore:
+        params = [parse_param(param) for param in query.parameters]
+        try:
+            byte = await bq.dry_query(sql=query.sql, parameters=params)
+        except Exception as e:
+            return Estimate(name=query.name, error=str(e))
+    return Estimate(name=query.name, total_bytes_processed=byte)
+
+
+async def estimate_plan(bq: BQ, plan: Plan, concurrency: int = 10) -> list[Estimate]:
+    """実行計画の全クエリを並列にドライランする
+
+    Args:
+        bq (BQ): クライアント
+        plan (Plan): 実行計画
+        concurrency (int): 同時に投げるドライランの数
+
+    Returns:
+        list[Estimate]: 実行計画のクエリ順の見積もり
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # 値ごとのタスクも全て見積もる
+    queries = [plan.query(node) for node in plan.expand_all().leaves()]
+    return await asyncio.gather(*[estimate_query(bq, q, semaphore) for q in queries])
+
+
+def total_bytes(estimates: list[Estimate]) -> int:
+    return sum(e.total_bytes_processed or 0 for e in estimates)
+
+
+def format_estimates(estimates: list[Estimate]) -> str:
+    lines = []
+    for e in estimates:
+        name = "/".join(e.name)
+        if e.error is not None:
+            lines.append(f"{name}: 見積もれませんでした ({e.error})")
+        else:
+            lines.append(f"{name}: {convert_size(e.total_bytes_processed)}")
+    lines.append(f"Total Processed: {convert_size(total_bytes(estimates))}")
+    return "\n".join(lines)
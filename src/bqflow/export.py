@@ -0,0 +1,210 @@
+"""クエリ結果をページごとにファイルへ書き出す
+
+結果を全てメモリに載せずに, 取得したページから順に書き出す.
+形式は出力先の拡張子で決める.
+
+- .json: 行の配列
+- .ndjson, .jsonl: 1行1レコードのjson
+- .csv: ヘッダ付きのcsv. STRUCTやARRAYはjson文字列にする
+- .parquet: pyarrowが必要
+"""
+
+import csv
+import json
+from pathlib import Path
+from pprint import pprint
+from typing import AsyncIterator, Optional
+
+from abq.bq import JobResult
+from abq.rows_parser import RowsParser
+
+from bqflow._helper import mkdir_if_not_exists
+
+FORMATS = [".json", ".ndjson", ".jsonl", ".csv", ".parquet"]
+
+# 1ページで取得する行数
+PAGE_SIZE = 10000
+
+
+async def iter_pages(
+    job: JobResult, page_size: int = PAGE_SIZE
+) -> AsyncIterator[tuple[dict, list[dict]]]:
+    """完了したジョブの結果をページごとに取得する
+
+    abqのiter_resultは残りのページを先読みして溜め込むので, 1ページずつ取得する.
+
+    Yields:
+        tuple[dict, list[dict]]: 結果のスキーマとページの行
+    """
+    result = await job.get_query_result(maxResults=page_size)
+    schema = result["schema"]
+    if int(result["totalRows"]) == 0:
+        yield schema, []
+        return
+    parser = RowsParser(schema)
+    while True:
+        yield schema, parser.parse_rows(result.get("rows", []))
+        token = result.get("pageToken")
+        if token is None:
+            break
+        result = await job.get_query_result(maxResults=page_size, pageToken=token)
+
+
+class Writer:
+    def __init__(self, path: Path, schema: dict):
+        self.path = path
+        self.schema = schema
+        self.rows = 0
+
+    def write(self, rows: list[dict]):
+        self.rows += len(rows)
+
+    def close(self):
+        ...
+
+
+class JSONWriter(Writer):
+    def __init__(self, path: Path, schema: dict):
+        super().__init__(path, schema)
+        self.f = open(path, "w")
+        self.f.write("[")
+
+    def write(self, rows: list[dict]):
+        for row in rows:
+            self.f.write(",\n" if self.rows > 0 else "\n")
+            self.f.write(json.dumps(row, ensure_ascii=False, default=str))
+            self.rows += 1
+
+    def close(self):
+        self.f.write("\n]\n")
+        self.f.close()
+
+
+class NDJSONWriter(Writer):
+    def __init__(self, path: Path, schema: dict):
+        super().__init__(path, schema)
+        self.f = open(path, "w")
+
+    def write(self, rows: list[dict]):
+        for row in rows:
+            self.f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+        super().write(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class CSVWriter(Writer):
+    def __init__(self, path: Path, schema: dict):
+        super().__init__(path, schema)
+        self.f = open(path, "w", newline="")
+        self.fields = [field["name"] for field in schema["fields"]]
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(self.fields)
+
+    def write(self, rows: list[dict]):
+        for row in rows:
+            self.writer.writerow([self._cell(row.get(name)) for name in self.fields])
+        super().write(rows)
+
+    @staticmethod
+    def _cell(value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False, default=str)
+        return value
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter(Writer):
+    def __init__(self, path: Path, schema: dict):
+        super().__init__(path, schema)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError(
+                "parquetで出力するにはpyarrowが必要です. pip install 'bq-flow[parquet]'"
+            ) from None
+        self.pa = pa
+        self.arrow_schema = pa.schema([_arrow_field(pa, f) for f in schema["fields"]])
+        self.writer = pq.ParquetWriter(str(path), self.arrow_schema)
+
+    def write(self, rows: list[dict]):
+        if rows:
+            table = self.pa.Table.from_pylist(rows, schema=self.arrow_schema)
+            self.writer.write_table(table)
+        super().write(rows)
+
+    def close(self):
+        self.writer.close()
+
+
+def _arrow_field(pa, field: dict):
+    types = {
+        "INTEGER": pa.int64(),
+        "INT64": pa.int64(),
+        "FLOAT": pa.float64(),
+        "FLOAT64": pa.float64(),
+        "BOOLEAN": pa.bool_(),
+        "BOOL": pa.bool_(),
+        "STRING": pa.string(),
+        "GEOGRAPHY": pa.string(),
+        "BYTES": pa.binary(),
+        "DATE": pa.date32(),
+        "TIME": pa.time64("us"),
+        "DATETIME": pa.timestamp("us"),
+        "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    }
+    if field["type"] in ["RECORD", "STRUCT"]:
+        type_ = pa.struct([_arrow_field(pa, f) for f in field["fields"]])
+    else:
+        type_ = types.get(field["type"], pa.string())
+    if field.get("mode") == "REPEATED":
+        type_ = pa.list_(type_)
+    return pa.field(field["name"], type_, nullable=field.get("mode") != "REQUIRED")
+
+
+WRITERS = {
+    ".json": JSONWriter,
+    ".ndjson": NDJSONWriter,
+    ".jsonl": NDJSONWriter,
+    ".csv": CSVWriter,
+    ".parquet": ParquetWriter,
+}
+
+
+def writer_class(path: Path) -> type:
+    suffix = path.suffix.lower()
+    if suffix not in WRITERS:
+        raise ValueError(f"{path}の拡張子には対応していません. {FORMATS}のいずれかを指定してください")
+    return WRITERS[suffix]
+
+
+async def export_result(job: JobResult, output: Path, echo: bool = False) -> int:
+    """ジョブの結果をoutputに書き出す
+
+    Args:
+        job (JobResult): 完了したジョブ
+        output (Path): 出力先. 拡張子で形式を決める
+        echo (bool): 書き出した行を標準出力にも表示する
+
+    Returns:
+        int: 書き出した行数
+    """
+    cls = writer_class(output)
+    mkdir_if_not_exists(output)
+    writer: Optional[Writer] = None
+    try:
+        async for schema, rows in iter_pages(job):
+            if writer is None:
+                writer = cls(output, schema)
+            writer.write(rows)
+            if echo:
+                for row in rows:
+                    pprint(row)
+    finally:
+        if writer is not None:
+            writer.close()
+    return writer.rows if writer is not None else 0
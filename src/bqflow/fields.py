@@ -5,6 +5,7 @@ https://argoproj.github.io/argo/fields/#workflowstep
 """
 
 from collections import Counter
+from datetime import date, timedelta
 from pathlib import Path
 from typing import Any, Literal, Optional, Union
 
@@ -39,6 +40,9 @@ Array = Literal[
     "ARRAY<STRUCT>",
 ]
 
+# BigQueryのジョブの優先度. BATCHはスロットが空くまで待ってから実行される
+JobPriority = Literal["INTERACTIVE", "BATCH"]
+
 
 class ExtraForbid(BaseModel):
     class Config:
@@ -60,21 +64,123 @@ class Inputs(ExtraForbid):
     parameters: list[Parameter] = []
 
 
-class DAGTask(ExtraForbid):
+class Range(ExtraForbid):
+    """withRangeで展開する値の範囲. endを含む. 日付のstepは日数"""
+
+    start: Union[int, date]
+    end: Union[int, date]
+    step: int = 1
+
+    @root_validator
+    def check_range(cls, values):
+        start, end = values.get("start"), values.get("end")
+        if type(start) is not type(end):
+            raise ValueError(f"startとendの型が異なります {start}, {end}")
+        if values.get("step") == 0:
+            raise ValueError("stepに0は指定できません")
+        return values
+
+    def __len__(self) -> int:
+        if isinstance(self.start, date):
+            span = (self.end - self.start).days
+        else:
+            span = self.end - self.start
+        return max(0, span // self.step + 1)
+
+    def value(self, i: int) -> Union[int, date]:
+        if isinstance(self.start, date):
+            return self.start + timedelta(days=i * self.step)
+        return self.start + i * self.step
+
+
+class Backoff(ExtraForbid):
+    """再実行までの待ち時間. n回目の再実行はduration * factor ** (n - 1)秒待つ"""
+
+    duration: float = 1.0
+    factor: float = 2.0
+    # 待ち時間の上限
+    maxDuration: Optional[float]
+
+    @root_validator(skip_on_failure=True)
+    def check_backoff(cls, values):
+        if values["duration"] < 0 or values["factor"] < 1:
+            raise ValueError("backoffのdurationは0以上, factorは1以上を指定してください")
+        return values
+
+
+class RetryStrategy(ExtraForbid):
+    """失敗したタスクを再実行する設定. limitは再実行する回数の上限
+
+    再実行するのはBigQueryの一時的なエラーとtimeoutだけで, SQLの誤りや権限のエラーは再実行しない.
+    """
+
+    limit: int = 0
+    backoff: Backoff = Backoff()
+
+    @validator("limit")
+    def check_limit(cls, limit: int):
+        if limit < 0:
+            raise ValueError("retryStrategyのlimitは0以上を指定してください")
+        return limit
+
+    def delay(self, retry: int) -> float:
+        """retry回目の再実行までに待つ秒数"""
+        delay = self.backoff.duration * self.backoff.factor ** (retry - 1)
+        if self.backoff.maxDuration is not None:
+            delay = min(delay, self.backoff.maxDuration)
+        return delay
+
+
+class FanOut(ExtraForbid):
+    """ひとつのタスクを値ごとのタスクに展開する設定
+
+    withItemsはリスト, withParamはARRAY型のパラメータの名前, withRangeは値の範囲を指定する.
+    parallelismは展開したタスクのうち同時に実行する数の上限.
+    """
+
+    withItems: Optional[list[Any]]
+    withParam: Optional[str]
+    withRange: Optional[Range]
+    parallelism: Optional[int]
+
+    @property
+    def is_fanout(self) -> bool:
+        return any(x is not None for x in [self.withItems, self.withParam, self.withRange])
+
+    @root_validator(skip_on_failure=True)
+    def check_fanout(cls, values):
+        name = values.get("name")
+        given = [values.get(k) is not None for k in ["withItems", "withParam", "withRange"]]
+        if given.count(True) > 1:
+            raise ValueError(f"withItems, withParam, withRangeはいずれかひとつを指定してください [{name}]")
+        parallelism = values.get("parallelism")
+        if parallelism is not None and (parallelism < 1 or not any(given)):
+            raise ValueError(
+                f"parallelismはwithItems, withParam, withRangeと一緒に1以上を指定してください [{name}]"
+            )
+        return values
+
+
+class DAGTask(FanOut):
     name: str
     template: Optional[str]
     dependencies: list[str] = []
     arguments: Argument = Argument()
+    # templateのpoolとpriorityを上書きする
+    pool: Optional[str]
+    priority: Optional[JobPriority]
 
 
 class DAGTemplate(ExtraForbid):
     tasks: list[DAGTask]
 
 
-class Step(ExtraForbid):
+class Step(FanOut):
     name: str
     template: Optional[str]
     arguments: Argument = Argument()
+    pool: Optional[str]
+    priority: Optional[JobPriority]
 
 
 class Template(ExtraForbid):
@@ -82,6 +188,16 @@ class Template(ExtraForbid):
     script: Optional[Path]
     run: Optional[str]
     inputs: Inputs = Inputs()
+    # runとscriptの結果の出力先. {task}はタスク名に置き換える
+    output: Optional[Path]
+    # 他のbatchableなタスクとまとめて1つのスクリプトとして実行してよいか
+    batchable: bool = False
+    # ジョブの完了を待つ秒数. 過ぎたらジョブをキャンセルする
+    timeout: Optional[float]
+    retryStrategy: Optional[RetryStrategy]
+    # 同時実行数を制限するpoolの名前と, ジョブの優先度. stepsとdagでは中のタスク全てに適用する
+    pool: Optional[str]
+    priority: Optional[JobPriority]
     steps: Optional[list[list[Step]]]
     dag: Optional[DAGTemplate]
 
@@ -108,9 +224,27 @@ class Template(ExtraForbid):
         ]
         if not conds.count(False):
             raise ValueError(f"script, steps, dagのいずれかひとつを指定してください [Teplate: {name}]")
+        if values.get("output") is not None and conds[2] and conds[3]:
+            raise ValueError(f"outputはscriptまたはrunにのみ指定できます [Teplate: {name}]")
+        if values.get("batchable") and conds[2] and conds[3]:
+            raise ValueError(f"batchableはscriptまたはrunにのみ指定できます [Teplate: {name}]")
+        for key in ["timeout", "retryStrategy"]:
+            if values.get(key) is not None and conds[2] and conds[3]:
+                raise ValueError(f"{key}はscriptまたはrunにのみ指定できます [Teplate: {name}]")
+        if values.get("timeout") is not None and values["timeout"] <= 0:
+            raise ValueError(f"timeoutは0より大きい秒数を指定してください [Teplate: {name}]")
         return values
 
 
+def convert_tasks(template: Template) -> list[Union[Step, DAGTask]]:
+    """templateのstepsまたはdagのタスク"""
+    if template.steps is not None:
+        return [step for steps in template.steps for step in steps]
+    if template.dag is not None:
+        return template.dag.tasks
+    return []
+
+
 class Workflow(ExtraForbid):
     """ワークフロー定義yamlのデータ構造
 
@@ -118,10 +252,13 @@ class Workflow(ExtraForbid):
         - templateに存在しないnameをentrypointで指定してはならない
         - templatesのnameはユニークでなければならない
         - stepまたはdagで存在しないtemplate nameを指定してはならない
+        - templateとタスクのpoolはpoolsで定義しなければならない
     """
 
     entrypoint: str
     arguments: Argument = Argument()
+    # poolの名前ごとの同時実行数の上限
+    pools: dict[str, int] = {}
     templates: list[Template] = []
 
     @root_validator
@@ -131,6 +268,22 @@ class Workflow(ExtraForbid):
             raise ValueError(f"templatesに存在しないnameがentrypointで指定されました {entrypoint}")
         return values
 
+    @root_validator(skip_on_failure=True)
+    def check_pools(cls, values):
+        pools, templates = values["pools"], values["templates"]
+        small = [name for name, capacity in pools.items() if capacity < 1]
+        if small:
+            raise ValueError(f"poolsの同時実行数は1以上を指定してください {small}")
+        refs = set()
+        for tmp in templates:
+            refs.add(tmp.pool)
+            for task in convert_tasks(tmp):
+                refs.add(task.pool)
+        sub = refs - set(pools) - {None}
+        if sub:
+            raise ValueError(f"poolsに存在しないpoolが指定されています {sub}")
+        return values
+
     @validator("templates")
     def unique_name(tmps: list[Template]):
         names = [v.name for v in tmps]
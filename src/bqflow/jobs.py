@@ -0,0 +1,197 @@
+"""abqが提供していないBigQueryジョブの操作"""
+
+from typing import Optional
+
+import httpx
+from abq import BQ, QueryException
+from abq.bq import EndPoint, JobResult
+
+from bqflow.task import Query
+
+
+def job_error(json: dict) -> Optional[str]:
+    """ジョブのjsonからエラーメッセージを返す
+
+    abqのJobモデルはerrorResultを持たないのでジョブのjsonから直接取り出す.
+
+    Returns:
+        Optional[str]: エラーがなければNone
+    """
+    error = json.get("status", {}).get("errorResult")
+    if error is None:
+        return None
+    return f'{error.get("reason")}: {error.get("message")}'
+
+
+def slot_ms(json: dict) -> Optional[int]:
+    """ジョブのjsonから消費したスロット時間(ミリ秒)を返す
+
+    abqのJobモデルはtotalSlotMsを持たないのでジョブのjsonから直接取り出す.
+    """
+    statistics = json.get("statistics", {})
+    value = statistics.get("totalSlotMs", statistics.get("query", {}).get("totalSlotMs"))
+    return int(value) if value is not None else None
+
+
+class BigQueryError(QueryException):
+    """BigQueryが返したエラー. reasonはエラーの理由
+
+    https://cloud.google.com/bigquery/docs/error-messages
+    """
+
+    def __init__(self, message: str, reason: Optional[str] = None):
+        super().__init__(message)
+        self.reason = reason
+
+
+def job_exception(json: dict) -> Optional[BigQueryError]:
+    """ジョブのjsonのエラーを理由付きの例外にする. エラーがなければNone"""
+    error = job_error(json)
+    if error is None:
+        return None
+    reason = json["status"]["errorResult"].get("reason")
+    return BigQueryError(f"Query Error: {error}", reason=reason)
+
+
+def raise_for_job_error(json: dict):
+    error = job_exception(json)
+    if error is not None:
+        raise error
+
+
+def api_error(r: httpx.Response) -> Optional[BigQueryError]:
+    """APIのレスポンスのエラー. エラーでなければNone
+
+    理由はレスポンスのerrorsの先頭から取り出し, 理由のない429はrateLimitExceededとする.
+    """
+    try:
+        body = r.json()
+    except ValueError:
+        body = None
+    error = body.get("error") if isinstance(body, dict) else None
+    if error is None:
+        if r.status_code == 429:
+            return BigQueryError("Query Error: Too Many Requests", reason="rateLimitExceeded")
+        return None
+    errors = error.get("errors") or [{}]
+    reason = errors[0].get("reason")
+    if reason is None and r.status_code == 429:
+        reason = "rateLimitExceeded"
+    return BigQueryError(f'Query Error: {error.get("message")}', reason=reason)
+
+
+# https://cloud.google.com/bigquery/docs/reference/rest/v2/jobs/cancel
+async def cancel_job(bq: BQ, job: JobResult):
+    """ジョブのキャンセルをリクエストする
+
+    キャンセルは非同期に行われるので, 完了を待つ場合はjob.wait()を使う.
+    """
+    endpoint = EndPoint().job.format(projectId=job.project_id) + job.job_id + "/cancel"
+    await bq.post(endpoint=endpoint, json={})
+
+
+# https://cloud.google.com/bigquery/docs/reference/rest/v2/jobs/insert
+async def insert_query(
+    bq: BQ,
+    sql: str,
+    parameters: Optional[list] = None,
+    priority: str = "BATCH",
+    maximumBytesBilled: Optional[int] = None,
+) -> dict:
+    """優先度を指定してクエリのジョブを作る
+
+    abqが使うjobs.queryは優先度を指定できないので, jobs.insertでジョブを作る.
+
+    Returns:
+        dict: 作成したジョブのjson
+    """
+    query = {"query": sql, "useLegacySql": False, "priority": priority}
+    if maximumBytesBilled is not None:
+        query["maximumBytesBilled"] = str(maximumBytesBilled)
+    if parameters is not None:
+        query["parameterMode"] = "NAMED"
+        query["queryParameters"] = [p.to_api_repr() for p in parameters]
+
+    def error(r):
+        e = api_error(r)
+        if e is not None:
+            raise e
+
+    endpoint = EndPoint().job.format(projectId=bq._project_id).rstrip("/")
+    r = await bq.post(endpoint=endpoint, json={"configuration": {"query": query}}, call_back=error)
+    return r.json()
+
+
+def job_options(task: Query) -> dict:
+    """bq.queryに渡すタスクのジョブの設定. 優先度は指定したときだけ渡す"""
+    return {"priority": task.priority} if task.priority is not None else {}
+
+
+# 時間をおけば解消するレート制限のエラーの理由.
+# quotaExceededは1日のスキャン量などの待っても解消しないクォータも含むので再実行しない
+RATE_LIMIT_REASONS = ["rateLimitExceeded"]
+# レート制限で再実行するまでに待つ秒数. 再実行するたびに倍にする
+RATE_LIMIT_WAIT = 1.0
+RATE_LIMIT_MAX_WAIT = 60.0
+# レート制限で再実行する回数の上限. 超えたらタスクを失敗にする
+RATE_LIMIT_RETRIES = 8
+
+
+def error_message(e: BaseException) -> str:
+    """例外のメッセージ. abqのリトライで包まれた例外は元の例外のメッセージを返す"""
+    while not str(e) and e.__cause__ is not None:
+        e = e.__cause__
+    return str(e) or type(e).__name__
+
+
+def error_reason(e: BaseException) -> Optional[str]:
+    """BigQueryのエラーの理由. abqのリトライで包まれた例外は元の例外から取り出す"""
+    current: Optional[BaseException] = e
+    while current is not None:
+        if isinstance(current, BigQueryError):
+            return current.reason
+        if isinstance(current, httpx.HTTPStatusError):
+            error = api_error(current.response)
+            return error.reason if error is not None else None
+        current = current.__cause__
+    return None
+
+
+def is_rate_limited(e: BaseException) -> bool:
+    """レート制限によるエラーか"""
+    return error_reason(e) in RATE_LIMIT_REASONS
+
+
+def rate_limit_delay(count: int) -> Optional[float]:
+    """レート制限でcount回再実行したタスクを次に再実行するまでに待つ秒数
+
+    Returns:
+        Optional[float]: 再実行の回数が上限に達していればNone
+    """
+    if count >= RATE_LIMIT_RETRIES:
+        return None
+    return min(RATE_LIMIT_WAIT * 2 ** count, RATE_LIMIT_MAX_WAIT)
+
+
+# 時間をおいて再実行すれば成功しうるジョブのエラーの理由
+# https://cloud.google.com/bigquery/docs/error-messages
+RETRYABLE_REASONS = ["backendError", "internalError", "jobBackendError", "jobInternalError"]
+
+
+class JobTimeout(Exception):
+    """ジョブがtimeoutまでに完了しなかった"""
+
+    def __init__(self, timeout: float):
+        super().__init__(f"timeout: {timeout}秒以内に完了しなかったのでキャンセルしました")
+        self.timeout = timeout
+
+
+def is_retryable(e: BaseException) -> bool:
+    """再実行すれば成功しうるエラーか
+
+    BigQuery内部の一時的なエラーとtimeoutは再実行し, SQLの誤り, 権限, スキャン量の上限,
+    キャンセルなど何度実行しても同じ結果になるエラーは再実行しない.
+    """
+    if isinstance(e, JobTimeout):
+        return True
+    return error_reason(e) in RETRYABLE_REASONS
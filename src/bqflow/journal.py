@@ -0,0 +1,89 @@
+"""ワークフロー実行の追記専用ジャーナル
+
+完了したタスクをtask_namesごとに1行のjsonとして追記していき,
+失敗したワークフローを再実行するときに完了済みのタスクを復元できるようにする.
+成功した実行のジャーナルは削除し, 失敗した実行も新しいものからKEEP_RUNS個だけ残す.
+"""
+
+import json
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from bqflow._helper import mkdir_if_not_exists
+
+# ワークフローごとに残す実行のジャーナルの数
+KEEP_RUNS = 20
+
+
+def journal_dir(workflow_path: Path) -> Path:
+    """ワークフローのyamlと同じ場所に置くジャーナルのディレクトリ"""
+    return workflow_path.parent / ".bqflow" / "runs"
+
+
+def new_run_id() -> str:
+    return datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+
+
+def prune(directory: Path, keep: int):
+    """新しいものからkeep個を残して古い実行のジャーナルを削除する
+
+    run idは開始時刻から始まるので, 名前の順が実行の順になる.
+    """
+    paths = sorted(directory.glob("*.jsonl"), key=lambda p: p.name)
+    for path in paths[: max(len(paths) - keep, 0)]:
+        path.unlink(missing_ok=True)
+
+
+class Journal:
+    def __init__(self, path: Path, run_id: str):
+        self.path = path
+        self.run_id = run_id
+
+    @classmethod
+    def create(cls, directory: Path, workflow: Path, entrypoint: str) -> "Journal":
+        """新しい実行のジャーナルを作成する"""
+        run_id = new_run_id()
+        journal = cls(directory / f"{run_id}.jsonl", run_id)
+        mkdir_if_not_exists(journal.path)
+        journal._write({"event": "start", "workflow": str(workflow), "entrypoint": entrypoint})
+        prune(directory, KEEP_RUNS)
+        return journal
+
+    @classmethod
+    def open(cls, directory: Path, run_id: str) -> "Journal":
+        """再開するために既存のジャーナルを開く"""
+        path = directory / f"{run_id}.jsonl"
+        if not path.exists():
+            raise FileNotFoundError(f"run id {run_id}のジャーナルが見つかりませんでした: {path}")
+        return cls(path, run_id)
+
+    def remove(self):
+        """成功して再開する必要のなくなった実行のジャーナルを削除する"""
+        self.path.unlink(missing_ok=True)
+
+    def _write(self, record: dict):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _read(self) -> list[dict]:
+        records = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた最終行は無視する
+                    break
+        return records
+
+    def header(self) -> Optional[dict]:
+        return next((r for r in self._read() if r.get("event") == "start"), None)
+
+    def record_done(self, task_names: list[str]):
+        self._write({"event": "done", "task_names": task_names})
+
+    def completed(self) -> list[list[str]]:
+        """完了済みのタスクを返す"""
+        return [r["task_names"] for r in self._read() if r.get("event") == "done"]
@@ -0,0 +1,248 @@
+"""ジョブの同時実行数の制御"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Optional
+
+
+class ConcurrencyLimiter:
+    """上限を実行中に変更できるセマフォ
+
+    固定の同時実行数で使う場合はこのクラスをそのまま使う.
+    """
+
+    def __init__(self, limit: int):
+        self.value = float(limit)
+        self.maximum = limit
+        self.active = 0
+        self.peak = self.level
+        self._waiters: "deque[asyncio.Future]" = deque()
+
+    @property
+    def level(self) -> int:
+        return int(self.value)
+
+    async def acquire(self):
+        while self.active >= self.level:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self.active += 1
+
+    async def admit(self):
+        """取り出したタスクのジョブを投げてよくなるまで待つ
+
+        acquireした枠でキューからタスクを取り出した後に呼ぶ. 複数のワークフローで枠を共有するときに使う.
+        """
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def withdraw(self):
+        """タスクを取り出さなかった枠を返す"""
+        self.release()
+
+    def _wake(self):
+        free = self.level - self.active
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def on_complete(self, pending: float, backlog: bool):
+        """ジョブの完了を通知する
+
+        Args:
+            pending (float): ジョブが作成されてから実行が始まるまでの秒数
+            backlog (bool): 実行待ちのタスクがあるか
+        """
+
+    def on_rate_limited(self):
+        """ジョブがレート制限やクォータ超過で拒否されたことを通知する"""
+
+    def describe(self) -> str:
+        return f"{self.level}"
+
+
+class AIMDLimiter(ConcurrencyLimiter):
+    """AIMDで同時実行数を調整する
+
+    実行待ちのタスクがありBigQuery側のpending時間が短い間は完了ごとに少しずつ上限を増やし,
+    pending時間が長くなるかレート制限に当たったら上限を半分にする.
+    """
+
+    def __init__(
+        self,
+        maximum: int,
+        minimum: int = 1,
+        initial: int = 2,
+        pending_threshold: float = 5.0,
+        decrease: float = 0.5,
+        cooldown: float = 10.0,
+    ):
+        super().__init__(max(minimum, min(initial, maximum)))
+        self.initial = self.level
+        self.maximum = maximum
+        self.minimum = minimum
+        self.pending_threshold = pending_threshold
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._last_decrease: Optional[float] = None
+
+    def on_complete(self, pending: float, backlog: bool):
+        if pending > self.pending_threshold:
+            self._decrease()
+        elif backlog and self.active >= self.level - 1:
+            self.value = min(float(self.maximum), self.value + 1 / self.level)
+            self.peak = max(self.peak, self.level)
+            self._wake()
+
+    def on_rate_limited(self):
+        self._decrease()
+
+    def _decrease(self):
+        # 同じ混雑に対して何度も下げないように一定時間は下げない
+        now = time.monotonic()
+        if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.value = max(float(self.minimum), self.value * self.decrease)
+
+    def describe(self) -> str:
+        return f"auto (initial {self.initial}, peak {self.peak}, final {self.level})"
+
+
+class SharedPool:
+    """複数のワークフローで共有する実行枠
+
+    ワークフローごとにlimiterで作ったPoolLimiterを使う.
+    枠が空いたら, 枠を待っているワークフローのうち使っている枠が最も少ないワークフローに渡す.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.peak = 0
+        self._waiters: "dict[PoolLimiter, deque[asyncio.Future]]" = {}
+
+    def limiter(self, cap: Optional[int] = None) -> "PoolLimiter":
+        """ワークフローに使わせるlimiter
+
+        Args:
+            cap (Optional[int]): ワークフローが同時に使う枠の上限. 省略すると共有する枠の数
+        """
+        return PoolLimiter(self, min(cap or self.limit, self.limit))
+
+    async def acquire(self, member: "PoolLimiter"):
+        if self.active < self.limit and not self._waiters:
+            self._take(member)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(member, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 枠を渡された後にキャンセルされた
+                self.release(member)
+            else:
+                self._discard(member, waiter)
+            raise
+
+    def release(self, member: "PoolLimiter"):
+        self.active -= 1
+        member.held -= 1
+        self._wake()
+
+    def _take(self, member: "PoolLimiter"):
+        self.active += 1
+        member.held += 1
+        self.peak = max(self.peak, self.active)
+
+    def _discard(self, member: "PoolLimiter", waiter: asyncio.Future):
+        waiters = self._waiters.get(member)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[member]
+
+    def _wake(self):
+        while self.active < self.limit and self._waiters:
+            # 同数なら先に待ち始めたワークフローを優先する
+            member = min(self._waiters, key=lambda m: m.held)
+            waiters = self._waiters[member]
+            waiter = waiters.popleft()
+            if not waiters:
+                del self._waiters[member]
+            if not waiter.done():
+                self._take(member)
+                waiter.set_result(None)
+
+
+class PoolLimiter(ConcurrencyLimiter):
+    """SharedPoolの枠を使うワークフローごとのlimiter
+
+    acquireはワークフローごとの上限だけを確かめ, タスクを取り出した後のadmitで共有する枠を待つ.
+    タスクのないワークフローのworkerが共有する枠を塞がないようにするため.
+    """
+
+    def __init__(self, pool: SharedPool, limit: int):
+        super().__init__(limit)
+        self.pool = pool
+        # 使っている共有する枠の数
+        self.held = 0
+
+    async def admit(self):
+        await self.pool.acquire(self)
+
+    def release(self):
+        self.pool.release(self)
+        super().release()
+
+    def withdraw(self):
+        super().release()
+
+    def describe(self) -> str:
+        return f"{self.level} (shared pool {self.pool.limit})"
+
+
+class Pools:
+    """名前付きのpoolごとの同時実行数
+
+    ReadyQueueがタスクを取り出すときにタスクのpoolの枠を取り, 実行が終わったら返す.
+    poolを指定しないタスクは全体の同時実行数だけで制限する.
+
+    Args:
+        capacities (dict[str, int]): poolの名前ごとの同時実行数の上限
+    """
+
+    def __init__(self, capacities: dict[str, int]):
+        self.capacities = dict(capacities)
+        self.active = {name: 0 for name in capacities}
+        self.peak = dict(self.active)
+
+    def try_acquire(self, pool: Optional[str]) -> bool:
+        """枠が空いていれば取る"""
+        if pool is None:
+            return True
+        if self.active[pool] >= self.capacities[pool]:
+            return False
+        self.active[pool] += 1
+        self.peak[pool] = max(self.peak[pool], self.active[pool])
+        return True
+
+    def release(self, pool: Optional[str]):
+        if pool is not None:
+            self.active[pool] -= 1
+
+    def describe(self) -> str:
+        """poolごとの最大の同時実行数と上限"""
+        return ", ".join(f"{name} {self.peak[name]}/{cap}" for name, cap in self.capacities.items())
@@ -0,0 +1,407 @@
+"""SQLが読み書きするテーブルから推定するタスクの依存関係
+
+run, scriptのSQLをsqlparseで字句解析し, CREATE/INSERT/MERGEなどの書き込み先と
+FROM/JOINなどの読み込み元のテーブルを集める.
+テーブルの読み書きから実際のデータの依存関係を求め, yamlに書かれた依存関係の過不足を調べたり,
+推定した依存関係だけで実行計画を組み直したりする.
+
+テーブル名はプロジェクトを除いた`dataset.table`で比較する.
+別プロジェクトの同名テーブルも同じテーブルとみなすので, 依存関係は多めに推定される.
+データセットを省略したテーブル名はCTEや一時テーブルと区別できないので無視する.
+"""
+
+import re
+from collections import deque
+from fnmatch import fnmatchcase
+from typing import Optional
+
+from pydantic import BaseModel
+from sqlparse import lexer
+from sqlparse import tokens as T
+
+from bqflow.plan import Plan, PlanNode
+
+NAME = r"(?:`[^`]+`|[\w\-*]+)(?:\s*\.\s*(?:`[^`]+`|[\w\-*]+))*"
+TARGET = re.compile(r"\s*(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(" + NAME + r")(\s*\()?", re.IGNORECASE)
+# CREATE TABLE x LIKE y のように書き込み先の直後に書く読み込み元
+SOURCE = re.compile(r"\s+(?:LIKE|CLONE|COPY)\s+(" + NAME + ")", re.IGNORECASE)
+
+READ_KEYWORDS = {"FROM", "USING"}
+WRITE_STATEMENTS = {"INSERT", "MERGE", "UPDATE", "DELETE"}
+DDL_STATEMENTS = {"CREATE", "CREATE OR REPLACE", "DROP", "TRUNCATE", "ALTER"}
+DDL_OBJECTS = {"TABLE", "VIEW"}
+# 引数の中にFROMを書く関数. EXTRACT(DATE FROM ts)など
+FROM_FUNCTIONS = {"EXTRACT"}
+
+
+class Lineage(BaseModel):
+    reads: set[str] = set()
+    writes: set[str] = set()
+
+
+def table_key(name: str) -> Optional[str]:
+    """テーブル名を比較用のキーにする. データセットを省略した名前はNone"""
+    parts = [p.strip().strip("`") for p in name.split(".")]
+    if len(parts) < 2:
+        return None
+    return ".".join(parts[-2:])
+
+
+def _tokens(sql: str) -> list[tuple[int, object, str]]:
+    """空白とコメントを除いたトークンを(開始位置, 種類, 値)で返す"""
+    tokens = []
+    pos = 0
+    for ttype, value in lexer.tokenize(sql):
+        if not (value.isspace() or ttype in T.Comment):
+            tokens.append((pos, ttype, value))
+        pos += len(value)
+    return tokens
+
+
+def _target(sql: str, end: int, into: set[str], write: bool = False) -> Optional[re.Match]:
+    """endの位置から始まるテーブル名をintoに加える"""
+    m = TARGET.match(sql, end)
+    # 読み込み元の直後の括弧はテーブル関数なのでテーブルとして扱わない.
+    # 書き込み先の直後の括弧は列の指定
+    if m is None or (m.group(2) is not None and not write):
+        return None
+    key = table_key(m.group(1))
+    if key is not None:
+        into.add(key)
+    return m
+
+
+def _access(ttype, word: str, previous: str, ddl: Optional[str]) -> Optional[str]:
+    """直後にテーブル名が来るトークンならread, write, ddlのいずれかを返す"""
+    if word == "INTO" or (word == "FROM" and previous == "DELETE"):
+        return "write"
+    if ttype in T.Keyword.DML and word in WRITE_STATEMENTS:
+        # INSERT ds.t やMERGE ds.tのようにINTOを省略した書き込み先
+        return "write"
+    if word in DDL_OBJECTS and ddl in DDL_STATEMENTS:
+        return "ddl"
+    if word in READ_KEYWORDS or word.endswith("JOIN") or word == "TABLE":
+        return "read"
+    return None
+
+
+def table_lineage(sql: str) -> Lineage:
+    """SQLが読み書きするテーブルを集める
+
+    Args:
+        sql (str): クエリまたはスクリプト
+
+    Returns:
+        Lineage: 読み込むテーブルと書き込むテーブルのキー
+    """
+    lineage = Lineage()
+    # 文の中で最後に現れたCREATEやDROPなど
+    ddl: Optional[str] = None
+    parens: list[str] = []
+    previous = ""
+    for pos, ttype, value in _tokens(sql):
+        word = " ".join(value.upper().split())
+        end = pos + len(value)
+        if value == ";":
+            ddl, parens, previous = None, [], ""
+            continue
+        if value == "(":
+            parens.append(previous)
+        elif value == ")" and parens:
+            parens.pop()
+
+        access = _access(ttype, word, previous, ddl)
+        if ttype in T.Keyword.DDL:
+            ddl = word
+        elif access == "write":
+            _target(sql, end, lineage.writes, write=True)
+        elif access == "ddl":
+            m = _target(sql, end, lineage.writes, write=True)
+            source = SOURCE.match(sql, m.end()) if m is not None else None
+            if source is not None and table_key(source.group(1)) is not None:
+                lineage.reads.add(table_key(source.group(1)))
+            ddl = None
+        elif access == "read" and not (parens and parens[-1] in FROM_FUNCTIONS):
+            _target(sql, end, lineage.reads)
+        previous = word
+    return lineage
+
+
+def plan_lineage(plan: Plan) -> dict[int, Lineage]:
+    """実行計画の全クエリのノードについて読み書きするテーブルを集める
+
+    値ごとのタスクは全て展開するので, 推定した依存関係で実行するときはparallelismは効かない.
+
+    Returns:
+        dict[int, Lineage]: ノードのidをキーにしたLineage
+    """
+    by_template: dict[str, Lineage] = {}
+    lineages: dict[int, Lineage] = {}
+    for node in plan.expand_all().leaves():
+        if node.template_name not in by_template:
+            by_template[node.template_name] = table_lineage(plan.query(node).sql)
+        lineages[node.id] = by_template[node.template_name]
+    return lineages
+
+
+def _bits(ids) -> int:
+    bits = 0
+    for i in ids:
+        bits |= 1 << i
+    return bits
+
+
+def subtree_leaves(plan: Plan) -> list[int]:
+    """各ノードの配下にあるクエリのノードの集合をビット列で返す"""
+    leaves = [0] * len(plan)
+    # 子ノードは必ず親ノードより後に追加されている
+    for node in reversed(plan.nodes):
+        if plan.is_query(node):
+            leaves[node.id] = 1 << node.id
+        for child in node.children:
+            leaves[node.id] |= leaves[child]
+    return leaves
+
+
+def _sources(plan: Plan, lineages: dict[int, Lineage]) -> dict[int, set[int]]:
+    """各クエリのノードが読むテーブルを書き込む他のノード"""
+    writers: dict[str, set[int]] = {}
+    for node_id, lineage in lineages.items():
+        for table in lineage.writes:
+            writers.setdefault(table, set()).add(node_id)
+
+    sources: dict[int, set[int]] = {}
+    for node_id, lineage in lineages.items():
+        found: set[int] = set()
+        for read in lineage.reads:
+            for table in [t for t in writers if fnmatchcase(t, read)]:
+                found |= writers[table]
+        sources[node_id] = found - {node_id}
+    return sources
+
+
+def _event_graph(plan: Plan) -> list[list[int]]:
+    """ノードの開始と終了を頂点にしたグラフ. 頂点 2 * id が開始, 2 * id + 1 が終了"""
+    edges: list[list[int]] = [[] for _ in range(2 * len(plan))]
+    for node in plan:
+        if not node.children:
+            edges[2 * node.id].append(2 * node.id + 1)
+        for child in node.children:
+            edges[2 * node.id].append(2 * child)
+            edges[2 * child + 1].append(2 * node.id + 1)
+        for dep in node.dependencies:
+            edges[2 * dep + 1].append(2 * node.id)
+    return edges
+
+
+class _Waiting:
+    """読むテーブルを書き込むノードがまだ並んでいないクエリのノードを後回しにする"""
+
+    def __init__(self, sources: dict[int, set[int]]):
+        self.count = {node_id: len(found) for node_id, found in sources.items()}
+        self.readers: dict[int, list[int]] = {}
+        for node_id, found in sources.items():
+            for source in found:
+                self.readers.setdefault(source, []).append(node_id)
+        self.ready: deque[int] = deque()
+        self.blocked: dict[int, None] = {}
+
+    def __bool__(self):
+        return bool(self.ready or self.blocked)
+
+    def push(self, v: int):
+        if v % 2 == 0 and self.count.get(v // 2, 0) > 0:
+            self.blocked[v // 2] = None
+        else:
+            self.ready.append(v)
+
+    def pop(self) -> int:
+        if self.ready:
+            return self.ready.popleft()
+        node_id = next(iter(self.blocked))
+        del self.blocked[node_id]
+        return 2 * node_id
+
+    def placed(self, node_id: int):
+        for reader in self.readers.get(node_id, []):
+            self.count[reader] -= 1
+            if self.count[reader] == 0 and reader in self.blocked:
+                del self.blocked[reader]
+                self.ready.append(2 * reader)
+
+
+def declared_order(plan: Plan, lineages: dict[int, Lineage]) -> tuple[list[int], dict[int, int]]:
+    """yamlに書かれた依存関係に沿ってクエリのノードを一列に並べる
+
+    ノードの開始と終了を頂点にしたグラフをトポロジカルソートする.
+    依存関係で順序が決まらないノードは, 読むテーブルを書き込むノードを先に並べる.
+
+    Returns:
+        tuple[list[int], dict[int, int]]: 並べたクエリのノードのidと,
+            各クエリのノードより先に完了しているはずのクエリのノードの集合(ビット列)
+    """
+    edges = _event_graph(plan)
+    indegree = [0] * len(edges)
+    for targets in edges:
+        for v in targets:
+            indegree[v] += 1
+
+    waiting = _Waiting(_sources(plan, lineages))
+    order: list[int] = []
+    before = [0] * len(edges)
+    waiting.push(0)
+    while waiting:
+        v = waiting.pop()
+        node_id = v // 2
+        done = before[v]
+        if node_id in lineages:
+            if v % 2 == 0:
+                order.append(node_id)
+                waiting.placed(node_id)
+            else:
+                done |= 1 << node_id
+        for w in edges[v]:
+            before[w] |= done
+            indegree[w] -= 1
+            if indegree[w] == 0:
+                waiting.push(w)
+    return order, {node_id: before[2 * node_id] for node_id in order}
+
+
+def infer_dependencies(plan: Plan, lineages: dict[int, Lineage]) -> dict[int, set[int]]:
+    """テーブルの読み書きからクエリのノードの依存関係を推定する
+
+    yamlに書かれた順序で読み書きを並べ, 各テーブルについて
+    書き込みの後の読み込み, 書き込みの後の書き込み, 読み込みの後の書き込みを依存関係にする.
+
+    Args:
+        plan (Plan): 実行計画
+        lineages (dict[int, Lineage]): plan_lineageの結果
+
+    Returns:
+        dict[int, set[int]]: クエリのノードのidをキーにした, 先に完了が必要なノードのid
+    """
+    order, _ = declared_order(plan, lineages)
+    written = {t for lineage in lineages.values() for t in lineage.writes}
+    accesses: dict[str, list[tuple[int, bool]]] = {}
+    for node_id in order:
+        lineage = lineages[node_id]
+        for read in lineage.reads:
+            for table in [t for t in written if fnmatchcase(t, read)]:
+                accesses.setdefault(table, []).append((node_id, False))
+        for table in lineage.writes:
+            accesses.setdefault(table, []).append((node_id, True))
+
+    deps: dict[int, set[int]] = {node_id: set() for node_id in order}
+    for table, access in accesses.items():
+        writer: Optional[int] = None
+        readers: list[int] = []
+        for node_id, write in access:
+            if writer is not None:
+                deps[node_id].add(writer)
+            if write:
+                deps[node_id].update(readers)
+                writer, readers = node_id, []
+            else:
+                readers.append(node_id)
+    for node_id in deps:
+        deps[node_id].discard(node_id)
+    return deps
+
+
+def _name(node: PlanNode) -> str:
+    return "/".join(node.task_names)
+
+
+def _missing(
+    plan: Plan, lineages: dict[int, Lineage], deps: dict[int, set[int]], before: dict[int, int]
+) -> list[str]:
+    warnings = []
+    for node_id, found in deps.items():
+        for dep in sorted(found):
+            if not before[node_id] >> dep & 1:
+                tables = lineages[dep].writes & (lineages[node_id].reads | lineages[node_id].writes)
+                warnings.append(
+                    f"{_name(plan.nodes[node_id])}は{_name(plan.nodes[dep])}が書き込む"
+                    f"{sorted(tables)}を使いますが, 依存関係が書かれていません"
+                )
+    return warnings
+
+
+def _redundant(plan: Plan, order: list[int], deps: dict[int, set[int]]) -> list[str]:
+    # 推定した依存関係の推移閉包
+    closure: dict[int, int] = {}
+    for node_id in order:
+        closure[node_id] = 0
+        for dep in deps[node_id]:
+            closure[node_id] |= closure[dep] | 1 << dep
+    # 各ノードの配下のクエリが推定上依存するクエリ
+    upstream = [0] * len(plan)
+    for node in reversed(plan.nodes):
+        upstream[node.id] = closure.get(node.id, 0)
+        for child in node.children:
+            upstream[node.id] |= upstream[child]
+
+    warnings = []
+    leaves = subtree_leaves(plan)
+    for node in plan:
+        for dep in node.dependencies:
+            if leaves[dep] and not leaves[dep] & upstream[node.id]:
+                warnings.append(
+                    f"{_name(node)}の{_name(plan.nodes[dep])}への依存関係は"
+                    "テーブルの読み書きからは不要です"
+                )
+    return warnings
+
+
+def check_dependencies(plan: Plan, lineages: dict[int, Lineage]) -> list[str]:
+    """yamlに書かれた依存関係とテーブルの読み書きから推定した依存関係を比べる
+
+    Returns:
+        list[str]: 足りない依存関係と不要な依存関係の警告
+    """
+    order, before = declared_order(plan, lineages)
+    deps = infer_dependencies(plan, lineages)
+    warnings = _missing(plan, lineages, deps, before) + _redundant(plan, order, deps)
+    for node_id in order:
+        if not lineages[node_id].reads and not lineages[node_id].writes:
+            warnings.append(f"{_name(plan.nodes[node_id])}が読み書きするテーブルを検出できませんでした")
+    return warnings
+
+
+def inferred_plan(plan: Plan, lineages: dict[int, Lineage]) -> Plan:
+    """推定した依存関係だけでクエリのノードを並べたフラットな実行計画
+
+    クエリのノードは全てrootの子になり, task_namesは元の実行計画のものを引き継ぐ.
+    親のタスクやtemplateから受け継いだpoolとpriorityは解決してノードに持たせる.
+    """
+    order, _ = declared_order(plan, lineages)
+    deps = infer_dependencies(plan, lineages)
+    ids = {node_id: i + 1 for i, node_id in enumerate(order)}
+    root = PlanNode(
+        id=0,
+        template_name=plan.root.template_name,
+        task_names=[],
+        parameters=plan.root.parameters,
+        children=list(ids.values()),
+    )
+    nodes = [root]
+    for node_id in order:
+        node = plan.nodes[node_id]
+        pool, priority = plan.scheduling(node)
+        nodes.append(
+            PlanNode(
+                id=ids[node_id],
+                template_name=node.template_name,
+                task_names=node.task_names,
+                parameters=node.parameters,
+                parent=0,
+                dependencies=sorted(ids[dep] for dep in deps[node_id]),
+                pool=pool,
+                priority=priority,
+            )
+        )
+    for node in nodes:
+        for dep in node.dependencies:
+            nodes[dep].add_dependent(node.id)
+    return Plan(plan.wf, nodes=nodes)
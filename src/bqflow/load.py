@@ -1,11 +1,72 @@
+from logging import getLogger
 from pathlib import Path
+from typing import Optional
 
 import yaml
 
+from bqflow.cache import PlanCache, cache_dir
 from bqflow.fields import Workflow
+from bqflow.plan import Plan
 
+logger = getLogger(__name__)
 
-def read_workflow(path: Path):
+# libyamlがあればCで実装されたLoaderを使う
+Loader = getattr(yaml, "CFullLoader", yaml.FullLoader)
+
+
+def read_workflow(path: Path, base: Optional[Path] = None):
+    """yamlを読み込む
+
+    Args:
+        path (Path): ワークフローのyaml
+        base (Optional[Path]): scriptとoutputの相対パスを解決するディレクトリ. 省略すると作業ディレクトリ
+    """
     with open(path, "r") as f:
-        data = yaml.load(f, Loader=yaml.FullLoader)
-    return Workflow.parse_obj(data)
+        data = yaml.load(f, Loader=Loader)
+    wf = Workflow.parse_obj(data)
+    if base is not None:
+        for temp in wf.templates:
+            if temp.script is not None:
+                temp.script = base / temp.script
+            if temp.output is not None:
+                temp.output = base / temp.output
+    return wf
+
+
+def load_plan(
+    path: Path,
+    entrypoint: Optional[str] = None,
+    use_cache: bool = True,
+    base: Optional[Path] = None,
+) -> Plan:
+    """yamlを読み込み, SQLとパラメータを解決した実行計画を返す
+
+    yamlと参照するscriptのファイルが前回から変わっていなければキャッシュを使う.
+
+    Args:
+        path (Path): ワークフローのyaml
+        entrypoint (Optional[str]): entrypointの上書き
+        use_cache (bool): キャッシュを読み書きするか
+        base (Optional[Path]): scriptとoutputの相対パスを解決するディレクトリ
+
+    Returns:
+        Plan: コンパイル済みの実行計画
+    """
+    cache = PlanCache(cache_dir())
+    # キャッシュのキーは作業ディレクトリで区別するので, 別のディレクトリから解決するときは使わない
+    use_cache = use_cache and base is None
+    if use_cache:
+        plan = cache.get(path, entrypoint)
+        if plan is not None:
+            return plan
+
+    wf = read_workflow(path, base=base)
+    if entrypoint is not None:
+        wf.entrypoint = entrypoint
+    plan = Plan(wf).compile()
+    if use_cache:
+        try:
+            cache.put(path, plan, entrypoint)
+        except OSError as e:
+            logger.warning(f"実行計画のキャッシュを保存できませんでした: {e}")
+    return plan
@@ -1,31 +1,195 @@
-import json
+"""bqflowのCLI
+
+`bqflow --help`や`bqflow validate`を速く起動できるように,
+abqやgoogle-cloud-bigqueryなどの重いモジュールは使うコマンドの中で読み込む.
+"""
+
+from __future__ import annotations
+
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 import click
-from abq import QueryException
 
-from bqflow import env
-from bqflow.client import Client
-from bqflow.fields import Workflow
-from bqflow.load import read_workflow
-from bqflow.procon import ProCon
+from bqflow._helper import parse_size
+from bqflow.options import (
+    FAILURE_POLICIES,
+    LINEAGE_MODES,
+    TRACE_FORMATS,
+    FailurePolicy,
+    LineageMode,
+    TraceFormat,
+)
+
+if TYPE_CHECKING:
+    from bqflow.fields import RetryStrategy, Workflow
+    from bqflow.journal import Journal
+    from bqflow.limiter import ConcurrencyLimiter, Pools
+    from bqflow.plan import Plan
+    from bqflow.report import TaskReport
+    from bqflow.state import StateStore
 
 logging.basicConfig(level=logging.CRITICAL)
 
 
-@click.command()
+class DefaultGroup(click.Group):
+    """サブコマンドを省略するとdefaultのコマンドを実行するGroup
+
+    `bqflow FILE`を`bqflow run FILE`として扱う.
+    """
+
+    def __init__(self, *args, default: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default = default
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args.insert(0, self.default)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, default="run")
+def cmd():
+    """BigQueryのクエリとワークフローを実行する"""
+
+
+@cmd.command("validate")
+@click.argument("file_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--entrypoint", help="entrypoint上書き")
+@click.option("--lineage", is_flag=True, help="テーブルの読み書きから推定した依存関係との過不足も表示する")
+@click.option("--no-cache", is_flag=True, help="コンパイル済みの実行計画のキャッシュを使わない")
+def validate_cmd(file_path: str, entrypoint: Optional[str], lineage: bool, no_cache: bool):
+    """ワークフローのyamlを実行せずに検証する. Google Cloudの認証情報は使わない"""
+    plan, errors = validate_workflow(Path(file_path), entrypoint=entrypoint, use_cache=not no_cache)
+    for error in errors:
+        print(error)
+    if errors:
+        return exit(1)
+    if lineage:
+        check_lineage(plan)
+    print("OK")
+
+
+@cmd.command("run")
 @click.argument("file_path")
 @click.option("--project", "-P", help="プロジェクトID")
-@click.option("--output", "-o", help="アウトプットパス")
+@click.option("--output", "-o", help="アウトプットパス. 拡張子で形式を決める(json, ndjson, csv, parquet)")
+@click.option("--print/--no-print", "echo", default=True, help="-oで出力する結果を標準出力にも表示する")
 @click.option("--entrypoint", help="entrypoint上書き")
-def cmd(
+@click.option("--incremental", is_flag=True, help="前回成功時から変更のないタスクをスキップ")
+@click.option("--resume", "run_id", help="指定したrun idの実行を完了済みのタスクから再開")
+@click.option(
+    "--on-failure",
+    type=click.Choice(FAILURE_POLICIES),
+    default="fail-fast",
+    show_default=True,
+    help="タスクが失敗したときの挙動",
+)
+@click.option("--dry-run", is_flag=True, help="実行せずに全クエリのスキャン量を見積もる")
+@click.option("--max-bytes-billed", help="スキャン量の上限. 例: 500GB")
+@click.option(
+    "--concurrency",
+    default="10",
+    show_default=True,
+    help="ジョブの同時実行数. autoを指定すると混雑具合に応じて調整する",
+)
+@click.option(
+    "--max-concurrency",
+    type=int,
+    default=50,
+    show_default=True,
+    help="--concurrency autoのときの同時実行数の上限",
+)
+@click.option(
+    "--lineage",
+    type=click.Choice(LINEAGE_MODES),
+    help="SQLが読み書きするテーブルから依存関係を推定する. "
+    "warnは書かれた依存関係の過不足を表示し, scheduleは推定した依存関係で実行する",
+)
+@click.option(
+    "--batch",
+    "batch_size",
+    type=int,
+    default=1,
+    show_default=True,
+    help="batchableなタスクを最大この数まで1つのスクリプトにまとめて実行する",
+)
+@click.option("--no-cache", is_flag=True, help="コンパイル済みの実行計画のキャッシュを使わない")
+@click.option("--dedup", is_flag=True, help="SQLとパラメータの値が同じクエリは1回だけ実行し, 結果を共有する")
+@click.option("--trace", "trace_path", help="タスクごとの待ち時間と実行時間のタイムラインを書き出すパス")
+@click.option(
+    "--trace-format",
+    type=click.Choice(TRACE_FORMATS),
+    default="chrome",
+    show_default=True,
+    help="--traceの形式. chromeはchrome://tracingやPerfetto, otlpはOpenTelemetryのOTLP/JSON",
+)
+@click.option(
+    "--timeout",
+    type=float,
+    help="ジョブの完了を待つ秒数. 過ぎたらジョブをキャンセルする. templateのtimeoutが優先される",
+)
+@click.option(
+    "--retries",
+    type=int,
+    default=0,
+    show_default=True,
+    help="一時的なエラーとtimeoutで失敗したタスクを再実行する回数. templateのretryStrategyが優先される",
+)
+@click.option(
+    "--retry-backoff",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="最初の再実行までに待つ秒数. 再実行のたびに2倍にする",
+)
+@click.option(
+    "--queue",
+    "queue_path",
+    help="タスクをこのSQLiteファイルの共有キューに積み, bqflow workerのプロセスに実行させる",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="実行後もyamlとscriptのファイルを監視し, 変更されたタスクと下流のタスクだけを再実行する",
+)
+@click.option(
+    "--watch-interval",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="--watchでファイルの変更を確認する間隔の秒数",
+)
+def run_cmd(
     file_path: str,
     project: Optional[str],
     output: Optional[str],
+    echo: bool,
     entrypoint: Optional[str],
+    incremental: bool,
+    run_id: Optional[str],
+    on_failure: FailurePolicy,
+    dry_run: bool,
+    max_bytes_billed: Optional[str],
+    concurrency: str,
+    max_concurrency: int,
+    lineage: Optional[LineageMode],
+    batch_size: int,
+    no_cache: bool,
+    dedup: bool,
+    trace_path: Optional[str],
+    trace_format: TraceFormat,
+    timeout: Optional[float],
+    retries: int,
+    retry_backoff: float,
+    queue_path: Optional[str],
+    watch: bool,
+    watch_interval: float,
 ):
+    """クエリ(.sql)またはワークフロー(.yml, .yaml)を実行する"""
+    from abq import QueryException
+
     path = Path(file_path)
     if not path.exists():
         raise FileNotFoundError(f"{file_path}は存在しません")
@@ -35,31 +199,606 @@ def cmd(
     if project is None:
         raise RuntimeError("credentialからproject_idが見つかりませんでした. -Pオプションで指定してください")
 
+    check_run_options(
+        path,
+        queue=queue_path is not None,
+        watch=watch,
+        incremental=incremental,
+        batch=batch_size > 1,
+        dedup=dedup,
+        resume=run_id is not None,
+        dry_run=dry_run,
+        lineage=lineage is not None,
+    )
+    maximum_bytes_billed = parse_size(max_bytes_billed) if max_bytes_billed is not None else None
+    limiter = make_limiter(concurrency, max_concurrency)
+
     if path.suffix == ".sql":
         try:
-            run_query(path, project_id=project, output=output)
+            run_query(
+                path,
+                project_id=project,
+                output=output,
+                dry_run=dry_run,
+                maximum_bytes_billed=maximum_bytes_billed,
+                echo=echo,
+            )
         except QueryException as e:
             print(e)
             return exit(1)
+    elif watch:
+        watch_workflow(
+            path,
+            project,
+            entrypoint=entrypoint,
+            interval=watch_interval,
+            incremental=incremental,
+            failure_policy=on_failure,
+            maximum_bytes_billed=maximum_bytes_billed,
+            limiter=limiter,
+            batch_size=batch_size,
+            use_cache=not no_cache,
+            dedup=dedup,
+            trace_path=Path(trace_path) if trace_path is not None else None,
+            trace_format=trace_format,
+            timeout=timeout,
+            retry=make_retry(retries, retry_backoff),
+        )
     elif path.suffix in [".yml", ".yaml"]:
-        wf = read_workflow(path)
-        if entrypoint is not None:
-            wf.entrypoint = entrypoint
-        execute_workflow(wf, project)
+        ok = run_workflow(
+            path,
+            project,
+            entrypoint=entrypoint,
+            incremental=incremental,
+            run_id=run_id,
+            failure_policy=on_failure,
+            dry_run=dry_run,
+            maximum_bytes_billed=maximum_bytes_billed,
+            limiter=limiter,
+            lineage=lineage,
+            batch_size=batch_size,
+            use_cache=not no_cache,
+            dedup=dedup,
+            trace_path=Path(trace_path) if trace_path is not None else None,
+            trace_format=trace_format,
+            timeout=timeout,
+            retry=make_retry(retries, retry_backoff),
+            queue_path=Path(queue_path) if queue_path is not None else None,
+        )
+        if not ok:
+            return exit(1)
+
+
+@cmd.command("submit")
+@click.argument("file_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--spool", "spool_dir", help="bqflow serveのスプールのディレクトリ. 既定は~/.bqflow/spool")
+@click.option("--project", "-P", help="プロジェクトID. 省略するとbqflow serveのプロジェクトID")
+@click.option("--entrypoint", help="entrypoint上書き")
+@click.option("--concurrency", type=int, help="このワークフローが同時に使う実行枠の上限")
+@click.option("--incremental", is_flag=True, help="前回成功時から変更のないタスクをスキップ")
+@click.option(
+    "--on-failure",
+    type=click.Choice(FAILURE_POLICIES),
+    default="fail-fast",
+    show_default=True,
+    help="タスクが失敗したときの挙動",
+)
+@click.option("--wait", is_flag=True, help="実行が終わるまで待ち, 失敗したら終了コードを1にする")
+def submit_cmd(
+    file_path: str,
+    spool_dir: Optional[str],
+    project: Optional[str],
+    entrypoint: Optional[str],
+    concurrency: Optional[int],
+    incremental: bool,
+    on_failure: FailurePolicy,
+    wait: bool,
+):
+    """ワークフローの実行をbqflow serveに依頼する"""
+    from bqflow.spool import Spool, Submission, default_spool_dir
+
+    if concurrency is not None and concurrency < 1:
+        raise click.BadParameter(f"1以上の整数を指定してください: {concurrency}")
+    spool = Spool(Path(spool_dir) if spool_dir is not None else default_spool_dir())
+    submission = Submission.create(
+        Path(file_path),
+        project=project,
+        entrypoint=entrypoint,
+        concurrency=concurrency,
+        incremental=incremental,
+        failure_policy=on_failure,
+    )
+    spool.submit(submission)
+    print("submission id:", submission.id)
+    if not wait:
+        return
+    result = spool.wait(submission.id)
+    print("run id:", result.run_id)
+    if result.error is not None:
+        print(result.error)
+    if not result.ok:
+        return exit(1)
+
+
+@cmd.command("serve")
+@click.option("--spool", "spool_dir", help="依頼を受け取るスプールのディレクトリ. 既定は~/.bqflow/spool")
+@click.option("--project", "-P", help="依頼にプロジェクトIDがないときのプロジェクトID")
+@click.option(
+    "--concurrency",
+    type=int,
+    default=10,
+    show_default=True,
+    help="全てのワークフローで共有するジョブの同時実行数",
+)
+@click.option("--poll-interval", type=float, default=1.0, show_default=True, help="スプールを確認する秒数")
+@click.option("--once", is_flag=True, help="スプールの依頼を全て実行したら終了する")
+def serve_cmd(
+    spool_dir: Optional[str],
+    project: Optional[str],
+    concurrency: int,
+    poll_interval: float,
+    once: bool,
+):
+    """bqflow submitで依頼されたワークフローを共有する実行枠で実行し続ける"""
+    from bqflow.serve import Server
+    from bqflow.session import run
+    from bqflow.spool import Spool, default_spool_dir
+
+    if concurrency < 1:
+        raise click.BadParameter(f"1以上の整数を指定してください: {concurrency}")
+    if project is None:
+        project = read_project_id_from_credential()
+    spool = Spool(Path(spool_dir) if spool_dir is not None else default_spool_dir())
+    print("spool:", spool.directory)
+    server = Server(spool, concurrency, project=project, poll_interval=poll_interval)
+    try:
+        run(server.serve(once=once))
+    except KeyboardInterrupt:
+        # 実行中だった依頼は次に起動したときに再開する
+        pass
+
+
+@cmd.command("worker")
+@click.option("--queue", "queue_path", required=True, help="タスクを取り出す共有キューのSQLiteファイル")
+@click.option(
+    "--concurrency",
+    type=int,
+    default=10,
+    show_default=True,
+    help="このworkerが同時に実行するジョブの数",
+)
+@click.option(
+    "--lease",
+    type=float,
+    default=30.0,
+    show_default=True,
+    help="タスクのリースの秒数. workerが落ちるとこの秒数の後に他のworkerが取り直す",
+)
+@click.option("--exit-when-idle", is_flag=True, help="実行中のワークフローがなくなったら終了する")
+def worker_cmd(queue_path: str, concurrency: int, lease: float, exit_when_idle: bool):
+    """bqflow run --queueで積まれたタスクを取り出して実行する"""
+    from bqflow.distributed import Worker
+    from bqflow.session import run
+    from bqflow.sharedqueue import SharedQueue
+
+    if concurrency < 1:
+        raise click.BadParameter(f"1以上の整数を指定してください: {concurrency}")
+    worker = Worker(SharedQueue(Path(queue_path)), concurrency=concurrency, lease=lease)
+    print("worker id:", worker.worker_id)
+    try:
+        run(worker.run(exit_when_idle=exit_when_idle))
+    except KeyboardInterrupt:
+        pass
+    print("executed:", worker.executed)
+
+
+def check_run_options(
+    path: Path,
+    queue: bool,
+    watch: bool,
+    incremental: bool,
+    batch: bool,
+    dedup: bool,
+    resume: bool,
+    dry_run: bool,
+    lineage: bool,
+):
+    """一緒に使えないオプションが指定されていないか確かめる"""
+    if queue and (incremental or batch or dedup):
+        raise click.BadParameter("--queueは--incremental, --batch, --dedupと一緒に使えません")
+    workflow = path.suffix in [".yml", ".yaml"]
+    if watch and (not workflow or queue or resume or dry_run or lineage):
+        raise click.BadParameter(
+            "--watchはワークフローにだけ使え, --queue, --resume, --dry-run, --lineageと一緒に使えません"
+        )
 
 
 def read_project_id_from_credential():
-    with open(env.GOOGLE_APPLICATION_CREDENTIALS, "r") as f:
-        dic = json.load(f)
-        return dic.get("project_id")
+    from bqflow import read_credential
+
+    return read_credential().get("project_id")
+
 
+def open_journal(path: Path, wf: Workflow, run_id: Optional[str]) -> Journal:
+    from bqflow.journal import Journal, journal_dir
+
+    if run_id is None:
+        return Journal.create(journal_dir(path), workflow=path, entrypoint=wf.entrypoint)
+
+    journal = Journal.open(journal_dir(path), run_id)
+    header = journal.header()
+    if header is not None and header.get("entrypoint") != wf.entrypoint:
+        raise RuntimeError(
+            f"run id {run_id}のentrypoint({header.get('entrypoint')})と"
+            f"指定されたentrypoint({wf.entrypoint})が異なります"
+        )
+    return journal
+
+
+def run_query(
+    path: Path,
+    project_id: Optional[str],
+    output: Optional[str],
+    dry_run: bool = False,
+    maximum_bytes_billed: Optional[int] = None,
+    echo: bool = True,
+):
+    from bqflow.client import Client
 
-def run_query(path: Path, project_id: Optional[str], output: Optional[str]):
     client = Client(project_id)
-    client.execute_query(Path(path), output=Path(output))
+    client.execute_query(
+        Path(path),
+        output=Path(output) if output is not None else None,
+        dry_run=dry_run,
+        maximum_bytes_billed=maximum_bytes_billed,
+        echo=echo,
+    )
+
+
+def run_workflow(
+    path: Path,
+    project: str,
+    entrypoint: Optional[str] = None,
+    incremental: bool = False,
+    run_id: Optional[str] = None,
+    failure_policy: FailurePolicy = "fail-fast",
+    dry_run: bool = False,
+    maximum_bytes_billed: Optional[int] = None,
+    limiter: Optional[ConcurrencyLimiter] = None,
+    lineage: Optional[LineageMode] = None,
+    batch_size: int = 1,
+    use_cache: bool = True,
+    dedup: bool = False,
+    trace_path: Optional[Path] = None,
+    trace_format: TraceFormat = "chrome",
+    timeout: Optional[float] = None,
+    retry: Optional[RetryStrategy] = None,
+    queue_path: Optional[Path] = None,
+) -> bool:
+    from abq import QueryException
+
+    from bqflow.client import Client
+    from bqflow.load import load_plan
+    from bqflow.state import open_state
+
+    plan = load_plan(path, entrypoint=entrypoint, use_cache=use_cache)
+    wf = plan.wf
+    if lineage is not None:
+        plan = check_lineage(plan, schedule=lineage == "schedule")
+
+    estimates = None
+    if dry_run or maximum_bytes_billed is not None:
+        try:
+            results = Client(project).estimate_workflow(
+                plan, maximum_bytes_billed=maximum_bytes_billed
+            )
+        except QueryException as e:
+            print(e)
+            return False
+        if dry_run:
+            return True
+        estimates = {
+            tuple(e.name): e.total_bytes_processed
+            for e in results
+            if e.total_bytes_processed is not None
+        }
+
+    if queue_path is not None:
+        return distribute_workflow(
+            plan,
+            project,
+            queue_path,
+            run_id=run_id,
+            failure_policy=failure_policy,
+            estimates=estimates,
+            trace_path=trace_path,
+            trace_format=trace_format,
+            timeout=timeout,
+            retry=retry,
+            maximum_bytes_billed=maximum_bytes_billed,
+        )
+
+    state = open_state(path, incremental)
+    journal = open_journal(path, wf, run_id)
+    print("run id:", journal.run_id)
+    try:
+        ok = execute_workflow(
+            wf,
+            project,
+            state=state,
+            incremental=incremental,
+            estimates=estimates,
+            journal=journal,
+            failure_policy=failure_policy,
+            maximum_bytes_billed=maximum_bytes_billed,
+            limiter=limiter,
+            plan=plan,
+            batch_size=batch_size,
+            dedup=dedup,
+            trace_path=trace_path,
+            trace_format=trace_format,
+            timeout=timeout,
+            retry=retry,
+        )
+    finally:
+        if state is not None:
+            state.close()
+    if ok:
+        journal.remove()
+    return ok
+
+
+def check_lineage(plan: Plan, schedule: bool = False) -> Plan:
+    """テーブルの読み書きから推定した依存関係との過不足を表示する
+
+    Args:
+        plan (Plan): yamlに書かれた依存関係の実行計画
+        schedule (bool): Trueなら推定した依存関係の実行計画を返す
+
+    Returns:
+        Plan: 実行する実行計画
+    """
+    from bqflow.lineage import check_dependencies, inferred_plan, plan_lineage
+
+    lineages = plan_lineage(plan)
+    for warning in check_dependencies(plan, lineages):
+        print("lineage:", warning)
+    if schedule:
+        return inferred_plan(plan, lineages)
+    return plan
+
+
+def make_limiter(concurrency: str, max_concurrency: int) -> ConcurrencyLimiter:
+    from bqflow.limiter import AIMDLimiter, ConcurrencyLimiter
+
+    if concurrency == "auto":
+        return AIMDLimiter(maximum=max_concurrency)
+    if not concurrency.isdigit() or int(concurrency) < 1:
+        raise click.BadParameter(f"1以上の整数かautoを指定してください: {concurrency}")
+    return ConcurrencyLimiter(int(concurrency))
+
+
+def make_retry(retries: int, retry_backoff: float) -> RetryStrategy:
+    from pydantic import ValidationError
+
+    from bqflow.fields import Backoff, RetryStrategy
+
+    try:
+        return RetryStrategy(limit=retries, backoff=Backoff(duration=retry_backoff))
+    except ValidationError as e:
+        raise click.BadParameter(str(e))
 
 
-def execute_workflow(wf: Workflow, project: str):
-    procon = ProCon(wf=wf, project_name=project, max_size=10)
+def execute_workflow(
+    wf: Workflow,
+    project: str,
+    state: Optional[StateStore] = None,
+    incremental: bool = False,
+    estimates: Optional[dict[tuple[str, ...], int]] = None,
+    journal: Optional[Journal] = None,
+    failure_policy: FailurePolicy = "fail-fast",
+    maximum_bytes_billed: Optional[int] = None,
+    limiter: Optional[ConcurrencyLimiter] = None,
+    plan: Optional[Plan] = None,
+    batch_size: int = 1,
+    dedup: bool = False,
+    trace_path: Optional[Path] = None,
+    trace_format: TraceFormat = "chrome",
+    timeout: Optional[float] = None,
+    retry: Optional[RetryStrategy] = None,
+) -> bool:
+    from bqflow.limiter import ConcurrencyLimiter
+    from bqflow.procon import ProCon
+
+    if limiter is None:
+        limiter = ConcurrencyLimiter(10)
+    procon = ProCon(
+        wf=wf,
+        project_name=project,
+        state=state,
+        incremental=incremental,
+        journal=journal,
+        failure_policy=failure_policy,
+        maximum_bytes_billed=maximum_bytes_billed,
+        limiter=limiter,
+        estimates=estimates,
+        plan=plan,
+        batch_size=batch_size,
+        dedup=dedup,
+        timeout=timeout,
+        retry=retry,
+    )
     reports = procon.run()
+    print_reports(
+        reports,
+        limiter,
+        pools=procon.pools,
+        dedup=dedup,
+        trace_path=trace_path,
+        trace_format=trace_format,
+    )
+    return all(r.state in ["done", "cached"] for r in reports)
+
+
+def print_reports(
+    reports: list[TaskReport],
+    limiter: ConcurrencyLimiter,
+    pools: Optional[Pools] = None,
+    dedup: bool = False,
+    trace_path: Optional[Path] = None,
+    trace_format: TraceFormat = "chrome",
+):
+    from bqflow.report import summarize, summarize_dedup, summarize_retries
+    from bqflow.session import default_session
+
+    print(reports)
+    if trace_path is not None:
+        from bqflow.trace import write_trace
+
+        write_trace(trace_path, reports, trace_format)
+        print("trace:", trace_path)
+    print("concurrency:", limiter.describe())
+    if pools is not None:
+        print("pools:", pools.describe())
+    print("api:", default_session().describe())
+    if dedup:
+        print(summarize_dedup(reports))
+    if any(r.retries for r in reports):
+        print(summarize_retries(reports))
+    summary = summarize(reports)
+    if summary:
+        print(summary)
+
+
+def watch_workflow(
+    path: Path,
+    project: str,
+    entrypoint: Optional[str] = None,
+    interval: float = 1.0,
+    incremental: bool = False,
+    failure_policy: FailurePolicy = "fail-fast",
+    maximum_bytes_billed: Optional[int] = None,
+    limiter: Optional[ConcurrencyLimiter] = None,
+    batch_size: int = 1,
+    use_cache: bool = True,
+    dedup: bool = False,
+    trace_path: Optional[Path] = None,
+    trace_format: TraceFormat = "chrome",
+    timeout: Optional[float] = None,
+    retry: Optional[RetryStrategy] = None,
+):
+    """ワークフローを実行し, ファイルが変わるたびに影響を受けるタスクだけを再実行し続ける"""
+    from bqflow.limiter import ConcurrencyLimiter
+    from bqflow.procon import ProCon
+    from bqflow.state import open_state
+    from bqflow.watch import Watcher
+
+    if limiter is None:
+        limiter = ConcurrencyLimiter(10)
+    state = open_state(path, incremental)
+
+    def run(plan: Plan, completed: list[list[str]]) -> list[TaskReport]:
+        procon = ProCon(
+            wf=plan.wf,
+            project_name=project,
+            state=state,
+            incremental=incremental,
+            failure_policy=failure_policy,
+            maximum_bytes_billed=maximum_bytes_billed,
+            limiter=limiter,
+            plan=plan,
+            batch_size=batch_size,
+            dedup=dedup,
+            timeout=timeout,
+            retry=retry,
+            completed=completed,
+        )
+        reports = procon.run()
+        # traceは最後の実行で上書きする
+        print_reports(
+            reports,
+            limiter,
+            pools=procon.pools,
+            dedup=dedup,
+            trace_path=trace_path,
+            trace_format=trace_format,
+        )
+        print(f"{path}の変更を待っています. 終了するにはCtrl+C")
+        return reports
+
+    watcher = Watcher(path, run, entrypoint=entrypoint, interval=interval, use_cache=use_cache)
+    try:
+        watcher.watch()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if state is not None:
+            state.close()
+
+
+def distribute_workflow(
+    plan: Plan,
+    project: str,
+    queue_path: Path,
+    run_id: Optional[str] = None,
+    failure_policy: FailurePolicy = "fail-fast",
+    estimates: Optional[dict[tuple[str, ...], int]] = None,
+    trace_path: Optional[Path] = None,
+    trace_format: TraceFormat = "chrome",
+    timeout: Optional[float] = None,
+    retry: Optional[RetryStrategy] = None,
+    maximum_bytes_billed: Optional[int] = None,
+) -> bool:
+    """ワークフローのタスクを共有キューに積み, bqflow workerに実行させる"""
+    from bqflow.distributed import Coordinator
+    from bqflow.report import summarize
+    from bqflow.sharedqueue import SharedQueue
+
+    queue = SharedQueue(queue_path)
+    coordinator = Coordinator(
+        plan.wf,
+        project,
+        queue,
+        run_id=run_id,
+        failure_policy=failure_policy,
+        plan=plan,
+        estimates=estimates,
+        timeout=timeout,
+        retry=retry,
+        maximum_bytes_billed=maximum_bytes_billed,
+    )
+    print("run id:", coordinator.start())
+    reports = coordinator.wait()
+    queue.close()
     print(reports)
+    if trace_path is not None:
+        from bqflow.trace import write_trace
+
+        write_trace(trace_path, reports, trace_format)
+        print("trace:", trace_path)
+    summary = summarize(reports)
+    if summary:
+        print(summary)
+    return all(r.state in ["done", "cached"] for r in reports)
+
+
+def validate_workflow(
+    path: Path, entrypoint: Optional[str] = None, use_cache: bool = True
+) -> tuple[Optional[Plan], list[str]]:
+    """ワークフローを実行計画に展開し, 全てのクエリを解決できるか確かめる
+
+    Returns:
+        tuple[Optional[Plan], list[str]]: 実行計画とエラー. エラーがあれば実行計画はNone
+    """
+    import yaml
+
+    from bqflow.load import load_plan
+    from bqflow.state import compute_fingerprints
+
+    try:
+        plan = load_plan(path, entrypoint=entrypoint, use_cache=use_cache)
+        # dependenciesの循環を検出する
+        compute_fingerprints(plan)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        return None, [str(e)]
+    return plan, []
@@ -0,0 +1,143 @@
+"""実行中のジョブの状態をまとめて監視する
+
+ジョブごとにwait()でポーリングする代わりに, 監視中の全ジョブをひとつのループで確認する.
+確認する間隔はジョブが作られてからの経過時間に応じて伸ばし,
+確認するジョブが複数あるときは完了したジョブの一覧をまとめて取得する.
+"""
+
+import asyncio
+import time
+from logging import getLogger
+from typing import Optional
+
+from abq import BQ
+from abq.bq import JobResult
+from abq.job import Job
+
+logger = getLogger(__name__)
+
+
+class Watch:
+    def __init__(self, job: JobResult, future: "asyncio.Future[dict]", first_poll: float):
+        self.job = job
+        self.future = future
+        self.created_at = time.monotonic()
+        self.next_poll = self.created_at + first_poll
+
+
+class JobMonitor:
+    def __init__(self, bq: BQ, min_interval: float = 0.5, max_interval: float = 10.0):
+        self.bq = bq
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.watches: dict[str, Watch] = {}
+        self.polls = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopped = False
+
+    def watch(self, job: JobResult) -> "asyncio.Future[dict]":
+        """ジョブを監視対象に加える
+
+        Returns:
+            asyncio.Future[dict]: ジョブが完了したときにジョブのjsonで解決される
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.watches[job.job_id] = Watch(job, future, self.min_interval)
+        self._wake()
+        return future
+
+    def forget(self, job: JobResult):
+        """ジョブを監視対象から外す. 完了を待たずに見切ったジョブに使う"""
+        watch = self.watches.pop(job.job_id, None)
+        if watch is not None:
+            watch.future.cancel()
+
+    def stop(self):
+        self._stopped = True
+        self._wake()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def interval(self, watch: Watch, now: float) -> float:
+        """ジョブの経過時間の1割を次の確認までの間隔にする"""
+        age = now - watch.created_at
+        return min(self.max_interval, max(self.min_interval, age * 0.1))
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while not self._stopped:
+            now = time.monotonic()
+            due = [w for w in self.watches.values() if w.next_poll <= now]
+            if due:
+                await self.poll(due)
+                continue
+
+            self._wakeup.clear()
+            timeout = None
+            if self.watches:
+                timeout = min(w.next_poll for w in self.watches.values()) - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll(self, due: list[Watch]):
+        try:
+            done = await self._done_jobs(due)
+        except Exception as e:
+            logger.warning(f"ジョブの状態を取得できませんでした: {e}")
+            done = {}
+
+        now = time.monotonic()
+        for watch in due:
+            if watch.job.job_id in done:
+                await self._resolve(watch, done[watch.job.job_id])
+            else:
+                watch.next_poll = now + self.interval(watch, now)
+
+    async def _done_jobs(self, due: list[Watch]) -> dict[str, Optional[dict]]:
+        """完了したジョブを返す
+
+        Returns:
+            dict[str, Optional[dict]]: 完了したジョブのidとジョブのjson.
+                一覧から見つけたジョブは詳細を持たないのでNoneになる
+        """
+        self.polls += 1
+        if len(due) == 1:
+            job = due[0].job
+            json = await self.bq.get_job(job.job_id, projectId=job.project_id)
+            return {job.job_id: json} if json["status"]["state"] == "DONE" else {}
+
+        # 監視中の最も古いジョブ以降に完了したジョブをまとめて取得する
+        oldest = min(time.time() - (time.monotonic() - w.created_at) for w in due)
+        json = await self.bq.get_job_list(
+            stateFilter="done", projection="minimal", minCreationTime=int(oldest * 1000) - 60000
+        )
+        done: dict[str, Optional[dict]] = {
+            j["jobReference"]["jobId"]: None for j in json.get("jobs", [])
+        }
+        if "nextPageToken" in json:
+            # 一覧に収まらなかったジョブは個別に確認する
+            for watch in due:
+                if watch.job.job_id not in done:
+                    done.update(await self._done_jobs([watch]))
+        return done
+
+    async def _resolve(self, watch: Watch, json: Optional[dict]):
+        if self.watches.pop(watch.job.job_id, None) is None:
+            # 確認している間に監視対象から外された
+            return
+        try:
+            if json is None:
+                json = await self.bq.get_job(watch.job.job_id, projectId=watch.job.project_id)
+        except Exception as e:
+            if not watch.future.done():
+                watch.future.set_exception(e)
+            return
+        if watch.future.done():
+            return
+        watch.job.state = json["status"]["state"]
+        watch.job.info = Job(**json)
+        watch.future.set_result(json)
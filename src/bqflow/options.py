@@ -0,0 +1,22 @@
+"""CLIのオプションで選べる値
+
+CLIを組み立てるだけで重いモジュールを読み込まないように, 選択肢はここにまとめる.
+"""
+
+from typing import Literal
+
+# fail-fast: 実行中のジョブをキャンセルし, 新しいタスクを実行しない
+# continue-independent-branches: 失敗したタスクに依存しないタスクは実行を続ける
+# wait-running: 実行中のジョブの完了を待ち, 新しいタスクを実行しない
+FailurePolicy = Literal["fail-fast", "continue-independent-branches", "wait-running"]
+FAILURE_POLICIES = ["fail-fast", "continue-independent-branches", "wait-running"]
+
+# warn: 書かれた依存関係の過不足を表示する
+# schedule: 推定した依存関係で実行する
+LineageMode = Literal["warn", "schedule"]
+LINEAGE_MODES = ["warn", "schedule"]
+
+# chrome: chrome://tracingやPerfettoで開けるTrace Event形式
+# otlp: OpenTelemetryのOTLP/JSON形式のスパン
+TraceFormat = Literal["chrome", "otlp"]
+TRACE_FORMATS = ["chrome", "otlp"]
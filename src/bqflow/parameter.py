@@ -1,13 +1,27 @@
-from typing import Union
+from __future__ import annotations
 
-from google.cloud.bigquery import ArrayQueryParameter, ScalarQueryParameter, StructQueryParameter
+from typing import TYPE_CHECKING, Union
 
 from bqflow.fields import Parameter
 
-BQParameter = Union[ArrayQueryParameter, ScalarQueryParameter, StructQueryParameter]
+if TYPE_CHECKING:
+    from google.cloud.bigquery import (
+        ArrayQueryParameter,
+        ScalarQueryParameter,
+        StructQueryParameter,
+    )
+
+    BQParameter = Union[ArrayQueryParameter, ScalarQueryParameter, StructQueryParameter]
 
 
 def parse_param(param: Parameter) -> BQParameter:
+    # google-cloud-bigqueryは読み込みが重いので, クエリを実行するときまで読み込まない
+    from google.cloud.bigquery import (
+        ArrayQueryParameter,
+        ScalarQueryParameter,
+        StructQueryParameter,
+    )
+
     value = param.value
     if isinstance(value, list):
         if param.type == "STRUCT":
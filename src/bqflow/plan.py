@@ -0,0 +1,488 @@
+"""Workflowを一度だけ展開した実行計画
+
+stepsとdagを全てdagとして扱い, entrypointから辿れる全タスクを
+親子関係と依存関係の隣接リストを持つフラットなノード列に変換する.
+withItems, withParam, withRangeのタスクは値ごとのタスクを持つノードになり,
+値ごとのタスクは実行するときに1つずつ展開する.
+"""
+
+import copy
+import sys
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+from pydantic import BaseModel
+
+from bqflow._helper import ifnull
+from bqflow.fields import DAGTask, JobPriority, Parameter, Range, Template, Workflow
+from bqflow.task import Query
+
+# withItemsの値がdictでないときに値を渡すパラメータの名前
+ITEM = "item"
+
+
+def infer_type(value: Any) -> str:
+    """withItemsの値からパラメータの型を決める"""
+    if isinstance(value, bool):
+        return "BOOL"
+    if isinstance(value, int):
+        return "INT64"
+    if isinstance(value, float):
+        return "FLOAT64"
+    if isinstance(value, datetime):
+        return "TIMESTAMP"
+    if isinstance(value, date):
+        return "DATE"
+    if isinstance(value, str):
+        return "STRING"
+    if isinstance(value, list) and value:
+        return f"ARRAY<{infer_type(value[0])}>"
+    raise ValueError(f"withItemsの値の型を決められません {value!r}")
+
+
+class FanOutItems(BaseModel):
+    """値ごとのタスクに展開するノードの値"""
+
+    # withItemsの値, またはwithParamで参照したパラメータの値
+    values: Optional[list[Any]] = None
+    # withParamで参照したARRAY型のパラメータの要素の型
+    type: Optional[str] = None
+    range: Optional[Range] = None
+    parallelism: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self.range) if self.range is not None else len(self.values)
+
+    def parameters(self, i: int) -> list[Parameter]:
+        """i番目のタスクに渡すパラメータ
+
+        dictの値はキーごとのパラメータに, STRUCTの値はメンバーごとのパラメータにする.
+        それ以外の値はitemという名前のパラメータにする.
+        """
+        value = self.range.value(i) if self.range is not None else self.values[i]
+        if self.type == "STRUCT":
+            return [Parameter(**p) for p in value]
+        # 型は値から決めたものなので検証しない
+        if isinstance(value, dict):
+            return [
+                Parameter.construct(name=k, type=infer_type(v), value=v) for k, v in value.items()
+            ]
+        return [Parameter.construct(name=ITEM, type=self.type or infer_type(value), value=value)]
+
+
+def _appended(xs: Sequence[int], x: int) -> list[int]:
+    xs = xs if isinstance(xs, list) else list(xs)
+    xs.append(x)
+    return xs
+
+
+class PlanNode:
+    """実行計画のノード
+
+    展開したワークフローのノードは数万になるので, pydanticのモデルにせず__slots__で持つ.
+    タスク名はinternした文字列のタプルで持ち, 同じ名前の文字列を共有する.
+    子タスクや依存関係がなければ空のタプルのままにしておく.
+    """
+
+    __slots__ = (
+        "id",
+        "template_name",
+        "key",
+        "parameters",
+        "parent",
+        "children",
+        "dependencies",
+        "dependents",
+        "fanout",
+        "pool",
+        "priority",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        template_name: str,
+        task_names: Sequence[str],
+        parameters: Optional[list[Parameter]] = None,
+        parent: Optional[int] = None,
+        children: Sequence[int] = (),
+        dependencies: Sequence[int] = (),
+        dependents: Sequence[int] = (),
+        fanout: Optional[FanOutItems] = None,
+        pool: Optional[str] = None,
+        priority: Optional[JobPriority] = None,
+    ):
+        self.id = id
+        self.template_name = sys.intern(template_name)
+        self.key: tuple[str, ...] = tuple(sys.intern(name) for name in task_names)
+        self.parameters: list[Parameter] = parameters if parameters is not None else []
+        self.parent = parent
+        self.children: Sequence[int] = children
+        self.dependencies: Sequence[int] = dependencies
+        self.dependents: Sequence[int] = dependents
+        # withItems, withParam, withRangeのタスクの値. childrenは展開したタスク
+        self.fanout = fanout
+        # タスクで指定したpoolとpriority. templateと親のタスクの指定はPlan.schedulingで解決する
+        self.pool = pool
+        self.priority = priority
+
+    @property
+    def task_names(self) -> list[str]:
+        return list(self.key)
+
+    def add_child(self, node_id: int):
+        self.children = _appended(self.children, node_id)
+
+    def add_dependency(self, node_id: int):
+        self.dependencies = _appended(self.dependencies, node_id)
+
+    def add_dependent(self, node_id: int):
+        self.dependents = _appended(self.dependents, node_id)
+
+    def __repr__(self) -> str:
+        return f"PlanNode(id={self.id}, template_name={self.template_name!r}, key={self.key!r})"
+
+
+def update_parameters(base: list[Parameter], update: list[Parameter]) -> list[Parameter]:
+    if not update:
+        # 上書きしなければ同じリストを共有する
+        return base
+    base = {x.name: x for x in base}
+    update = {x.name: x for x in update}
+    base.update(update)
+    return [x for x in base.values()]
+
+
+def input_overwrite(inputs: list[Parameter], writes: list[Parameter]) -> list[Parameter]:
+    inputs = {x.name: x for x in inputs}
+    writes = {x.name: x for x in writes if x.name in list(inputs.keys())}
+    sub = set(inputs.keys()) - set(writes.keys())
+    if sub != set():
+        raise ValueError(f"{sub}のパラメータが初期化できていません. yamlを確認してください")
+    inputs.update(writes)
+    return [x for x in inputs.values()]
+
+
+def convert_dag(template: Template) -> list[DAGTask]:
+    """stepsとdagをDAGTaskのリストに変換する
+
+    Args:
+        template (Template): テンプレート
+
+    Returns:
+        list[DAGTask]: templateの中のDAGTask. run, scriptの場合は空
+    """
+    dags: list[DAGTask] = []
+    if template.type == "steps":
+        deps: list[str] = []
+        for steps in template.steps:
+            step_deps = []
+            for step in steps:
+                task = DAGTask(
+                    name=step.name,
+                    template=step.template,
+                    dependencies=deps,
+                    arguments=step.arguments,
+                    withItems=step.withItems,
+                    withParam=step.withParam,
+                    withRange=step.withRange,
+                    parallelism=step.parallelism,
+                    pool=step.pool,
+                    priority=step.priority,
+                )
+                step_deps.append(step.name)
+                dags.append(task)
+            deps = step_deps
+    elif template.type == "dag":
+        dags = list(template.dag.tasks)
+    return dags
+
+
+def fanout_items(
+    task: DAGTask, parameters: list[Parameter], task_names: list[str]
+) -> Optional[FanOutItems]:
+    """タスクのwithItems, withParam, withRangeから展開する値を求める"""
+    if not task.is_fanout:
+        return None
+    if task.withParam is None:
+        return FanOutItems(
+            values=task.withItems, range=task.withRange, parallelism=task.parallelism
+        )
+    param = next((p for p in parameters if p.name == task.withParam), None)
+    if param is None or param.type is None or not param.type.startswith("ARRAY<"):
+        raise ValueError(f"{task_names}のwithParamにはARRAY型のパラメータを指定してください {task.withParam}")
+    return FanOutItems(
+        values=param.value, type=param.type[len("ARRAY<") : -1], parallelism=task.parallelism
+    )
+
+
+class Plan:
+    """コンパイル済みの実行計画
+
+    ノードのidはnodesのindexと一致し, 0番がentrypointのrootノードになる.
+    nodesを渡すとWorkflowを展開せずにそのまま使う.
+    """
+
+    def __init__(self, wf: Workflow, nodes: Optional[list[PlanNode]] = None):
+        self.wf = wf
+        self.nodes: list[PlanNode] = []
+        self.index: dict[tuple[str, ...], int] = {}
+        self.templates = {t.name: t for t in wf.templates}
+        self.dags = {t.name: convert_dag(t) for t in wf.templates}
+        self.queries = {t.name: t for t in wf.templates if t.type in ["run", "script"]}
+        # 解決済みのQueryとtemplateごとのSQL. scriptのファイルは一度だけ読む
+        self._compiled: dict[int, Query] = {}
+        self._sql: dict[str, str] = {}
+        if nodes is not None:
+            for node in nodes:
+                self._add(node)
+            return
+
+        root = self._add(
+            PlanNode(
+                id=0,
+                template_name=wf.entrypoint,
+                task_names=[],
+                parameters=wf.arguments.parameters,
+            )
+        )
+        self._expand(root, [])
+
+    @property
+    def root(self) -> PlanNode:
+        return self.nodes[0]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def find(self, task_names: list[str]) -> PlanNode:
+        key = tuple(task_names)
+        if key not in self.index:
+            raise KeyError(f"{task_names}は実行計画の中に存在しませんでした")
+        return self.nodes[self.index[key]]
+
+    def is_query(self, node: PlanNode) -> bool:
+        return node.fanout is None and node.template_name in self.queries
+
+    def is_fanout(self, node: PlanNode) -> bool:
+        return node.fanout is not None
+
+    def size(self, node: PlanNode) -> int:
+        """子タスクの数. 値ごとのタスクに展開するノードは展開前でも値の数を返す"""
+        return len(node.fanout) if node.fanout is not None else len(node.children)
+
+    def instance(self, group: PlanNode, i: int) -> PlanNode:
+        """展開するノードのi番目の値のタスクを返す. まだ展開していなければ展開する"""
+        key = group.key + (str(i),)
+        if key in self.index:
+            return self.nodes[self.index[key]]
+        node = self._add(
+            PlanNode(
+                id=len(self.nodes),
+                template_name=group.template_name,
+                task_names=list(key),
+                parameters=update_parameters(group.parameters, group.fanout.parameters(i)),
+                parent=group.id,
+            )
+        )
+        group.add_child(node.id)
+        self._expand(node, self._ancestors(group), self._scope(node))
+        return node
+
+    def expand_all(self) -> "Plan":
+        """全ての値ごとのタスクを展開する. 全てのクエリを見る必要があるときに使う"""
+        # 展開して追加されたノードもそのまま辿る
+        for node in self.nodes:
+            if node.fanout is not None:
+                for i in range(len(node.fanout)):
+                    self.instance(node, i)
+        return self
+
+    def copy(self) -> "Plan":
+        """同じワークフローを別に実行するための複製
+
+        値ごとのタスクの展開はノードを追加するので, ノードと索引だけを複製し, Workflowと解決済みのSQLは共有する.
+        """
+        plan = copy.copy(self)
+        plan.nodes = []
+        for node in self.nodes:
+            node = copy.copy(node)
+            # 追加するときにlistは書き換えるので, tupleにして元のノードと共有しない
+            node.children = tuple(node.children)
+            node.dependencies = tuple(node.dependencies)
+            node.dependents = tuple(node.dependents)
+            plan.nodes.append(node)
+        plan.index = dict(self.index)
+        plan._compiled = dict(self._compiled)
+        plan._sql = dict(self._sql)
+        return plan
+
+    def _ancestors(self, node: PlanNode) -> list[str]:
+        """nodeと祖先のtemplate名. 値ごとのタスクに展開するノードは除く"""
+        names = []
+        while node is not None:
+            if node.fanout is None:
+                names.append(node.template_name)
+            node = self.nodes[node.parent] if node.parent is not None else None
+        return names[::-1]
+
+    def _scope(self, node: PlanNode) -> list[Parameter]:
+        """nodeの子孫のタスクに渡すパラメータ
+
+        ワークフローの引数に, nodeと祖先の値ごとのタスクの値を重ねる.
+        """
+        instances = []
+        while node.parent is not None:
+            parent = self.nodes[node.parent]
+            if parent.fanout is not None:
+                instances.append((parent, int(node.task_names[-1])))
+            node = parent
+        params = self.wf.arguments.parameters
+        for group, i in reversed(instances):
+            params = update_parameters(params, group.fanout.parameters(i))
+        return params
+
+    def query(self, node: PlanNode) -> Query:
+        """クエリのノードを実行するQueryに変換する
+
+        Args:
+            node (PlanNode): runまたはscriptのtemplateを参照するノード
+
+        Returns:
+            Query: SQLとパラメータを解決したクエリ
+        """
+        if node.id in self._compiled:
+            return self._compiled[node.id]
+        temp = self.queries[node.template_name]
+        params = input_overwrite(temp.inputs.parameters, node.parameters)
+
+        output = None
+        if temp.output is not None:
+            output = Path(str(temp.output).replace("{task}", "-".join(node.task_names)))
+        pool, priority = self.scheduling(node)
+        # 値は検証済みなので, タスクごとにpydanticの検証をしない
+        query = Query.construct(
+            name=node.task_names,
+            sql=self._read_sql(temp),
+            parameters=params,
+            output=output,
+            batchable=temp.batchable,
+            timeout=temp.timeout,
+            retry=temp.retryStrategy,
+            pool=pool,
+            priority=priority,
+        )
+        self._compiled[node.id] = query
+        return query
+
+    def scheduling(self, node: PlanNode) -> tuple[Optional[str], Optional[JobPriority]]:
+        """タスクのpoolとpriority
+
+        タスク, タスクのtemplate, 親のタスクの順に辿り, 最初に指定されているものを使う.
+        """
+        pool, priority = None, None
+        current: Optional[PlanNode] = node
+        while current is not None and (pool is None or priority is None):
+            temp = self.templates[current.template_name]
+            pool = ifnull(pool, ifnull(current.pool, temp.pool))
+            priority = ifnull(priority, ifnull(current.priority, temp.priority))
+            current = self.nodes[current.parent] if current.parent is not None else None
+        return pool, priority
+
+    def sql(self, template_name: str) -> str:
+        """runまたはscriptのtemplateのSQL. scriptのファイルは最初に読んだときの内容を返す"""
+        return self._read_sql(self.queries[template_name])
+
+    def _read_sql(self, temp: Template) -> str:
+        if temp.name not in self._sql:
+            if temp.run is None:
+                with open(temp.script, "r") as f:
+                    self._sql[temp.name] = f.read()
+            else:
+                self._sql[temp.name] = temp.run
+        return self._sql[temp.name]
+
+    def compile(self) -> "Plan":
+        """全てのクエリのSQLとパラメータを解決しておく
+
+        値ごとのタスクに展開するノードは最初の値のタスクだけを展開して確かめる.
+        """
+        # 展開して追加されたノードもそのまま辿る
+        for node in self.nodes:
+            try:
+                if node.fanout is not None and len(node.fanout) > 0:
+                    self.instance(node, 0)
+                elif self.is_query(node):
+                    self.query(node)
+            except (OSError, ValueError) as e:
+                raise ValueError(f"{node.task_names}: {e}") from e
+        return self
+
+    def sources(self) -> list[Path]:
+        """実行計画が読み込むscriptのファイル"""
+        used = {node.template_name for node in self.nodes if self.is_query(node) or node.fanout}
+        return [t.script for t in self.queries.values() if t.name in used and t.script is not None]
+
+    def leaves(self) -> list[PlanNode]:
+        return [node for node in self.nodes if self.is_query(node)]
+
+    def _add(self, node: PlanNode) -> PlanNode:
+        self.nodes.append(node)
+        self.index[node.key] = node.id
+        return node
+
+    def _expand(
+        self, parent: PlanNode, stack: list[str], scope: Optional[list[Parameter]] = None
+    ):
+        """parentのtemplateに含まれるタスクを再帰的に展開する
+
+        Args:
+            parent (PlanNode): 展開するノード
+            stack (list[str]): 祖先のtemplate名. 循環の検出に使う
+            scope (Optional[list[Parameter]]): タスクの引数の下に敷くパラメータ.
+                値ごとのタスクの子孫ではその値を含む. 省略するとワークフローの引数
+        """
+        if parent.template_name in stack:
+            raise ValueError(f"templateの参照が循環しています {stack + [parent.template_name]}")
+        if scope is None:
+            scope = self.wf.arguments.parameters
+
+        tasks = self.dags[parent.template_name]
+        ids: dict[str, int] = {}
+        for task in tasks:
+            task_names = parent.task_names + [task.name]
+            if task.template is None:
+                raise ValueError(f"{task_names}にtemplateが指定されていません")
+            parameters = update_parameters(scope, task.arguments.parameters)
+            node = self._add(
+                PlanNode(
+                    id=len(self.nodes),
+                    template_name=task.template,
+                    task_names=task_names,
+                    parameters=parameters,
+                    parent=parent.id,
+                    fanout=fanout_items(task, parameters, task_names),
+                    pool=task.pool,
+                    priority=task.priority,
+                )
+            )
+            parent.add_child(node.id)
+            ids[task.name] = node.id
+
+        for task in tasks:
+            node = self.nodes[ids[task.name]]
+            for dep in task.dependencies:
+                if dep not in ids:
+                    raise ValueError(
+                        f"{node.task_names}のdependenciesに存在しないタスクが指定されています {dep}"
+                    )
+                node.add_dependency(ids[dep])
+                self.nodes[ids[dep]].add_dependent(node.id)
+
+        for node_id in parent.children:
+            if self.nodes[node_id].fanout is None:
+                self._expand(self.nodes[node_id], stack + [parent.template_name], scope)
@@ -0,0 +1,180 @@
+"""クリティカルパスの長さによるタスクの優先度付け"""
+
+import asyncio
+import heapq
+import itertools
+import statistics
+from typing import Callable, Hashable, Optional, TypeVar
+
+from bqflow.limiter import Pools
+from bqflow.plan import Plan
+from bqflow.task import Query
+
+K = TypeVar("K", bound=Hashable)
+
+
+def evaluate(keys: list[K], deps: Callable[[K], list[K]], compute: Callable[[K], float]):
+    """依存する値を先に計算しながら全てのkeyの値を計算する
+
+    深い依存関係でも再帰の上限に当たらないようにスタックで辿る.
+    computeは依存する値が全て計算済みになってから呼ばれる.
+    """
+    done: set[K] = set()
+    visiting: set[K] = set()
+    for key in keys:
+        stack = [key]
+        while stack:
+            k = stack[-1]
+            if k in done:
+                stack.pop()
+                continue
+            pending = [d for d in deps(k) if d not in done]
+            if pending:
+                if k in visiting:
+                    raise ValueError(f"依存関係が循環しています {k}")
+                visiting.add(k)
+                stack += pending
+                continue
+            compute(k)
+            visiting.discard(k)
+            done.add(k)
+            stack.pop()
+
+
+def task_weights(
+    plan: Plan,
+    durations: Optional[dict[tuple[str, ...], float]] = None,
+    estimates: Optional[dict[tuple[str, ...], int]] = None,
+) -> dict[int, float]:
+    """クエリのノードの重み
+
+    過去の実行時間があればそれを, なければドライランの見積もりバイト数を使う.
+    どちらにもないタスクは他のタスクの中央値にする. 何もなければ全て1にする.
+
+    Returns:
+        dict[int, float]: ノードidをキーにした重み
+    """
+    leaves = plan.leaves()
+    for source in [durations, estimates]:
+        if not source:
+            continue
+        known = [float(source[n.key]) for n in leaves if n.key in source]
+        if not known:
+            continue
+        default = statistics.median(known)
+        return {n.id: float(source.get(n.key, default)) for n in leaves}
+    return {n.id: 1.0 for n in leaves}
+
+
+def critical_path_lengths(plan: Plan, weights: dict[int, float]) -> dict[tuple[str, ...], float]:
+    """各クエリのノードから始まる残りのクリティカルパスの長さを計算する
+
+    ノードの後続は自身と祖先のdependentsで, stepsやdagのノードの長さは
+    依存タスクのない子タスクの長さの最大値になる.
+    値ごとのタスクに展開するノードは展開前なので, parallelismずつ順に実行する回数を重みにする.
+
+    Returns:
+        dict[tuple[str, ...], float]: task_namesをキーにした自身を含む残りの長さ.
+            値ごとのタスクに展開するノードも含む
+    """
+    # ("rank", id): ノードから始まる長さ, ("tail", id): ノードの完了後に続く長さ
+    values: dict[tuple[str, int], float] = {}
+
+    def deps(key: tuple[str, int]) -> list[tuple[str, int]]:
+        kind, node_id = key
+        node = plan.nodes[node_id]
+        if kind == "tail":
+            keys = [("rank", d) for d in node.dependents]
+            return keys + ([("tail", node.parent)] if node.parent is not None else [])
+        if plan.is_query(node) or plan.is_fanout(node):
+            return [("tail", node_id)]
+        entries = [c for c in node.children if not plan.nodes[c].dependencies]
+        return [("rank", c) for c in entries] if entries else [("tail", node_id)]
+
+    def compute(key: tuple[str, int]):
+        kind, node_id = key
+        node = plan.nodes[node_id]
+        if kind == "tail" or not (plan.is_query(node) or plan.is_fanout(node)):
+            values[key] = max([values[d] for d in deps(key)], default=0.0)
+        elif plan.is_fanout(node):
+            size = len(node.fanout)
+            waves = -(-size // (node.fanout.parallelism or max(size, 1)))
+            values[key] = weights.get(node_id, 1.0) * waves + values[("tail", node_id)]
+        else:
+            values[key] = weights.get(node_id, 1.0) + values[("tail", node_id)]
+
+    targets = [n for n in plan if plan.is_query(n) or plan.is_fanout(n)]
+    evaluate([("rank", n.id) for n in targets], deps, compute)
+    return {n.key: values[("rank", n.id)] for n in targets}
+
+
+def priority_of(priorities: dict[tuple[str, ...], float], task_names: list[str]) -> float:
+    """タスクの優先度. 実行中に展開したタスクは展開元のノードの優先度を使う"""
+    key = tuple(task_names)
+    while key:
+        if key in priorities:
+            return priorities[key]
+        key = key[:-1]
+    return 0.0
+
+
+class ReadyQueue:
+    """実行可能なタスクのキュー
+
+    残りのクリティカルパスが長いタスクから取り出す. 同じ長さなら積んだ順に取り出す.
+    Noneはworkerを止める番兵で, 全てのタスクの後に取り出される.
+    poolsを渡すと, poolの枠が埋まっているタスクは枠が空くまで脇に置き, 次に優先度の高いタスクを取り出す.
+    """
+
+    def __init__(
+        self,
+        priorities: Optional[dict[tuple[str, ...], float]] = None,
+        pools: Optional[Pools] = None,
+    ):
+        self.priorities = priorities if priorities is not None else {}
+        self.pools = pools
+        self._q: "asyncio.PriorityQueue[tuple[float, int, Optional[Query]]]" = (
+            asyncio.PriorityQueue()
+        )
+        self._counter = itertools.count()
+        # poolの枠が空くのを待っているタスク
+        self._parked: dict[str, list[tuple[float, int, Optional[Query]]]] = {}
+
+    def put_nowait(self, task: Optional[Query]):
+        if task is None:
+            priority = float("inf")
+        else:
+            priority = -self.priority(task.name)
+        self._q.put_nowait((priority, next(self._counter), task))
+
+    def priority(self, task_names: list[str]) -> float:
+        return priority_of(self.priorities, task_names)
+
+    async def get(self) -> Optional[Query]:
+        """タスクを取り出す. poolを指定したタスクはpoolの枠を取ってから返す"""
+        while True:
+            item = await self._q.get()
+            task = item[2]
+            if task is None or self.pools is None or self.pools.try_acquire(task.pool):
+                return task
+            heapq.heappush(self._parked.setdefault(task.pool, []), item)
+
+    def get_nowait(self) -> Optional[Query]:
+        """poolの枠を取らずにタスクを取り出す. 取り出したタスクと同じ枠で実行するときに使う"""
+        _, _, task = self._q.get_nowait()
+        return task
+
+    def release(self, task: Query):
+        """getで取り出したタスクのpoolの枠を返し, 枠を待っていたタスクを戻す"""
+        if self.pools is None or task.pool is None:
+            return
+        self.pools.release(task.pool)
+        parked = self._parked.get(task.pool)
+        if parked:
+            self._q.put_nowait(heapq.heappop(parked))
+
+    def empty(self) -> bool:
+        return self._q.empty() and not any(self._parked.values())
+
+    def qsize(self) -> int:
+        return self._q.qsize() + sum(len(parked) for parked in self._parked.values())
@@ -1,92 +1,729 @@
 import asyncio
-from asyncio import Queue
+import time
+from logging import getLogger
+from typing import Any, Coroutine, Optional
 
 from abq import BQ
+from abq.async_retry import TooManyTriesException
 from abq.bq import JobResult
 
 from bqflow._helper import ifnull
-from bqflow.fields import Workflow
+from bqflow.batch import (
+    build_script,
+    can_batch,
+    child_jobs,
+    compatible,
+    failed_index,
+    statement_stats,
+)
+from bqflow.dedup import QueryMemo, SharedJob
+from bqflow.export import export_result
+from bqflow.fields import Parameter, RetryStrategy, Workflow
+from bqflow.jobs import (
+    JobTimeout,
+    cancel_job,
+    error_message,
+    is_rate_limited,
+    is_retryable,
+    job_exception,
+    job_options,
+    raise_for_job_error,
+    rate_limit_delay,
+    slot_ms,
+)
+from bqflow.journal import Journal
+from bqflow.limiter import ConcurrencyLimiter, Pools
+from bqflow.monitor import JobMonitor
+from bqflow.options import FailurePolicy
 from bqflow.parameter import parse_param
-from bqflow.report import TaskReport
+from bqflow.plan import Plan
+from bqflow.priority import ReadyQueue, critical_path_lengths, task_weights
+from bqflow.report import TaskReport, TaskTiming
+from bqflow.session import SessionBQ, run
+from bqflow.state import Fingerprints, StateStore
 from bqflow.task import Query
 from bqflow.tracer import TreeTracer
 
+logger = getLogger(__name__)
+
 
 class Producer:
-    def __init__(self, tt: TreeTracer, queue: Queue[Query]):
+    """実行可能になったタスクをキューに積む
+
+    タスクの完了を受け取ったときにだけ新たに実行可能になったタスクを積むので,
+    ポーリングは行わない.
+    """
+
+    def __init__(self, tt: TreeTracer, queue: ReadyQueue, workers: int):
         self.tt = tt
-        self.added_tasks: list[list[str]] = []
         self.q = queue
+        self.workers = workers
+        self.stopped = False
+        # 実行可能になる前にバッチに含めたタスク. 完了時にキューへ積まない
+        self.claimed: set[tuple[str, ...]] = set()
+        # タスクが実行可能になった時刻
+        self.ready_at: dict[tuple[str, ...], float] = {}
 
     def is_done(self):
         root = self.tt.statuses.get_root_task()
         return root.done
 
-    async def task_loop(self) -> bool:
-        while not self.is_done():
-            await self._add_task()
-            await asyncio.sleep(0.1)
-        return True
+    def start(self):
+        self._put(self.tt.get_tasks())
+
+    def task_done(self, task_names: list[str]):
+        """タスクの完了を反映し, 新たに実行可能になったタスクをキューに積む
 
-    async def _add_task(self):
-        tasks = [t for t in self.tt.get_tasks() if t.name not in self.added_tasks]
+        Args:
+            task_names (list[str]): 完了したタスク名
+        """
+        self._put(self.tt.task_done(task_names))
+
+    def _put(self, tasks: list[Query]):
+        now = time.time()
         for task in tasks:
-            self.added_tasks.append(task.name)
+            self.ready_at[tuple(task.name)] = now
+            if tuple(task.name) in self.claimed:
+                self.claimed.discard(tuple(task.name))
+                continue
             self.q.put_nowait(task)
+        if self.is_done():
+            self.stop()
+
+    def stop(self):
+        """全workerに終了の番兵を送る"""
+        if self.stopped:
+            return
+        self.stopped = True
+        for _ in range(self.workers):
+            self.q.put_nowait(None)
 
 
 class Consumer:
-    def __init__(self, tt: TreeTracer, project_name: str, queue: Queue[Query]):
-        self.tt = tt
-        self.bq = BQ(project_id=project_name)
+    def __init__(
+        self,
+        producer: Producer,
+        project_name: str,
+        queue: ReadyQueue,
+        limiter: ConcurrencyLimiter,
+        state: Optional[StateStore] = None,
+        incremental: bool = False,
+        journal: Optional[Journal] = None,
+        failure_policy: FailurePolicy = "fail-fast",
+        maximum_bytes_billed: Optional[int] = None,
+        bq: Optional[BQ] = None,
+        poll_interval: float = 0.5,
+        batch_size: int = 1,
+        dedup: bool = False,
+        timeout: Optional[float] = None,
+        retry: Optional[RetryStrategy] = None,
+    ):
+        self.producer = producer
+        self.bq = bq if bq is not None else SessionBQ(project_name)
         self.q = queue
-        self.done = False
+        self.limiter = limiter
         self.reports: list[TaskReport] = []
-
-    def stop(self):
-        self.done = True
+        self.state = state
+        self.incremental = incremental
+        self.fingerprints = Fingerprints(producer.tt.plan) if state is not None else {}
+        self.journal = journal
+        self.failure_policy = failure_policy
+        self.maximum_bytes_billed = maximum_bytes_billed
+        # 失敗したタスクがあり新しいタスクを実行しない
+        self.halted = False
+        self.running: dict[tuple[str, ...], JobResult] = {}
+        self.cancelled: set[tuple[str, ...]] = set()
+        self.in_progress = 0
+        self.monitor = JobMonitor(
+            self.bq, min_interval=poll_interval, max_interval=max(poll_interval, 10.0)
+        )
+        self.processes: set[asyncio.Task] = set()
+        self.batch_size = batch_size
+        # 完了していないタスクの各段階の時刻
+        self.timings: dict[tuple[str, ...], TaskTiming] = {}
+        # 同じSQLとパラメータのクエリを1回だけ実行する
+        self.memo = QueryMemo() if dedup else None
+        # templateで指定されていないタスクのtimeoutと再実行の設定
+        self.timeout = timeout
+        self.retry = retry if retry is not None else RetryStrategy()
+        # 再実行した回数と, 失敗した実行と再実行までの待ちに費やした秒数
+        self.retries: dict[tuple[str, ...], int] = {}
+        self.lost: dict[tuple[str, ...], float] = {}
+        # レート制限で再実行した回数. retryStrategyとは別に数える
+        self.rate_limited: dict[tuple[str, ...], int] = {}
 
     async def make_worker(self, worker: int):
+        monitor = asyncio.create_task(self.monitor.run())
         await asyncio.gather(*[self.execute(i + 1) for i in range(worker)])
+        await asyncio.gather(*self.processes)
+        self.monitor.stop()
+        await monitor
 
     async def execute(self, i):
-        while not self.done:
-            if not self.q.empty():
-                task = self.q.get_nowait()
-                params = [parse_param(param) for param in task.parameters]
-                job: JobResult = await self.bq.query(sql=task.sql, parameters=params)
-                await job.wait()
-
-                duration = job.info.statistics.endTime - job.info.statistics.startTime
-                total_bytes_billed = ifnull(job.info.statistics.query.totalBytesBilled, 0)
-                tr = TaskReport(
-                    name=task.name,
-                    duration=duration / 1000,
-                    total_bytes_billed=total_bytes_billed,
+        """実行可能なタスクを取り出してジョブを投げる
+
+        ジョブの完了はJobMonitorが監視するので, workerは完了を待たずに次のタスクを取り出す.
+        """
+        while True:
+            await self.limiter.acquire()
+            task = await self.q.get()
+            if task is None:
+                self.limiter.withdraw()
+                break
+            await self.limiter.admit()
+            self.dequeue(task, i)
+            if self.halted:
+                self.free(task)
+                self.report(
+                    TaskReport(name=task.name, state="skipped", timing=self.finish(task))
                 )
-                self.reports.append(tr)
+                self.stop_if_idle()
+                continue
+
+            self.in_progress += 1
+            self.spawn(self.dispatch(task, i))
+
+    def dequeue(self, task: Query, worker: int):
+        """workerがタスクを取り出した時刻を記録する"""
+        timing = self.timings.setdefault(tuple(task.name), TaskTiming())
+        if timing.ready is None:
+            timing.ready = self.producer.ready_at.pop(tuple(task.name), None)
+        timing.dequeued = time.time()
+        timing.worker = worker
+
+    def free(self, task: Query):
+        """取り出したタスクが使っていた全体とpoolの実行枠を返す"""
+        self.limiter.release()
+        self.q.release(task)
+
+    def report(self, tr: TaskReport):
+        """タスクのレポートに再実行した回数を加えて記録する"""
+        tr.retries = self.retries.pop(tuple(tr.name), 0)
+        tr.lost = self.lost.pop(tuple(tr.name), 0.0)
+        self.rate_limited.pop(tuple(tr.name), None)
+        self.reports.append(tr)
+
+    def finish(self, task: Query) -> TaskTiming:
+        """タスクの完了または失敗を反映した時刻を記録し, 記録した時刻を返す"""
+        timing = self.timings.pop(tuple(task.name), None) or TaskTiming()
+        timing.finished = time.time()
+        return timing
+
+    def dispatch(self, task: Query, worker: int) -> Coroutine[Any, Any, None]:
+        """タスクを単独で実行するか, バッチで実行するか, 同じクエリのジョブの結果を使うかを決める
+
+        同じクエリのジョブがあるかはworkerが次のタスクを取り出す前に決めておく.
+        """
+        memoize = self.memo is not None and not self.is_cached(task)
+        if memoize:
+            future = self.memo.get(task)
+            if future is not None:
+                # ジョブの完了を待つだけなので実行枠は使わない
+                self.free(task)
+                return self.process_shared(task, future)
+        if self.batch_size > 1 and can_batch(task) and not self.is_cached(task):
+            return self.process_batch(*self.make_batch(task, worker))
+        return self.process(task, self.memo.claim(task) if memoize else None)
+
+    async def process(self, task: Query, future: "Optional[asyncio.Future[Optional[SharedJob]]]"):
+        try:
+            await self.run_task(task, future)
+        except (Exception, TooManyTriesException) as e:
+            if is_rate_limited(e):
+                self.retry_rate_limited(task, e)
+            else:
+                self.retry_or_fail(task, e)
+        finally:
+            self.in_progress -= 1
+            self.running.pop(tuple(task.name), None)
+            self.free(task)
+        self.stop_if_idle()
+
+    def is_cached(self, task: Query) -> bool:
+        """--incrementalで前回の成功時から変更がなく, 実行を省略できるか"""
+        if not self.incremental:
+            return False
+        fingerprint = self.fingerprints.get(tuple(task.name))
+        if fingerprint is None:
+            return False
+        return self.state.is_fresh(task.name, fingerprint)
+
+    async def run_task(
+        self, task: Query, future: "Optional[asyncio.Future[Optional[SharedJob]]]" = None
+    ):
+        if self.is_cached(task):
+            tr = TaskReport(name=task.name, state="cached", timing=self.finish(task))
+            self.report(tr)
+            self.task_done(task.name)
+            return
+        if future is None:
+            await self.run_query(task)
+            return
+
+        try:
+            shared = await self.run_query(task)
+        except (Exception, TooManyTriesException) as e:
+            # 再実行するなら待っているタスクにはそれぞれ実行させる
+            if tuple(task.name) in self.running and self.retry_delay(task, e) is None:
+                self.memo.fail(future, e)
+            else:
+                self.memo.abandon(task, future)
+            raise
+        except BaseException:
+            self.memo.abandon(task, future)
+            raise
+        self.memo.resolve(future, shared)
+
+    async def run_query(self, task: Query) -> SharedJob:
+        """タスクのジョブを投げて完了を待つ"""
+        fingerprint = self.fingerprints.get(tuple(task.name))
+        params = [parse_param(param) for param in task.parameters]
+        concurrency = self.limiter.level
+        timing = self.timings.setdefault(tuple(task.name), TaskTiming())
+        timing.submitted = time.time()
+        job: JobResult = await self.bq.query(
+            sql=task.sql,
+            parameters=params,
+            maximumBytesBilled=self.maximum_bytes_billed,
+            **job_options(task),
+        )
+        self.running[tuple(task.name)] = job
+        json = await self.wait_job([task], job)
+        timing.slot_ms = slot_ms(json)
+        raise_for_job_error(json)
+
+        statistics = job.info.statistics
+        timing.started = statistics.startTime / 1000
+        timing.ended = statistics.endTime / 1000
+        duration = statistics.endTime - statistics.startTime
+        pending = statistics.startTime - statistics.creationTime
+        self.limiter.on_complete(pending / 1000, backlog=not self.q.empty())
+
+        total_bytes_billed = ifnull(statistics.query.totalBytesBilled, 0)
+        tr = TaskReport(
+            name=task.name,
+            duration=duration / 1000,
+            total_bytes_billed=total_bytes_billed,
+            concurrency=concurrency,
+        )
+        if task.output is not None:
+            await export_result(job, task.output)
+        tr.timing = self.finish(task)
+        self.report(tr)
+        if fingerprint is not None:
+            self.state.record(task.name, fingerprint, tr.duration, total_bytes_billed)
+
+        self.task_done(task.name)
+        return SharedJob(task.name, job, tr.duration)
+
+    async def wait_job(self, tasks: list[Query], job: JobResult) -> dict:
+        """ジョブの完了を待つ
+
+        tasksのtimeoutを過ぎたらジョブのキャンセルをリクエストし, 完了を待たずにJobTimeoutを送出する.
+        バッチのタスクはスクリプトの中で順に実行されるので, 各タスクのtimeoutの合計を使う.
+
+        Returns:
+            dict: 完了したジョブのjson
+        """
+        timeouts = [ifnull(task.timeout, self.timeout) for task in tasks]
+        future = self.monitor.watch(job)
+        if None in timeouts:
+            return await future
+        timeout = sum(timeouts)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.monitor.forget(job)
+            self.spawn(self.cancel(tuple(tasks[0].name), job))
+            raise JobTimeout(timeout) from None
+
+    async def process_shared(self, task: Query, future: "asyncio.Future[Optional[SharedJob]]"):
+        try:
+            shared = await asyncio.shield(future)
+            if shared is None:
+                # 最初のタスクがジョブを投げられなかったので, 改めて実行する
+                self.q.put_nowait(task)
+            else:
+                await self.reuse(task, shared)
+        except (Exception, TooManyTriesException) as e:
+            leader = self.memo.leader(task)
+            if leader is not None and tuple(leader) in self.cancelled:
+                self.cancelled.add(tuple(task.name))
+            self.fail(task, e)
+        finally:
+            self.in_progress -= 1
+        self.stop_if_idle()
+
+    async def reuse(self, task: Query, shared: SharedJob):
+        """同じクエリのジョブの結果でタスクを完了にする"""
+        if task.output is not None:
+            await export_result(shared.job, task.output)
+        tr = TaskReport(name=task.name, shared_with=shared.task_names, timing=self.finish(task))
+        self.report(tr)
+        fingerprint = self.fingerprints.get(tuple(task.name))
+        if fingerprint is not None:
+            self.state.record(task.name, fingerprint, shared.duration, 0)
+        self.task_done(task.name)
+
+    def make_batch(self, task: Query, worker: int) -> tuple[list[Query], int]:
+        """taskと1つのスクリプトにまとめるタスクを集める
+
+        キューに積まれている独立したタスクを空いている枠の数で分け合った分と,
+        それらが完了すると実行可能になる後続のタスクをbatch_sizeまで集める. 後続のタスクは完了時にキューへ積まれないようにしておく.
 
-                self.tt.task_done(task.name)
-            await asyncio.sleep(0.1)
+        Returns:
+            tuple[list[Query], int]: 依存関係の順に並んだタスクと, そのうちキューから取り出した数
+        """
+        batch = [task]
+        parameters = {p.name: p for p in task.parameters}
+        # 独立したタスクはスクリプトの中では順に実行されるので, 空いている枠で分け合う
+        free = max(0, self.limiter.level - self.limiter.active) + 1
+        share = min(self.batch_size, -(-(self.q.qsize() + 1) // free))
+        others: list[Optional[Query]] = []
+        while len(batch) < share:
+            try:
+                other = self.q.get_nowait()
+            except asyncio.QueueEmpty:
+                # 残りはpoolの枠を待っているタスクだけ
+                break
+            if other is None:
+                others.append(other)
+                break
+            if self.add_to_batch(batch, parameters, other):
+                self.dequeue(other, worker)
+            else:
+                others.append(other)
+        for other in others:
+            self.q.put_nowait(other)
+
+        ready = len(batch)
+        added = True
+        while added and len(batch) < self.batch_size:
+            news = self.producer.tt.unlocked([t.name for t in batch])
+            added = False
+            for other in news[: self.batch_size - len(batch)]:
+                added = self.add_to_batch(batch, parameters, other) or added
+        for other in batch[ready:]:
+            self.producer.claimed.add(tuple(other.name))
+            self.timings[tuple(other.name)] = TaskTiming(dequeued=time.time(), worker=worker)
+        return batch, ready
+
+    def add_to_batch(
+        self, batch: list[Query], parameters: dict[str, Parameter], task: Query
+    ) -> bool:
+        if not can_batch(task) or not compatible(parameters, task) or self.is_cached(task):
+            return False
+        # 同じpoolの枠と同じ優先度のジョブで実行できるタスクだけをまとめる
+        if (task.pool, task.priority) != (batch[0].pool, batch[0].priority):
+            return False
+        batch.append(task)
+        parameters.update({p.name: p for p in task.parameters})
+        return True
+
+    async def process_batch(self, tasks: list[Query], ready: int):
+        try:
+            await self.run_batch(tasks, ready)
+        except (Exception, TooManyTriesException) as e:
+            # スクリプトのジョブを投げられなかった
+            self.release(tasks[1:], ready - 1)
+            if is_rate_limited(e):
+                self.retry_rate_limited(tasks[0], e)
+            else:
+                self.retry_or_fail(tasks[0], e)
+        finally:
+            self.in_progress -= 1
+            for task in tasks:
+                self.running.pop(tuple(task.name), None)
+            # バッチは先頭のタスクのpoolの枠で実行する
+            self.free(tasks[0])
+        self.stop_if_idle()
+
+    async def run_batch(self, tasks: list[Query], ready: int):
+        """タスクを1つのスクリプトとして実行し, 子ジョブの結果をタスクごとに反映する
+
+        Args:
+            tasks (list[Query]): 依存関係の順に並んだタスク
+            ready (int): tasksのうちキューから取り出したタスクの数
+        """
+        script = build_script(tasks)
+        parameters = {p.name: p for task in tasks for p in task.parameters}
+        concurrency = self.limiter.level
+        submitted = time.time()
+        for task in tasks:
+            self.timings.setdefault(tuple(task.name), TaskTiming()).submitted = submitted
+        job: JobResult = await self.bq.query(
+            sql=script.sql,
+            parameters=[parse_param(param) for param in parameters.values()],
+            maximumBytesBilled=self.maximum_bytes_billed,
+            **job_options(tasks[0]),
+        )
+        for task in tasks:
+            self.running[tuple(task.name)] = job
+        json = await self.wait_job(tasks, job)
+        for task in tasks:
+            self.running.pop(tuple(task.name), None)
+
+        statistics = job.info.statistics
+        pending = statistics.startTime - statistics.creationTime
+        self.limiter.on_complete(pending / 1000, backlog=not self.q.empty())
+
+        children = await child_jobs(self.bq, job)
+        stats = statement_stats(script, children)
+        error = job_exception(json)
+        n = len(tasks) if error is None else failed_index(script, children, str(error))
+        # 失敗したタスク以降は実行されていないので元に戻す
+        self.release(tasks[n + 1 :], ready - n - 1)
+        for task, stat in zip(tasks[:n], stats):
+            tr = TaskReport(
+                name=task.name,
+                duration=stat.duration,
+                total_bytes_billed=stat.total_bytes_billed,
+                concurrency=concurrency,
+                timing=self.finish(task),
+            )
+            tr.timing.started, tr.timing.ended = stat.started, stat.ended
+            tr.timing.slot_ms = stat.slot_ms
+            self.report(tr)
+            fingerprint = self.fingerprints.get(tuple(task.name))
+            if fingerprint is not None:
+                self.state.record(task.name, fingerprint, tr.duration, tr.total_bytes_billed)
+            self.task_done(task.name)
+        if error is not None:
+            self.retry_or_fail(tasks[n], error)
+
+    def release(self, tasks: list[Query], ready: int):
+        """バッチから外したタスクを戻す
+
+        キューから取り出したタスクはキューに積み直し, 後続のタスクは通常どおり完了時に積まれるようにする.
+        """
+        for i, task in enumerate(tasks):
+            if i < ready:
+                self.q.put_nowait(task)
+            else:
+                self.producer.claimed.discard(tuple(task.name))
+                # まだ実行可能になっていないので取り出した時刻は捨てる
+                self.timings.pop(tuple(task.name), None)
+
+    def task_done(self, task_names: list[str]):
+        if self.journal is not None:
+            self.journal.record_done(task_names)
+        self.producer.task_done(task_names)
+
+    def retry_delay(self, task: Query, e: BaseException) -> Optional[float]:
+        """再実行するなら再実行までに待つ秒数を返す
+
+        Returns:
+            Optional[float]: 再実行しないエラーか, 再実行の回数が上限に達していればNone
+        """
+        key = tuple(task.name)
+        if self.halted or key in self.cancelled or not is_retryable(e):
+            return None
+        strategy = task.retry if task.retry is not None else self.retry
+        retries = self.retries.get(key, 0)
+        if retries >= strategy.limit:
+            return None
+        return strategy.delay(retries + 1)
+
+    def retry_or_fail(self, task: Query, e: BaseException):
+        """再実行できるエラーなら待ってからキューに積み直し, そうでなければ失敗にする
+
+        待っている間は実行枠を空けておき, 他のタスクに使わせる.
+        """
+        delay = self.retry_delay(task, e)
+        if delay is None:
+            self.fail(task, e)
+            return
+        key = tuple(task.name)
+        self.retries[key] = self.retries.get(key, 0) + 1
+        timing = self.timings.get(key)
+        started = timing.dequeued if timing is not None and timing.dequeued else time.time()
+        self.lost[key] = self.lost.get(key, 0.0) + time.time() - started + delay
+        logger.warning(
+            f"{task.name}を{delay:.1f}秒後に再実行します"
+            f"({self.retries[key]}回目): {error_message(e)}"
+        )
+        # 再びキューに積むまでworkerを止めない
+        self.in_progress += 1
+        self.spawn(self.requeue(task, e, delay))
+
+    def retry_rate_limited(self, task: Query, e: BaseException):
+        """レート制限に当たったタスクを待ってからキューに積み直す
+
+        待つ時間は再実行するたびに倍にし, 回数が上限に達したら失敗にする.
+        """
+        self.limiter.on_rate_limited()
+        key = tuple(task.name)
+        count = self.rate_limited.get(key, 0)
+        delay = rate_limit_delay(count)
+        if delay is None or self.halted or key in self.cancelled:
+            self.fail(task, e)
+            return
+        self.rate_limited[key] = count + 1
+        logger.warning(
+            f"{task.name}がレート制限に当たったので{delay:.1f}秒後に再実行します({count + 1}回目)"
+        )
+        self.in_progress += 1
+        self.spawn(self.requeue(task, e, delay))
+
+    async def requeue(self, task: Query, e: BaseException, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.in_progress -= 1
+        if self.halted:
+            # 待っている間に他のタスクが失敗したので再実行しない
+            self.report(
+                TaskReport(
+                    name=task.name, state="failed", error=error_message(e), timing=self.finish(task)
+                )
+            )
+        else:
+            self.q.put_nowait(task)
+        self.stop_if_idle()
+
+    def spawn(self, coro: Coroutine[Any, Any, None]):
+        """workerの終了時に完了を待つタスクとして実行する"""
+        process = asyncio.create_task(coro)
+        self.processes.add(process)
+        process.add_done_callback(self.processes.discard)
+
+    def fail(self, task: Query, e: BaseException):
+        """タスクの失敗をfailure_policyに従って扱う"""
+        key = tuple(task.name)
+        state = "cancelled" if key in self.cancelled else "failed"
+        error = error_message(e)
+        self.report(
+            TaskReport(name=task.name, state=state, error=error, timing=self.finish(task))
+        )
+        if state == "cancelled":
+            return
+
+        if self.failure_policy == "continue-independent-branches":
+            return
+        self.halted = True
+        if self.failure_policy == "fail-fast":
+            # バッチのタスクは同じジョブを共有するので, ジョブごとに1回だけキャンセルする
+            jobs = set()
+            for name, job in self.running.items():
+                if name != key:
+                    self.cancelled.add(name)
+                    if id(job) not in jobs:
+                        jobs.add(id(job))
+                        self.spawn(self.cancel(name, job))
+
+    async def cancel(self, task_names: tuple[str, ...], job: JobResult):
+        try:
+            await cancel_job(self.bq, job)
+        except Exception as e:
+            logger.warning(f"{list(task_names)}のジョブをキャンセルできませんでした: {e}")
+
+    def stop_if_idle(self):
+        """実行中のタスクも実行待ちのタスクもなくなったらworkerを止める
+
+        失敗したタスクがあるとrootタスクは完了しないので, ここで終了を判定する.
+        """
+        if self.in_progress == 0 and self.q.empty():
+            self.producer.stop()
 
 
 class ProCon:
-    def __init__(self, wf: Workflow, project_name: str, max_size=10):
-        self.q: list[Query] = Queue()
-        self.tt = TreeTracer(wf)
-        self.tt.task_update()
-        self.producer = Producer(self.tt, self.q)
-        self.consumer = Consumer(self.tt, project_name, self.q)
-        self.max_size = max_size
+    def __init__(
+        self,
+        wf: Workflow,
+        project_name: str,
+        max_size=10,
+        state: Optional[StateStore] = None,
+        incremental: bool = False,
+        journal: Optional[Journal] = None,
+        failure_policy: FailurePolicy = "fail-fast",
+        maximum_bytes_billed: Optional[int] = None,
+        limiter: Optional[ConcurrencyLimiter] = None,
+        estimates: Optional[dict[tuple[str, ...], int]] = None,
+        bq: Optional[BQ] = None,
+        poll_interval: float = 0.5,
+        plan: Optional[Plan] = None,
+        batch_size: int = 1,
+        dedup: bool = False,
+        timeout: Optional[float] = None,
+        retry: Optional[RetryStrategy] = None,
+        completed: Optional[list[list[str]]] = None,
+    ):
+        self.tt = TreeTracer(wf, plan=plan)
+        self.project_name = project_name
+        self.limiter = limiter if limiter is not None else ConcurrencyLimiter(max_size)
+        # workerの数は同時実行数の上限に合わせる
+        self.max_size = self.limiter.maximum
+        # poolごとの同時実行数は全体の同時実行数と一緒に守る
+        pools = self.tt.plan.wf.pools
+        self.pools = Pools(pools) if pools else None
+        self.state = state
+        self.incremental = incremental
+        self.journal = journal
+        self.failure_policy = failure_policy
+        self.maximum_bytes_billed = maximum_bytes_billed
+        # テストやベンチマークでは偽のバックエンドに差し替える
+        self.bq = bq
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.dedup = dedup
+        self.timeout = timeout
+        self.retry = retry
+        if journal is not None:
+            self.tt.restore(journal.completed())
+        # 監視モードでは変更の影響を受けないタスクを完了済みにして実行しない
+        if completed:
+            self.tt.restore(completed)
+
+        durations = state.durations() if state is not None else None
+        weights = task_weights(self.tt.plan, durations=durations, estimates=estimates)
+        self.priorities = critical_path_lengths(self.tt.plan, weights)
 
     def run(self) -> list[TaskReport]:
-        return asyncio.run(self.execute())
+        return run(self.execute())
 
     async def execute(self) -> list[TaskReport]:
-        producer = asyncio.create_task(self.producer.task_loop())
-        consumer = asyncio.create_task(self.consumer.make_worker(self.max_size))
+        # Queueは実行中のイベントループに紐づくのでここで作る
+        q = ReadyQueue(self.priorities, pools=self.pools)
+        producer = Producer(self.tt, q, self.max_size)
+        consumer = Consumer(
+            producer,
+            self.project_name,
+            q,
+            self.limiter,
+            state=self.state,
+            incremental=self.incremental,
+            journal=self.journal,
+            failure_policy=self.failure_policy,
+            maximum_bytes_billed=self.maximum_bytes_billed,
+            bq=self.bq,
+            poll_interval=self.poll_interval,
+            batch_size=self.batch_size,
+            dedup=self.dedup,
+            timeout=self.timeout,
+            retry=self.retry,
+        )
+
+        producer.start()
+        consumer.stop_if_idle()
+        await consumer.make_worker(self.max_size)
+        return consumer.reports + self.skipped_reports(consumer.reports)
+
+    def skipped_reports(self, reports: list[TaskReport]) -> list[TaskReport]:
+        return skipped_reports(self.tt, reports)
+
 
-        await producer
-        self.consumer.stop()
-        await consumer
-        return self.consumer.reports
+def skipped_reports(tt: TreeTracer, reports: list[TaskReport]) -> list[TaskReport]:
+    """失敗により実行されなかったタスクのレポート"""
+    reported = {tuple(r.name) for r in reports}
+    skipped = []
+    # 展開されなかった値ごとのタスクは展開元のノードをまとめて報告する
+    plan = tt.plan
+    for node in [n for n in plan if plan.is_query(n) or plan.is_fanout(n)]:
+        if node.key in reported:
+            continue
+        if tt.statuses.is_done(node.id):
+            continue
+        if plan.is_fanout(node) and tt.cursors.get(node.id, 0) == len(node.fanout):
+            continue
+        skipped.append(TaskReport(name=node.task_names, state="skipped"))
+    return skipped
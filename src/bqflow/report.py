@@ -1,7 +1,77 @@
+from typing import Literal, Optional
+
 from pydantic import BaseModel
 
+from bqflow._helper import convert_size
+
+# done: 実行して成功した
+# cached: 前回の実行から変更がなくジョブを投げずに完了にした
+# failed: 実行して失敗した
+# cancelled: 他のタスクの失敗により実行中にキャンセルした
+# skipped: 他のタスクの失敗により実行しなかった
+TaskState = Literal["done", "cached", "failed", "cancelled", "skipped"]
+
+
+class TaskTiming(BaseModel):
+    """タスクが各段階に入った時刻(UNIX時間の秒)"""
+
+    # 依存するタスクが全て完了し実行可能になった
+    ready: Optional[float] = None
+    # workerがキューから取り出した
+    dequeued: Optional[float] = None
+    # ジョブを投げた
+    submitted: Optional[float] = None
+    # BigQueryでジョブの実行が始まった, 終わった
+    started: Optional[float] = None
+    ended: Optional[float] = None
+    # 完了または失敗を反映した
+    finished: Optional[float] = None
+    # キューから取り出したworkerの番号
+    worker: Optional[int] = None
+    slot_ms: Optional[int] = None
+
 
 class TaskReport(BaseModel):
     name: list[str]
-    duration: float
-    total_bytes_billed: int
+    duration: float = 0
+    total_bytes_billed: int = 0
+    state: TaskState = "done"
+    error: Optional[str] = None
+    # ジョブを投げたときの同時実行数の上限
+    concurrency: Optional[int] = None
+    timing: Optional[TaskTiming] = None
+    # --dedupで同じクエリのジョブの結果を使ったときのジョブを投げたタスク
+    shared_with: Optional[list[str]] = None
+    # 失敗して再実行した回数と, 失敗した実行と再実行までの待ちに費やした秒数
+    retries: int = 0
+    lost: float = 0
+
+
+def summarize(reports: list[TaskReport]) -> str:
+    """完了しなかったタスクを状態ごとにまとめる"""
+    lines = []
+    for state in ["failed", "cancelled", "skipped"]:
+        targets = [r for r in reports if r.state == state]
+        if not targets:
+            continue
+        lines.append(f"{state}: {len(targets)}")
+        for r in targets:
+            error = f" ({r.error})" if r.error is not None else ""
+            lines.append(f"  {'/'.join(r.name)}{error}")
+    return "\n".join(lines)
+
+
+def summarize_dedup(reports: list[TaskReport]) -> str:
+    """同じクエリのジョブの結果を使ったことで省略したジョブの数とスキャン量"""
+    billed = {tuple(r.name): r.total_bytes_billed for r in reports}
+    shared = [r for r in reports if r.shared_with is not None]
+    saved = sum(billed.get(tuple(r.shared_with), 0) for r in shared)
+    return f"dedup: {len(shared)} jobs, {convert_size(saved)} saved"
+
+
+def summarize_retries(reports: list[TaskReport]) -> str:
+    """再実行した回数と失敗した実行で失った時間"""
+    retried = [r for r in reports if r.retries]
+    retries = sum(r.retries for r in retried)
+    lost = sum(r.lost for r in retried)
+    return f"retries: {retries} times in {len(retried)} tasks, {lost:.1f}s lost"
@@ -0,0 +1,156 @@
+"""複数のワークフローをひとつの実行枠で実行し続けるサーバー
+
+スプールに投入されたワークフローを受け取り次第, 並行して実行する.
+全てのワークフローのジョブは共有する実行枠の数までしか同時に実行せず,
+枠は使っている枠が少ないワークフローから順に渡すので, 先に投入された大きなワークフローが枠を占有しない.
+コンパイルした実行計画とBigQueryのクライアントは実行をまたいで使い回す.
+実行計画の読み込みはファイルを読むので別のスレッドで行い, 他のワークフローの実行を止めない.
+"""
+
+import asyncio
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Optional
+
+from abq import BQ
+
+from bqflow.cache import FileStamp
+from bqflow.journal import Journal, journal_dir
+from bqflow.limiter import SharedPool
+from bqflow.load import load_plan
+from bqflow.plan import Plan
+from bqflow.procon import ProCon
+from bqflow.report import summarize
+from bqflow.session import SessionBQ
+from bqflow.spool import Result, Spool, Submission
+from bqflow.state import StateStore, open_state
+
+logger = getLogger(__name__)
+
+
+class Server:
+    """スプールのワークフローを共有する実行枠で実行する
+
+    Args:
+        spool (Spool): 依頼を受け取るスプール
+        concurrency (int): 全てのワークフローで共有する同時実行数
+        project (Optional[str]): 依頼にプロジェクトIDがないときに使うプロジェクトID
+        poll_interval (float): スプールを確認する間隔の秒数
+        bq (Optional[Callable[[str], BQ]]): プロジェクトIDからクライアントを作る. テストでは偽のBigQueryにする
+        job_poll_interval (float): ジョブの状態を確認する最小の間隔の秒数
+    """
+
+    def __init__(
+        self,
+        spool: Spool,
+        concurrency: int,
+        project: Optional[str] = None,
+        poll_interval: float = 1.0,
+        bq: Optional[Callable[[str], BQ]] = None,
+        job_poll_interval: float = 0.5,
+    ):
+        self.spool = spool
+        self.pool = SharedPool(concurrency)
+        self.project = project
+        self.poll_interval = poll_interval
+        self.make_bq = bq if bq is not None else SessionBQ
+        self.job_poll_interval = job_poll_interval
+        self.clients: dict[str, BQ] = {}
+        self.plans: dict[tuple[Path, Path, Optional[str]], tuple[list[FileStamp], Plan]] = {}
+        self.runs: set[asyncio.Task] = set()
+
+    async def serve(self, once: bool = False):
+        """依頼を受け取って実行し続ける
+
+        Args:
+            once (bool): スプールの依頼を全て実行したら終了する
+        """
+        recovered = self.spool.recover()
+        if recovered:
+            print(f"前回止まったときに実行中だった{recovered}件を再開します")
+        while True:
+            for path in self.spool.pending():
+                submission = self.spool.claim(path)
+                if submission is not None:
+                    run = asyncio.create_task(self.run(submission))
+                    self.runs.add(run)
+                    run.add_done_callback(self.runs.discard)
+            if once and not self.runs and not self.spool.pending():
+                break
+            await asyncio.sleep(self.poll_interval)
+
+    def client(self, project: str) -> BQ:
+        if project not in self.clients:
+            self.clients[project] = self.make_bq(project)
+        return self.clients[project]
+
+    def plan(self, submission: Submission) -> Plan:
+        """コンパイル済みの実行計画. yamlとscriptが変わっていなければ前回の実行計画を使う
+
+        値ごとのタスクの展開で書き換えないよう, 使い回す実行計画ではなく実行ごとの複製を返す.
+        """
+        key = (submission.workflow, submission.cwd, submission.entrypoint)
+        if key in self.plans:
+            stamps, plan = self.plans[key]
+            if all(stamp.is_fresh() for stamp in stamps):
+                return plan.copy()
+        plan = load_plan(submission.workflow, entrypoint=submission.entrypoint, base=submission.cwd)
+        files = [submission.workflow] + plan.sources()
+        self.plans[key] = ([FileStamp.of(p.resolve()) for p in files], plan)
+        return plan.copy()
+
+    def journal(self, submission: Submission, plan: Plan) -> Journal:
+        directory = journal_dir(submission.workflow)
+        if submission.run_id is not None:
+            return Journal.open(directory, submission.run_id)
+        journal = Journal.create(
+            directory, workflow=submission.workflow, entrypoint=plan.wf.entrypoint
+        )
+        submission.run_id = journal.run_id
+        self.spool.update(submission)
+        return journal
+
+    async def run(self, submission: Submission) -> Result:
+        """依頼されたワークフローを実行し, 結果をスプールに書く"""
+        name = f"{submission.workflow.name} ({submission.id})"
+        state: Optional[StateStore] = None
+        try:
+            project = submission.project or self.project
+            if project is None:
+                raise RuntimeError("プロジェクトIDが指定されていません")
+            loop = asyncio.get_running_loop()
+            plan = await loop.run_in_executor(None, self.plan, submission)
+            journal = self.journal(submission, plan)
+            print(f"start: {name} run id: {journal.run_id}")
+            state = open_state(submission.workflow, submission.incremental)
+            procon = ProCon(
+                plan.wf,
+                project,
+                state=state,
+                incremental=submission.incremental,
+                journal=journal,
+                failure_policy=submission.failure_policy,
+                limiter=self.pool.limiter(submission.concurrency),
+                bq=self.client(project),
+                poll_interval=self.job_poll_interval,
+                plan=plan,
+            )
+            reports = await procon.execute()
+        except Exception as e:
+            logger.exception(f"{name}を実行できませんでした")
+            result = Result(id=submission.id, ok=False, run_id=submission.run_id, error=str(e))
+        else:
+            ok = all(r.state in ["done", "cached"] for r in reports)
+            if ok:
+                journal.remove()
+            result = Result(id=submission.id, ok=ok, run_id=journal.run_id, reports=reports)
+        finally:
+            if state is not None:
+                state.close()
+        self.spool.complete(result)
+
+        print(f"{'done' if result.ok else 'failed'}: {name}")
+        summary = result.error or summarize(result.reports)
+        if summary:
+            print(summary)
+        return result
@@ -0,0 +1,279 @@
+"""BigQueryのクライアントで共有するHTTPの接続とアクセストークン
+
+abqのクライアントはリクエストごとにhttpxのクライアントを作り直すので, 毎回TCPとTLSの接続から始まる.
+アクセストークンも期限が切れてから, イベントループを止めたまま同期的に更新する.
+SessionBQはプロセスで共有するSessionを通してリクエストを送り,
+keep-aliveの接続を使い回し, アクセストークンは期限の前に別のスレッドで更新する.
+
+接続はイベントループに紐づくので, コマンドの中の非同期処理はrunで同じイベントループで実行する.
+"""
+
+import asyncio
+import atexit
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from logging import getLogger
+from typing import Any, Callable, Optional, TypeVar
+
+import httpx
+from abq import BQ
+from abq.async_retry import retry
+from abq.bq import RETRYIES, JobResult
+
+from bqflow.fields import JobPriority
+from bqflow.jobs import api_error, insert_query
+
+logger = getLogger(__name__)
+
+T = TypeVar("T")
+
+SCOPES = [
+    "https://www.googleapis.com/auth/bigquery",
+    "https://www.googleapis.com/auth/cloud-platform",
+]
+
+
+def load_credentials():
+    """GOOGLE_APPLICATION_CREDENTIALSのサービスアカウントの認証情報"""
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    from bqflow import read_credential
+
+    return ServiceAccountCredentials.from_json_keyfile_dict(read_credential(), scopes=SCOPES)
+
+
+def _utcnow() -> datetime:
+    # oauth2clientのtoken_expiryはtimezoneのないUTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class TokenCache:
+    """アクセストークンを期限の少し前に更新して使い回す
+
+    同時に期限が近づいたことに気づいたリクエストは, ひとつの更新を待って同じトークンを使う.
+
+    Args:
+        load (Callable[[], Any]): oauth2clientの認証情報を作る. 最初に使うときに一度だけ呼ぶ
+        margin (float): 期限のこの秒数前に更新する
+    """
+
+    def __init__(self, load: Callable[[], Any] = load_credentials, margin: float = 300.0):
+        self.load = load
+        self.margin = margin
+        self.credentials: Optional[Any] = None
+        self.refreshes = 0
+        self._lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def is_stale(self) -> bool:
+        credentials = self.credentials
+        if credentials is None or credentials.access_token is None or credentials.invalid:
+            return True
+        if credentials.token_expiry is None:
+            return False
+        return credentials.token_expiry - timedelta(seconds=self.margin) <= _utcnow()
+
+    async def headers(self) -> dict[str, str]:
+        if self.is_stale():
+            async with self.lock():
+                if self.is_stale():
+                    # トークンの取得は同期的な通信なので, 他のリクエストを止めないように別のスレッドで行う
+                    await asyncio.get_running_loop().run_in_executor(None, self.refresh)
+        return {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.credentials.access_token}",
+        }
+
+    def lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock, self._loop = asyncio.Lock(), loop
+        return self._lock
+
+    def refresh(self):
+        import httplib2
+
+        if self.credentials is None:
+            self.credentials = self.load()
+        self.credentials.refresh(httplib2.Http())
+        self.refreshes += 1
+
+
+class Session:
+    """BigQueryのクライアントの間で共有するHTTPの接続プールとアクセストークン
+
+    Args:
+        tokens (Optional[TokenCache]): アクセストークンのキャッシュ. Noneなら認証しない
+        max_connections (int): 同時に開く接続の上限
+        max_keepalive (int): 使い終わった後も開いておく接続の数
+    """
+
+    def __init__(
+        self,
+        tokens: Optional[TokenCache] = None,
+        max_connections: int = 100,
+        max_keepalive: int = 50,
+    ):
+        self.tokens = tokens
+        self.limits = httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_keepalive
+        )
+        self.requests = 0
+        self.elapsed = 0.0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def client(self) -> httpx.AsyncClient:
+        """実行中のイベントループのhttpxのクライアント"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 別のイベントループで開いた接続は使えない
+            self._client = httpx.AsyncClient(limits=self.limits)
+            self._loop = loop
+        return self._client
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        headers = await self.tokens.headers() if self.tokens is not None else None
+        client = self.client()
+        start = time.perf_counter()
+        try:
+            return await client.request(method, url, headers=headers, **kwargs)
+        finally:
+            self.requests += 1
+            self.elapsed += time.perf_counter() - start
+
+    async def aclose(self):
+        if self._client is not None and self._loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._client, self._loop = None, None
+
+    def describe(self) -> str:
+        mean = self.elapsed / self.requests * 1000 if self.requests else 0.0
+        return f"{self.requests} requests, mean {mean:.1f} ms"
+
+
+@lru_cache(maxsize=None)
+def default_session() -> Session:
+    """プロセスで共有するSession"""
+    return Session(TokenCache())
+
+
+class _SessionClient:
+    """abqのClientのget, postをSession経由にする"""
+
+    session: Session
+
+    def __init__(self, session: Optional[Session] = None):
+        # abqのClientの__init__は使わないhttpxのクライアントを作るので呼ばない
+        self.session = session if session is not None else default_session()
+
+    async def close(self):
+        """接続は他のクライアントと共有しているので閉じない"""
+
+    async def _send(self, method: str, endpoint: str, timeout, call_back, **kwargs):
+        r = await self.session.request(method, endpoint, timeout=timeout, **kwargs)
+        if call_back is not None:
+            # abqのエラーの確認はメッセージしか残さないので, 先に理由を持ったエラーにする
+            error = api_error(r)
+            if error is not None:
+                raise error
+            call_back(r)
+        r.raise_for_status()
+        return r
+
+    @retry(RETRYIES, httpx.HTTPError)
+    async def post(self, endpoint, json, timeout=5000, call_back=None):
+        return await self._send("POST", endpoint, timeout, call_back, json=json)
+
+    @retry(RETRYIES, httpx.HTTPError)
+    async def get(self, endpoint, params=None, timeout=5000, call_back=None):
+        return await self._send("GET", endpoint, timeout, call_back, params=params)
+
+
+class SessionJobResult(_SessionClient, JobResult):
+    def __init__(self, projectId: str, jobId: str, session: Optional[Session] = None):
+        self.project_id = projectId
+        self.job_id = jobId
+        self.state = None
+        self.info = None
+        _SessionClient.__init__(self, session)
+
+
+class SessionBQ(_SessionClient, BQ):
+    """接続とアクセストークンをSessionで共有するabqのBQ
+
+    Args:
+        project_id (str): プロジェクトID
+        session (Optional[Session]): 省略するとプロセスで共有するSession
+    """
+
+    def __init__(self, project_id: str, session: Optional[Session] = None):
+        self._project_id = project_id
+        _SessionClient.__init__(self, session)
+
+    async def query_wait(self):
+        """abqのプロジェクトのジョブ数による待機をしない
+
+        abqはプロジェクトにPENDINGのジョブがあるか, RUNNINGのジョブが5つを超える間は次のジョブを投げない.
+        BATCHのジョブが待っている間もINTERACTIVEのジョブを投げられるように,
+        同時実行数はConcurrencyLimiterだけで制御する.
+        """
+
+    async def query(
+        self, sql: str, parameters=None, priority: Optional[JobPriority] = None, **kwargs
+    ) -> JobResult:
+        """クエリのジョブを作る. priorityにBATCHを指定するとjobs.insertで作る"""
+        if priority == "BATCH":
+            maximum = kwargs.get("maximumBytesBilled")
+            result = await insert_query(self, sql, parameters, priority, maximum)
+        else:
+            result = await self._base_query(sql=sql, parameters=parameters, **kwargs)
+        reference = result["jobReference"]
+        job = SessionJobResult(reference["projectId"], reference["jobId"], session=self.session)
+        await job.update()
+        return job
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def run(coro: "asyncio.Future[T]") -> T:
+    """コマンドで共有するイベントループでcoroを実行する
+
+    asyncio.runと同じく終わっていないタスクはキャンセルするが, イベントループは閉じないので,
+    続けて呼んだときもkeep-aliveの接続を使い回せる. イベントループはプロセスの終了時に閉じる.
+    """
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        atexit.register(close)
+    asyncio.set_event_loop(_loop)
+    try:
+        return _loop.run_until_complete(coro)
+    finally:
+        _cancel_all_tasks(_loop)
+
+
+def close():
+    """共有するイベントループとプロセスで共有するSessionの接続を閉じる"""
+    if _loop is None or _loop.is_closed():
+        return
+    try:
+        _loop.run_until_complete(default_session().aclose())
+        _loop.run_until_complete(_loop.shutdown_asyncgens())
+    finally:
+        _loop.close()
+
+
+def _cancel_all_tasks(loop: asyncio.AbstractEventLoop):
+    tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    if not tasks:
+        return
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"終了時に失敗したタスクがありました: {task.exception()}")
@@ -0,0 +1,265 @@
+"""複数のプロセスで共有するタスクのキュー
+
+`bqflow run --queue`で実行するワークフローは, 実行可能になったタスクをSQLiteのファイルに積む.
+`bqflow worker`のプロセスはタスクのリースを取ってジョブを投げ, 完了したら結果を書き戻す.
+workerは実行中のタスクのリースを定期的に延長し, 延長されずに期限が切れたタスクは
+workerが落ちたとみなして他のworkerが取り直す.
+
+SQLiteはWALモードで開き, WALはホスト内の共有メモリを使うので, キューは同じホストのプロセスでだけ共有できる.
+ネットワークファイルシステムに置いて複数のホストから使うと壊れることがある.
+複数のホストで使うには, SharedQueueと同じ操作を持つ別のデータベースのキューが必要になる.
+"""
+
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+from bqflow._helper import mkdir_if_not_exists
+from bqflow.report import TaskReport
+from bqflow.task import Query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    project TEXT NOT NULL,
+    active INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    task_names TEXT NOT NULL,
+    query TEXT NOT NULL,
+    priority REAL NOT NULL,
+    ready_at REAL NOT NULL,
+    -- ready, leased, done, failed, skipped
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    -- 実行中のジョブのキャンセルを求められた
+    cancel INTEGER NOT NULL DEFAULT 0,
+    -- 完了または失敗をワークフローに反映した
+    acked INTEGER NOT NULL DEFAULT 0,
+    report TEXT,
+    UNIQUE (run_id, task_names)
+);
+CREATE INDEX IF NOT EXISTS tasks_ready ON tasks (state, priority DESC, seq);
+"""
+
+
+class LeasedTask(NamedTuple):
+    """workerがリースを取ったタスク"""
+
+    seq: int
+    run_id: str
+    project: str
+    query: Query
+    ready_at: float
+    # リースを取った回数. 2以上なら前にリースを取ったworkerが落ちている
+    attempts: int
+
+
+def _key(task_names: list[str]) -> str:
+    return json.dumps(task_names, ensure_ascii=False)
+
+
+class SharedQueue:
+    """SQLiteのファイルに置いたタスクのキュー
+
+    Args:
+        path (Path): データベースのファイル
+        timeout (float): 他のプロセスの書き込みが終わるのを待つ秒数
+    """
+
+    def __init__(self, path: Path, timeout: float = 30.0):
+        self.path = path
+        mkdir_if_not_exists(path)
+        # トランザクションはtransactionで明示的に始める
+        self.conn = sqlite3.connect(
+            str(path), timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """書き込みのロックを取ってから読むトランザクション"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def create_run(self, run_id: str, project: str):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, 1, ?)", (run_id, project, time.time())
+            )
+
+    def finish_run(self, run_id: str):
+        with self.transaction() as conn:
+            conn.execute("UPDATE runs SET active = 0 WHERE run_id = ?", (run_id,))
+
+    def has_active_runs(self) -> bool:
+        row = self.conn.execute("SELECT 1 FROM runs WHERE active = 1 LIMIT 1").fetchone()
+        return row is not None
+
+    def put(self, run_id: str, tasks: list[Query], priorities: list[float]):
+        """実行可能になったタスクを積む. 既に積んだタスクは無視する"""
+        now = time.time()
+        rows = [
+            (run_id, _key(task.name), task.json(), priority, now)
+            for task, priority in zip(tasks, priorities)
+        ]
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (run_id, task_names, query, priority, ready_at, state)"
+                " VALUES (?, ?, ?, ?, ?, 'ready')",
+                rows,
+            )
+
+    def claim(self, owner: str, n: int, lease: float) -> list[LeasedTask]:
+        """優先度の高い順に最大n個のタスクのリースを取る
+
+        実行可能なタスクと, リースの期限が切れたタスクが対象になる.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT t.seq, t.run_id, r.project, t.query, t.ready_at, t.attempts"
+                " FROM tasks t JOIN runs r USING (run_id)"
+                " WHERE t.state = 'ready' OR (t.state = 'leased' AND t.lease_expires < ?)"
+                " ORDER BY t.priority DESC, t.seq LIMIT ?",
+                (now, n),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET state = 'leased', owner = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE seq = ?",
+                [(owner, now + lease, row[0]) for row in rows],
+            )
+        return [
+            LeasedTask(seq, run_id, project, Query.parse_raw(query), ready_at, attempts + 1)
+            for seq, run_id, project, query, ready_at, attempts in rows
+        ]
+
+    def heartbeat(self, owner: str, seqs: list[int], lease: float) -> list[int]:
+        """実行中のタスクのリースを延長する
+
+        Returns:
+            list[int]: キャンセルを求められたタスク
+        """
+        if not seqs:
+            return []
+        marks = ", ".join("?" * len(seqs))
+        with self.transaction() as conn:
+            conn.execute(
+                f"UPDATE tasks SET lease_expires = ?"
+                f" WHERE owner = ? AND state = 'leased' AND seq IN ({marks})",
+                (time.time() + lease, owner, *seqs),
+            )
+            rows = conn.execute(
+                f"SELECT seq FROM tasks WHERE owner = ? AND cancel = 1 AND seq IN ({marks})",
+                (owner, *seqs),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def complete(self, seq: int, owner: str, report: TaskReport) -> bool:
+        """タスクの結果を書き戻す
+
+        Returns:
+            bool: まだリースを持っていたか. 期限が切れて他のworkerが取り直していればFalse
+        """
+        state = "done" if report.state == "done" else "failed"
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET state = ?, report = ?, lease_expires = NULL"
+                " WHERE seq = ? AND owner = ? AND state = 'leased'",
+                (state, report.json(), seq, owner),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, seq: int, owner: str):
+        """実行しなかったタスクのリースを返す"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET state = 'ready', owner = NULL, lease_expires = NULL"
+                " WHERE seq = ? AND owner = ? AND state = 'leased'",
+                (seq, owner),
+            )
+
+    def finished(self, run_id: str) -> list[TaskReport]:
+        """まだワークフローに反映していない完了または失敗したタスクの結果"""
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT seq, report FROM tasks"
+                " WHERE run_id = ? AND state IN ('done', 'failed') AND acked = 0 ORDER BY seq",
+                (run_id,),
+            ).fetchall()
+            conn.executemany("UPDATE tasks SET acked = 1 WHERE seq = ?", [(r[0],) for r in rows])
+        return [TaskReport.parse_raw(report) for _, report in rows]
+
+    def halt(self, run_id: str, cancel: bool):
+        """積まれているタスクを実行しないようにする
+
+        Args:
+            cancel (bool): 実行中のタスクのジョブもキャンセルさせる
+        """
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET state = 'skipped' WHERE run_id = ? AND state = 'ready'",
+                (run_id,),
+            )
+            if cancel:
+                conn.execute(
+                    "UPDATE tasks SET cancel = 1 WHERE run_id = ? AND state = 'leased'", (run_id,)
+                )
+
+    def pending(self, run_id: str) -> int:
+        """実行待ちと実行中のタスクの数"""
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE run_id = ? AND state IN ('ready', 'leased')",
+            (run_id,),
+        ).fetchone()
+        return row[0]
+
+    def completed(self, run_id: str) -> list[list[str]]:
+        """完了したタスク"""
+        rows = self.conn.execute(
+            "SELECT task_names FROM tasks WHERE run_id = ? AND state = 'done'", (run_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def reports(self, run_id: str) -> list[TaskReport]:
+        rows = self.conn.execute(
+            "SELECT report FROM tasks WHERE run_id = ? AND report IS NOT NULL ORDER BY seq",
+            (run_id,),
+        ).fetchall()
+        return [TaskReport.parse_raw(row[0]) for row in rows]
+
+    def reset(self, run_id: str) -> Optional[str]:
+        """再開するために, 完了していないタスクを実行可能に戻す
+
+        Returns:
+            Optional[str]: runのプロジェクトID. runがなければNone
+        """
+        with self.transaction() as conn:
+            row = conn.execute("SELECT project FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET state = 'ready', owner = NULL, lease_expires = NULL,"
+                " cancel = 0, acked = 0, report = NULL"
+                " WHERE run_id = ? AND state IN ('failed', 'skipped')",
+                (run_id,),
+            )
+            conn.execute("UPDATE runs SET active = 1 WHERE run_id = ?", (run_id,))
+        return row[0]
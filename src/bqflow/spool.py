@@ -0,0 +1,129 @@
+"""bqflow serveに実行を依頼するワークフローのスプール
+
+incoming/に置いた依頼をサーバーがrunning/に移して実行し, 結果をdone/に書く.
+依頼の受け取りはrenameで行うので, 複数のプロセスから同時に投入してよい.
+
+`bqflow submit`から重いモジュールを読み込まないように, ここではabqを使わない.
+"""
+
+import os
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from pydantic import BaseModel
+
+from bqflow.options import FailurePolicy
+from bqflow.report import TaskReport
+
+
+def default_spool_dir() -> Path:
+    return Path.home() / ".bqflow" / "spool"
+
+
+class Submission(BaseModel):
+    """ワークフローの実行の依頼"""
+
+    id: str
+    workflow: Path
+    # scriptとoutputの相対パスを解決するディレクトリ
+    cwd: Path
+    project: Optional[str] = None
+    entrypoint: Optional[str] = None
+    # このワークフローが同時に使う実行枠の上限
+    concurrency: Optional[int] = None
+    incremental: bool = False
+    failure_policy: FailurePolicy = "fail-fast"
+    # 実行を始めたときのrun id. サーバーが止まった後はこのrun idから再開する
+    run_id: Optional[str] = None
+
+    @classmethod
+    def create(cls, workflow: Path, **kwargs) -> "Submission":
+        # ファイル名の順が投入された順になるようにする
+        submission_id = datetime.now().strftime("%Y%m%d-%H%M%S-%f-") + uuid.uuid4().hex[:6]
+        return cls(id=submission_id, workflow=workflow.resolve(), cwd=Path.cwd(), **kwargs)
+
+
+class Result(BaseModel):
+    id: str
+    ok: bool
+    run_id: Optional[str] = None
+    # ワークフローを読み込めないなど, タスクを実行する前のエラー
+    error: Optional[str] = None
+    reports: list[TaskReport] = []
+
+
+class Spool:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.incoming = directory / "incoming"
+        self.running = directory / "running"
+        self.done = directory / "done"
+
+    def _write(self, path: Path, model: BaseModel):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 書き込み途中のファイルを読まないように置き換える
+        tmp = self.directory / f".{path.name}.{os.getpid()}.tmp"
+        tmp.write_text(model.json(ensure_ascii=False))
+        tmp.replace(path)
+
+    def submit(self, submission: Submission):
+        self._write(self.incoming / f"{submission.id}.json", submission)
+
+    def pending(self) -> list[Path]:
+        """投入された順の依頼のファイル"""
+        if not self.incoming.exists():
+            return []
+        return sorted(self.incoming.glob("*.json"))
+
+    def claim(self, path: Path) -> Optional[Submission]:
+        """依頼をrunning/に移して受け取る
+
+        Returns:
+            Optional[Submission]: 他のサーバーが先に受け取っていればNone
+        """
+        target = self.running / path.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            path.rename(target)
+        except FileNotFoundError:
+            return None
+        return Submission.parse_file(target)
+
+    def update(self, submission: Submission):
+        """実行中の依頼にrun idを記録する"""
+        self._write(self.running / f"{submission.id}.json", submission)
+
+    def complete(self, result: Result):
+        self._write(self.done / f"{result.id}.json", result)
+        (self.running / f"{result.id}.json").unlink(missing_ok=True)
+
+    def recover(self) -> int:
+        """止まったサーバーが実行していた依頼をincoming/に戻す
+
+        Returns:
+            int: 戻した依頼の数
+        """
+        if not self.running.exists():
+            return 0
+        paths = sorted(self.running.glob("*.json"))
+        self.incoming.mkdir(parents=True, exist_ok=True)
+        for path in paths:
+            path.replace(self.incoming / path.name)
+        return len(paths)
+
+    def result(self, submission_id: str) -> Optional[Result]:
+        path = self.done / f"{submission_id}.json"
+        if not path.exists():
+            return None
+        return Result.parse_file(path)
+
+    def wait(self, submission_id: str, interval: float = 1.0) -> Result:
+        """依頼の実行が終わるまで待って結果を返す"""
+        while True:
+            result = self.result(submission_id)
+            if result is not None:
+                return result
+            time.sleep(interval)
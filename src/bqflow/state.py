@@ -0,0 +1,195 @@
+"""前回までの実行結果を保存するローカルの状態ストア
+
+タスクごとにSQL, パラメータ, 上流タスクのハッシュから計算したfingerprintと実行時間を記録する.
+fingerprintが前回の成功時と一致するタスクはジョブを投げずに完了扱いにでき,
+実行時間はタスクの優先度付けに使う.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+from bqflow.plan import Plan
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS task_state (
+    task_names TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    finished_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    total_bytes_billed INTEGER NOT NULL
+)
+"""
+
+
+def default_state_path(workflow_path: Path) -> Path:
+    """ワークフローのyamlと同じ場所に置く状態ストアのパス"""
+    return workflow_path.with_suffix(".bqflow.sqlite")
+
+
+def _hash(obj) -> str:
+    text = json.dumps(obj, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class Fingerprints:
+    """実行計画のノードのfingerprintを必要になったときに計算する
+
+    クエリのノードはSQL, 解決済みのパラメータ, 上流タスク(自身と祖先のdependencies)の
+    fingerprintから, stepsやdagのノードは子タスクのfingerprintから計算する.
+    値ごとのタスクに展開するノードは値ごとのタスクを展開せず,
+    展開する値, パラメータ, 上流タスクと, templateから参照するtemplateの定義とSQLから計算する.
+
+    Args:
+        plan (Plan): 実行計画
+    """
+
+    def __init__(self, plan: Plan):
+        self.plan = plan
+        self.fps: dict[int, str] = {}
+        self.ups: dict[int, list[str]] = {}
+        self.visiting: set[int] = set()
+        self.templates: dict[str, str] = {}
+
+    def get(self, task_names: tuple[str, ...]) -> Optional[str]:
+        """task_namesのfingerprint. 実行計画に存在しなければNone"""
+        if task_names not in self.plan.index:
+            return None
+        return self.fingerprint(self.plan.index[task_names])
+
+    def upstream(self, node_id: int) -> list[str]:
+        if node_id not in self.ups:
+            node = self.plan.nodes[node_id]
+            base = self.upstream(node.parent) if node.parent is not None else []
+            self.ups[node_id] = base + [self.fingerprint(dep) for dep in node.dependencies]
+        return self.ups[node_id]
+
+    def fingerprint(self, node_id: int) -> str:
+        if node_id in self.fps:
+            return self.fps[node_id]
+        if node_id in self.visiting:
+            raise ValueError(f"dependenciesが循環しています {self.plan.nodes[node_id].task_names}")
+        self.visiting.add(node_id)
+
+        plan = self.plan
+        node = plan.nodes[node_id]
+        if plan.is_query(node):
+            query = plan.query(node)
+            self.fps[node_id] = _hash(
+                {
+                    "sql": query.sql,
+                    "parameters": [p.dict() for p in query.parameters],
+                    "upstream": self.upstream(node_id),
+                }
+            )
+        elif plan.is_fanout(node):
+            self.fps[node_id] = _hash(
+                {
+                    "template": self.template(node.template_name),
+                    "fanout": node.fanout.dict(),
+                    "parameters": [p.dict() for p in node.parameters],
+                    "upstream": self.upstream(node_id),
+                }
+            )
+        else:
+            children = [self.fingerprint(c) for c in node.children]
+            self.fps[node_id] = _hash({"children": children})
+        self.visiting.discard(node_id)
+        return self.fps[node_id]
+
+    def template(self, name: str) -> str:
+        """templateとそこから参照するtemplateの定義とSQLのハッシュ"""
+        if name not in self.templates:
+            # 参照が循環していても止まるように先に埋めておく
+            self.templates[name] = ""
+            plan = self.plan
+            self.templates[name] = _hash(
+                {
+                    "definition": plan.templates[name].dict(),
+                    "sql": plan.sql(name) if name in plan.queries else None,
+                    "tasks": [
+                        self.template(task.template)
+                        for task in plan.dags[name]
+                        if task.template in plan.templates
+                    ],
+                }
+            )
+        return self.templates[name]
+
+
+def compute_fingerprints(plan: Plan) -> dict[tuple[str, ...], str]:
+    """実行計画の全ノードのfingerprintを計算する
+
+    Args:
+        plan (Plan): 実行計画
+
+    Returns:
+        dict[tuple[str, ...], str]: task_namesをキーにしたfingerprint
+    """
+    fingerprints = Fingerprints(plan)
+    # 値ごとのタスクの展開で追加されたノードもそのまま辿る
+    return {node.key: fingerprints.fingerprint(node.id) for node in plan.nodes}
+
+
+class StateStore:
+    """SQLiteに保存するタスクの成功記録"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _key(task_names: list[str]) -> str:
+        return json.dumps(task_names, ensure_ascii=False)
+
+    def fingerprint(self, task_names: list[str]) -> Optional[str]:
+        """前回成功したときのfingerprintを返す"""
+        row = self.conn.execute(
+            "SELECT fingerprint FROM task_state WHERE task_names = ?", (self._key(task_names),)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def is_fresh(self, task_names: list[str], fingerprint: str) -> bool:
+        return self.fingerprint(task_names) == fingerprint
+
+    def durations(self) -> dict[tuple[str, ...], float]:
+        """前回成功したときの実行時間"""
+        rows = self.conn.execute("SELECT task_names, duration FROM task_state").fetchall()
+        return {tuple(json.loads(names)): duration for names, duration in rows}
+
+    def record(
+        self, task_names: list[str], fingerprint: str, duration: float, total_bytes_billed: int
+    ):
+        """タスクの成功を記録する"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO task_state VALUES (?, ?, ?, ?, ?)",
+            (self._key(task_names), fingerprint, time.time(), duration, total_bytes_billed),
+        )
+        self.conn.commit()
+
+
+def open_state(workflow_path: Path, incremental: bool) -> Optional[StateStore]:
+    """ワークフローの状態ストアを開く
+
+    `--incremental`では作成し, それ以外は前回までの記録がある場合だけ開く.
+    開いた状態ストアには成功したタスクを記録し, 実行時間をクリティカルパスの計算に使う.
+
+    Args:
+        workflow_path (Path): ワークフローのyamlのパス
+        incremental (bool): `--incremental`で実行するか
+
+    Returns:
+        Optional[StateStore]: 状態ストア. 開かない場合はNone
+    """
+    path = default_state_path(workflow_path)
+    if not incremental and not path.exists():
+        return None
+    return StateStore(path)
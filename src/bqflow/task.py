@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+from pathlib import Path
+from typing import Optional
+
 from pydantic import BaseModel
 
-from bqflow.fields import Parameter
+from bqflow.fields import JobPriority, Parameter, RetryStrategy
 from bqflow.parameter import parse_param
 
 
@@ -10,6 +13,14 @@ class Query(BaseModel):
     name: list[str]
     sql: str
     parameters: list[Parameter]
+    output: Optional[Path] = None
+    batchable: bool = False
+    timeout: Optional[float] = None
+    retry: Optional[RetryStrategy] = None
+    pool: Optional[str] = None
+    priority: Optional[JobPriority] = None
+    # --queueでworkerに渡すジョブのスキャン量の上限
+    maximum_bytes_billed: Optional[int] = None
 
     @property
     def bq_parameters(self):
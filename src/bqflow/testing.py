@@ -0,0 +1,453 @@
+"""認証情報やネットワークなしでスケジューラを動かすための偽のBigQuery
+
+ProConのbqに渡すとabq.BQの代わりにジョブを模擬する.
+ベンチマーク用の合成ワークフローの生成もここで行う.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Union
+from urllib.parse import parse_qs, urlsplit
+
+import sqlparse
+from abq import QueryException
+from abq.job import Job
+
+from bqflow.fields import Workflow
+
+Latency = Union[float, tuple[float, float], Callable[[str], float]]
+
+
+class FakeJob:
+    """abqのJobResultと同じ属性を持つ偽のジョブ"""
+
+    def __init__(self, bq: "FakeBQ", job_id: str, sql: str):
+        self.bq = bq
+        self.project_id = bq.project_id
+        self.job_id = job_id
+        self.sql = sql
+        self.priority = "INTERACTIVE"
+        self.state = "PENDING"
+        self.info = None
+        self.error: Optional[dict] = None
+        self.creation_time = time.time()
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.finished = asyncio.Event()
+        # スクリプトの子ジョブの場合の親ジョブのidと文の開始行
+        self.parent_job_id: Optional[str] = None
+        self.line: Optional[int] = None
+
+    def json(self) -> dict:
+        status: dict = {"state": self.state}
+        if self.error is not None:
+            status["errorResult"] = self.error
+        statistics: dict = {"creationTime": int(self.creation_time * 1000)}
+        if self.start_time is not None:
+            statistics["startTime"] = int(self.start_time * 1000)
+        if self.end_time is not None:
+            statistics["endTime"] = int(self.end_time * 1000)
+            statistics["query"] = {"totalBytesBilled": self.bq.bytes_per_job}
+            # 1スロットで実行したことにする
+            started = self.start_time if self.start_time is not None else self.end_time
+            statistics["totalSlotMs"] = int((self.end_time - started) * 1000)
+        if self.parent_job_id is not None:
+            statistics["parentJobId"] = self.parent_job_id
+            statistics["scriptStatistics"] = {
+                "evaluationKind": "STATEMENT",
+                "stackFrames": [{"startLine": self.line, "endLine": self.line}],
+            }
+        return {
+            "id": f"{self.project_id}:{self.job_id}",
+            "jobReference": {"projectId": self.project_id, "jobId": self.job_id},
+            "status": status,
+            "statistics": statistics,
+        }
+
+    async def update(self):
+        self.info = Job(**self.json())
+
+    async def wait(self, state="DONE"):
+        await self.finished.wait()
+        await self.update()
+        return True
+
+    async def get_query_result(self, startIndex=0, maxResults=None, pageToken=None):
+        return {"schema": {"fields": []}, "totalRows": "0", "jobComplete": True}
+
+
+class FakeBQ:
+    """ジョブの実行時間, 失敗率, 同時実行数の上限を設定できる偽のBigQuery
+
+    Args:
+        latency (Latency): ジョブの実行秒数. 固定値, (最小, 最大)の一様分布, SQLを受け取る関数
+        failure_rate (float): ジョブが失敗する確率
+        fail_if (Callable[[str], bool]): SQLを受け取り, Trueならジョブを失敗させる
+        error_reason (str): 失敗させたジョブのエラーの理由. backendErrorなら一時的なエラーになる
+        max_concurrent (Optional[int]): 同時に実行するジョブの上限. 超えた分はPENDINGになる
+        job_overhead (float): ジョブの作成から実行開始までにかかる秒数
+        bytes_per_job (int): ジョブごとのスキャン量
+        seed (int): 乱数のシード
+    """
+
+    def __init__(
+        self,
+        latency: Latency = (0.01, 0.05),
+        failure_rate: float = 0.0,
+        fail_if: Optional[Callable[[str], bool]] = None,
+        error_reason: str = "invalidQuery",
+        max_concurrent: Optional[int] = None,
+        job_overhead: float = 0.0,
+        bytes_per_job: int = 10 * 1024 ** 2,
+        seed: int = 0,
+        project_id: str = "fake-project",
+    ):
+        self.project_id = project_id
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_if = fail_if
+        self.error_reason = error_reason
+        self.max_concurrent = max_concurrent
+        self.job_overhead = job_overhead
+        self.bytes_per_job = bytes_per_job
+        self.random = random.Random(seed)
+        self.jobs: dict[str, FakeJob] = {}
+        self.calls: dict[str, int] = {}
+        self.running = 0
+        self.peak_running = 0
+        self._ids = itertools.count()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: dict[str, asyncio.Task] = {}
+        self.children: dict[str, list[FakeJob]] = {}
+
+    def _count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _latency(self, sql: str) -> float:
+        if callable(self.latency):
+            return self.latency(sql)
+        if isinstance(self.latency, tuple):
+            return self.random.uniform(*self.latency)
+        return self.latency
+
+    async def query(
+        self, sql: str, parameters=None, maximumBytesBilled=None, priority="INTERACTIVE", **kwargs
+    ):
+        self._count("query")
+        job = FakeJob(self, f"job_{next(self._ids)}", sql)
+        job.priority = priority
+        self.jobs[job.job_id] = job
+        if self._slots is None and self.max_concurrent is not None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._tasks[job.job_id] = asyncio.create_task(self._run(job, maximumBytesBilled))
+        await job.update()
+        return job
+
+    def _error(self, sql: str, maximum_bytes_billed: Optional[int]) -> Optional[dict]:
+        if maximum_bytes_billed is not None and self.bytes_per_job > maximum_bytes_billed:
+            return {"reason": "bytesBilledLimitExceeded", "message": "over limit"}
+        if (self.fail_if is not None and self.fail_if(sql)) or (
+            self.random.random() < self.failure_rate
+        ):
+            return {"reason": self.error_reason, "message": "simulated failure"}
+        return None
+
+    async def _run(self, job: FakeJob, maximum_bytes_billed: Optional[int]):
+        acquired = False
+        try:
+            if self.job_overhead:
+                await asyncio.sleep(self.job_overhead)
+            if self._slots is not None:
+                await self._slots.acquire()
+                acquired = True
+            job.state = "RUNNING"
+            job.start_time = time.time()
+            self.running += 1
+            self.peak_running = max(self.peak_running, self.running)
+            try:
+                statements = _statements(job.sql)
+                if len(statements) > 1:
+                    await self._run_script(job, statements, maximum_bytes_billed)
+                else:
+                    await asyncio.sleep(self._latency(job.sql))
+                    job.error = self._error(job.sql, maximum_bytes_billed)
+            finally:
+                self.running -= 1
+        except asyncio.CancelledError:
+            job.error = {"reason": "stopped", "message": "Job execution was cancelled"}
+        finally:
+            if acquired:
+                self._slots.release()
+            job.state = "DONE"
+            job.end_time = time.time()
+            job.finished.set()
+
+    async def _run_script(
+        self, job: FakeJob, statements: list[tuple[int, str]], maximum_bytes_billed: Optional[int]
+    ):
+        """文ごとに子ジョブを作って順に実行する. 失敗した文で止まる"""
+        children = self.children.setdefault(job.job_id, [])
+        for line, sql in statements:
+            child = FakeJob(self, f"{job.job_id}_{len(children)}", sql)
+            child.parent_job_id = job.job_id
+            child.line = line
+            children.append(child)
+            child.state = "RUNNING"
+            child.start_time = time.time()
+            try:
+                await asyncio.sleep(self._latency(sql))
+                child.error = self._error(sql, maximum_bytes_billed)
+            finally:
+                child.state = "DONE"
+                child.end_time = time.time()
+            if child.error is not None:
+                job.error = {
+                    "reason": child.error["reason"],
+                    "message": f"{child.error['message']} at [{line}:1]",
+                }
+                return
+
+    async def dry_query(self, sql: str, parameters=None, **kwargs) -> int:
+        self._count("dry_query")
+        if self.fail_if is not None and self.fail_if(sql):
+            raise QueryException("Query Error: simulated failure")
+        return self.bytes_per_job
+
+    async def get_job(self, job_id: str, projectId=None) -> dict:
+        self._count("get_job")
+        return self.jobs[job_id].json()
+
+    async def get_job_list(
+        self, stateFilter=None, minCreationTime=None, parentJobId=None, **kwargs
+    ) -> dict:
+        self._count("get_job_list")
+        if parentJobId is not None:
+            return {"jobs": [job.json() for job in self.children.get(parentJobId, [])]}
+        jobs = [
+            job.json()
+            for job in self.jobs.values()
+            if (stateFilter is None or job.state.lower() == stateFilter)
+            and (minCreationTime is None or job.creation_time * 1000 >= minCreationTime)
+        ]
+        return {"jobs": jobs} if jobs else {}
+
+    async def post(self, endpoint: str, json: dict, **kwargs):
+        """jobs.cancelだけを扱う"""
+        self._count("post")
+        job_id = endpoint.rstrip("/").split("/")[-2]
+        if endpoint.endswith("/cancel") and job_id in self._tasks:
+            self._tasks[job_id].cancel()
+
+
+class FakeRESTServer:
+    """BigQueryのREST APIを模擬するローカルのHTTPサーバー
+
+    HTTPクライアントの接続の使い回しを確かめるために, 受け付けた接続とリクエストの数を数える.
+    jobs.query, jobs.insert, jobs.get, jobs.listだけを扱い, クエリはすぐに完了する.
+    abqのEndPoint.endpointをendpointに差し替えて使う.
+
+    Args:
+        latency (float): レスポンスを返すまでの秒数
+        listed (Optional[dict[str, int]]): jobs.listがstateFilterの状態ごとに返す他のジョブの数
+    """
+
+    def __init__(self, latency: float = 0.0, listed: Optional[dict[str, int]] = None):
+        self.latency = latency
+        self.listed = listed if listed is not None else {}
+        self.connections = 0
+        self.requests = 0
+        self.authorizations: set[str] = set()
+        # 同時に処理していたリクエストの数の最大
+        self.active = 0
+        self.peak_active = 0
+        self.created: list[str] = []
+        # POSTされたパスとjson
+        self.posts: list[tuple[str, dict]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bigquery/v2/projects/{{projectId}}"
+
+    def __enter__(self) -> "FakeRESTServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(
+        self, method: str, path: str, authorization: Optional[str], body: Optional[dict] = None
+    ) -> dict:
+        with self._lock:
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+        time.sleep(self.latency)
+        with self._lock:
+            self.active -= 1
+            self.requests += 1
+            if authorization is not None:
+                self.authorizations.add(authorization)
+            if method == "POST":
+                self.posts.append((path, body))
+        project = path.split("/")[4]
+        if method == "POST":
+            job_id = uuid.uuid4().hex
+            with self._lock:
+                self.created.append(job_id)
+            return {"jobReference": {"projectId": project, "jobId": job_id}}
+        job_id = path.split("?")[0].rstrip("/").split("/")[-1]
+        if job_id == "jobs":
+            state = parse_qs(urlsplit(path).query).get("stateFilter", [""])[0].upper()
+            ids = [f"other_{i}" for i in range(self.listed.get(state, 0))]
+            if state == "DONE":
+                # 作成したジョブはすぐに完了している
+                ids += self.created
+            jobs = [{"jobReference": {"projectId": project, "jobId": i}} for i in ids]
+            return {"jobs": jobs} if jobs else {}
+        now = int(time.time() * 1000)
+        return {
+            "jobReference": {"projectId": project, "jobId": job_id},
+            "status": {"state": "DONE"},
+            "statistics": {
+                "creationTime": now,
+                "startTime": now,
+                "endTime": now,
+                "query": {"totalBytesBilled": "0"},
+            },
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-aliveの接続を受け付ける
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                self.reply(fake.respond("GET", self.path, self.headers.get("Authorization")))
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                authorization = self.headers.get("Authorization")
+                self.reply(fake.respond("POST", self.path, authorization, body))
+
+            def reply(self, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _statements(sql: str) -> list[tuple[int, str]]:
+    """スクリプトを文に分け, 各文の開始行と一緒に返す"""
+    statements = []
+    pos = 0
+    for statement in sqlparse.split(sql):
+        if not statement.strip(";").strip():
+            continue
+        pos = sql.index(statement, pos)
+        statements.append((sql.count("\n", 0, pos) + 1, statement))
+        pos += len(statement)
+    return statements
+
+
+def _workflow(entrypoint: str, templates: list[dict], batchable: bool = False) -> Workflow:
+    templates.append({"name": "query", "run": "SELECT 1", "batchable": batchable})
+    return Workflow.parse_obj({"entrypoint": entrypoint, "templates": templates})
+
+
+def fanout_workflow(size: int, batchable: bool = False) -> Workflow:
+    """size個のタスクを全て並列に実行する"""
+    steps = [[{"name": f"t{i}", "template": "query"} for i in range(size)]]
+    return _workflow("main", [{"name": "main", "steps": steps}], batchable)
+
+
+def chain_workflow(size: int, batchable: bool = False, distinct: bool = False) -> Workflow:
+    """size個のタスクを一列に実行する. distinctならi番目のタスクは`SELECT i`を実行する"""
+    tasks = [
+        {
+            "name": f"t{i}",
+            "template": f"q{i}" if distinct else "query",
+            "dependencies": [f"t{i - 1}"] if i else [],
+        }
+        for i in range(size)
+    ]
+    templates = [{"name": "main", "dag": {"tasks": tasks}}]
+    if distinct:
+        templates += [
+            {"name": f"q{i}", "run": f"SELECT {i}", "batchable": batchable} for i in range(size)
+        ]
+    return _workflow("main", templates, batchable)
+
+
+def diamond_workflow(size: int, width: int = 8, batchable: bool = False) -> Workflow:
+    """width個のタスクの層と1個の合流タスクを交互に並べる"""
+    tasks: list[dict] = []
+    join: list[str] = []
+    for layer in range(max(1, size // (width + 1))):
+        names = [f"l{layer}_{i}" for i in range(width)]
+        tasks += [{"name": n, "template": "query", "dependencies": join} for n in names]
+        join = [f"j{layer}"]
+        tasks.append({"name": join[0], "template": "query", "dependencies": names})
+    return _workflow("main", [{"name": "main", "dag": {"tasks": tasks}}], batchable)
+
+
+def nested_workflow(depth: int, breadth: int = 3, batchable: bool = False) -> Workflow:
+    """stepsとdagを交互にdepth段ネストする. タスク数はおよそbreadth ** depth"""
+    templates = []
+    for level in range(depth):
+        child = f"level{level + 1}" if level + 1 < depth else "query"
+        if level % 2 == 0:
+            steps = [[{"name": f"s{i}", "template": child}] for i in range(breadth)]
+            templates.append({"name": f"level{level}", "steps": steps})
+        else:
+            tasks = [{"name": "a", "template": child}]
+            tasks += [
+                {"name": f"b{i}", "template": child, "dependencies": ["a"]}
+                for i in range(breadth - 1)
+            ]
+            templates.append({"name": f"level{level}", "dag": {"tasks": tasks}})
+    return _workflow("level0", templates, batchable)
+
+
+def items_workflow(
+    size: int, parallelism: Optional[int] = None, batchable: bool = False
+) -> Workflow:
+    """withRangeでsize個の値のタスクに展開する"""
+    task = {"name": "t", "template": "query", "withRange": {"start": 0, "end": size - 1}}
+    if parallelism is not None:
+        task["parallelism"] = parallelism
+    return _workflow("main", [{"name": "main", "dag": {"tasks": [task]}}], batchable)
+
+
+WORKFLOWS: dict[str, Callable[..., Workflow]] = {
+    "fanout": fanout_workflow,
+    "items": items_workflow,
+    "chain": chain_workflow,
+    "diamond": diamond_workflow,
+    "nested": nested_workflow,
+}
@@ -0,0 +1,248 @@
+"""ワークフローの実行をタイムラインとして書き出す
+
+タスクごとに記録した各段階の時刻から, 実行可能になってからキューで待った時間,
+ジョブを投げるまでの時間, BigQueryでPENDINGだった時間, 実行していた時間,
+完了を反映するまでの時間を区間にする.
+同時に実行していたタスクを重ならない行に並べるので, 空いていた枠や待ちが長いタスクがわかる.
+
+chrome形式はchrome://tracingやPerfetto(https://ui.perfetto.dev)で,
+otlp形式はOTLP/JSONを読み込めるOpenTelemetryのツールで開ける.
+"""
+
+import heapq
+import json
+import secrets
+from pathlib import Path
+from typing import Optional
+
+from bqflow._helper import mkdir_if_not_exists
+from bqflow.options import TraceFormat
+from bqflow.report import TaskReport, TaskTiming
+
+# (区間の名前, 開始の属性, 終了の属性)
+PHASES = [
+    ("submit", "dequeued", "submitted"),
+    ("pending", "submitted", "started"),
+    ("running", "started", "ended"),
+    ("finish", "ended", "finished"),
+]
+
+SLOTS_PID = 1
+QUEUE_PID = 2
+
+
+def lanes(intervals: list[tuple[float, float]]) -> list[int]:
+    """区間が重ならないように行を割り当てる
+
+    Returns:
+        list[int]: 区間ごとの行番号. 行の数は同時に存在した区間の最大数になる
+    """
+    order = sorted(range(len(intervals)), key=lambda i: intervals[i])
+    result = [0] * len(intervals)
+    # (空く時刻, 行番号)
+    busy: list[tuple[float, int]] = []
+    free: list[int] = []
+    for i in order:
+        start, end = intervals[i]
+        while busy and busy[0][0] <= start:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        lane = heapq.heappop(free) if free else len(busy)
+        heapq.heappush(busy, (end, lane))
+        result[i] = lane
+    return result
+
+
+def phases(timing: TaskTiming) -> list[tuple[str, float, float]]:
+    """記録された時刻からタスクの区間を求める
+
+    BigQueryの時刻は手元の時計とずれることがあるので, 前の区間より前には戻らないようにする.
+    """
+    result = []
+    for name, start_attr, end_attr in PHASES:
+        start, end = getattr(timing, start_attr), getattr(timing, end_attr)
+        if start is None or end is None:
+            continue
+        if result:
+            start = max(start, result[-1][2])
+        end = min(max(start, end), timing.finished or end)
+        result.append((name, start, end))
+    return result
+
+
+def _timed(reports: list[TaskReport]) -> list[TaskReport]:
+    return [
+        r
+        for r in reports
+        if r.timing is not None and r.timing.dequeued is not None and r.timing.finished is not None
+    ]
+
+
+def _args(report: TaskReport) -> dict:
+    args = {
+        "state": report.state,
+        "worker": report.timing.worker,
+        "slot_ms": report.timing.slot_ms,
+        "total_bytes_billed": report.total_bytes_billed,
+        "concurrency": report.concurrency,
+        "error": report.error,
+    }
+    return {k: v for k, v in args.items() if v is not None}
+
+
+def chrome_trace(reports: list[TaskReport]) -> dict:
+    """Trace Event形式のタイムライン
+
+    実行枠の行にタスクと各区間を, キューの行に実行可能になってから取り出されるまでの待ちを置く.
+    """
+    timed = _timed(reports)
+    origin = min((r.timing.ready or r.timing.dequeued for r in timed), default=0)
+
+    def us(t: float) -> float:
+        return round((t - origin) * 1e6, 3)
+
+    def dur(start: float, end: float) -> float:
+        return round((end - start) * 1e6, 3)
+
+    events: list[dict] = [
+        {"name": "process_name", "ph": "M", "pid": SLOTS_PID, "args": {"name": "slots"}},
+        {"name": "process_name", "ph": "M", "pid": QUEUE_PID, "args": {"name": "ready queue"}},
+    ]
+    slot_lanes = lanes([(r.timing.dequeued, r.timing.finished) for r in timed])
+    for report, lane in zip(timed, slot_lanes):
+        name = "/".join(report.name)
+        timing = report.timing
+        common = {"ph": "X", "pid": SLOTS_PID, "tid": lane}
+        events.append(
+            dict(
+                common,
+                name=name,
+                cat=report.state,
+                ts=us(timing.dequeued),
+                dur=dur(timing.dequeued, timing.finished),
+                args=_args(report),
+            )
+        )
+        for phase, start, end in phases(timing):
+            events.append(
+                dict(common, name=phase, cat="phase", ts=us(start), dur=dur(start, end))
+            )
+
+    queued = [r for r in timed if r.timing.ready is not None]
+    queue_lanes = lanes([(r.timing.ready, r.timing.dequeued) for r in queued])
+    for report, lane in zip(queued, queue_lanes):
+        timing = report.timing
+        events.append(
+            {
+                "name": "/".join(report.name),
+                "cat": "queued",
+                "ph": "X",
+                "pid": QUEUE_PID,
+                "tid": lane,
+                "ts": us(timing.ready),
+                "dur": dur(timing.ready, timing.dequeued),
+            }
+        )
+    lane_names = [(SLOTS_PID, "slot", max(slot_lanes, default=-1) + 1)]
+    lane_names.append((QUEUE_PID, "queue", max(queue_lanes, default=-1) + 1))
+    for pid, prefix, n in lane_names:
+        for lane in range(n):
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": lane,
+                    "args": {"name": f"{prefix} {lane}"},
+                }
+            )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def _attributes(values: dict) -> list[dict]:
+    attributes = []
+    for key, value in values.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            attributes.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            # OTLP/JSONでは64bit整数を文字列で表す
+            attributes.append({"key": key, "value": {"intValue": str(value)}})
+        else:
+            attributes.append({"key": key, "value": {"stringValue": str(value)}})
+    return attributes
+
+
+def _span(
+    trace_id: str,
+    name: str,
+    start: float,
+    end: float,
+    parent: Optional[str] = None,
+    attributes: Optional[dict] = None,
+    error: Optional[str] = None,
+) -> dict:
+    span = {
+        "traceId": trace_id,
+        "spanId": secrets.token_hex(8),
+        "name": name,
+        # SPAN_KIND_INTERNAL
+        "kind": 1,
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int(end * 1e9)),
+        "attributes": _attributes(attributes or {}),
+    }
+    if parent is not None:
+        span["parentSpanId"] = parent
+    if error is not None:
+        # STATUS_CODE_ERROR
+        span["status"] = {"code": 2, "message": error}
+    return span
+
+
+def otlp_trace(reports: list[TaskReport], service_name: str = "bqflow") -> dict:
+    """OTLP/JSON形式のスパン
+
+    ワークフロー全体のスパンの下にタスクのスパンを, タスクのスパンの下に各区間のスパンを置く.
+    """
+    timed = _timed(reports)
+    trace_id = secrets.token_hex(16)
+    spans = []
+    if timed:
+        start = min(r.timing.ready or r.timing.dequeued for r in timed)
+        end = max(r.timing.finished for r in timed)
+        root = _span(trace_id, "workflow", start, end, attributes={"bqflow.tasks": len(reports)})
+        spans.append(root)
+    for report in timed:
+        timing = report.timing
+        attributes = {"bqflow.task": "/".join(report.name), **_args(report)}
+        attributes = {
+            k if k.startswith("bqflow.") else f"bqflow.{k}": v for k, v in attributes.items()
+        }
+        task = _span(
+            trace_id,
+            "/".join(report.name),
+            timing.ready or timing.dequeued,
+            timing.finished,
+            parent=root["spanId"],
+            attributes=attributes,
+            error=report.error if report.state in ["failed", "cancelled"] else None,
+        )
+        spans.append(task)
+        intervals = phases(timing)
+        if timing.ready is not None:
+            intervals.insert(0, ("queued", timing.ready, timing.dequeued))
+        for phase, phase_start, phase_end in intervals:
+            spans.append(_span(trace_id, phase, phase_start, phase_end, parent=task["spanId"]))
+
+    resource = {"attributes": _attributes({"service.name": service_name})}
+    scope = {"scope": {"name": "bqflow"}, "spans": spans}
+    return {"resourceSpans": [{"resource": resource, "scopeSpans": [scope]}]}
+
+
+def write_trace(path: Path, reports: list[TaskReport], trace_format: TraceFormat = "chrome"):
+    """タイムラインをjsonファイルに書き出す"""
+    trace = chrome_trace(reports) if trace_format == "chrome" else otlp_trace(reports)
+    mkdir_if_not_exists(path)
+    with open(path, "w") as f:
+        json.dump(trace, f, ensure_ascii=False)
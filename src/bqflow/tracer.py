@@ -1,86 +1,162 @@
 from __future__ import annotations
 
-from typing import Optional, TypeVar
+from array import array
+from typing import Iterator, Optional, TypeVar
 
-from pydantic import BaseModel
-
-from bqflow.fields import DAGTask, Parameter, Template, Workflow
+from bqflow.fields import Parameter, Workflow
+from bqflow.plan import Plan, PlanNode
 from bqflow.task import Query
 
+# Statusesのノードごとの状態
+NOT_STARTED = 0
+STARTED = 1
+DONE = 2
+
+
+class Status:
+    """Statusesが持つ1つのノードの状態を見るためのビュー
+
+    状態はStatusesの配列にあり, このオブジェクトは必要になったときにだけ作る.
+    """
+
+    __slots__ = ("statuses", "id")
+
+    def __init__(self, statuses: "Statuses", node_id: int):
+        self.statuses = statuses
+        self.id = node_id
+
+    @property
+    def node(self) -> PlanNode:
+        return self.statuses.plan.nodes[self.id]
+
+    @property
+    def template_name(self) -> str:
+        return self.node.template_name
+
+    @property
+    def task_names(self) -> list[str]:
+        return self.node.task_names
+
+    @property
+    def parameters(self) -> list[Parameter]:
+        return self.node.parameters
+
+    @property
+    def remaining(self) -> int:
+        """完了していない子タスクの数"""
+        return self.statuses.remaining[self.id]
+
+    @remaining.setter
+    def remaining(self, value: int):
+        self.statuses.remaining[self.id] = value
 
-class Status(BaseModel):
-    template_name: str
-    task_names: list[str]
-    done_task_names: list[str]
-    required_task_names: list[str]
-    parameters: list[Parameter] = []
-    done: bool = False
+    @property
+    def done(self) -> bool:
+        return self.statuses.states[self.id] == DONE
 
-    def contain_recursive(self):
-        return len(self.template_names) != len(set(self.template_names))
+    def __repr__(self) -> str:
+        return f"Status(task_names={self.task_names}, remaining={self.remaining}, done={self.done})"
 
 
-class Statuses(BaseModel):
-    statuses: list[Status] = []
+class Statuses:
+    """開始したノードの状態
 
-    def __getitem__(self, i):
-        return self.statuses[i]
+    pydanticのモデルをノードごとに作らず, ノードのidを添字にした配列で
+    状態(未開始, 開始, 完了)と未完了の子タスクの数を持つ.
+    タスク名からノードへの対応は実行計画の索引を使う.
+    """
+
+    def __init__(self, plan: Plan):
+        self.plan = plan
+        self.states = bytearray()
+        self.remaining = array("l")
+        self.started = 0
+
+    def _grow(self, node_id: int):
+        # 値ごとのタスクの展開で実行計画のノードが増える
+        if node_id >= len(self.states):
+            n = len(self.plan.nodes) - len(self.states)
+            self.states.extend(bytes(n))
+            self.remaining.extend([0] * n)
+
+    def _id(self, task_names: list[str]) -> int:
+        node_id = self.plan.index.get(tuple(task_names))
+        if node_id is None or not self.is_started(node_id):
+            raise KeyError(f"{task_names}は登録されているstatusesの中に存在しませんでした")
+        return node_id
 
-    def __iter__(self) -> Status:
-        return iter(self.statuses)
+    def __getitem__(self, task_names: list[str]) -> Status:
+        return self.find(task_names)
+
+    def __iter__(self) -> Iterator[Status]:
+        return (Status(self, i) for i, state in enumerate(self.states) if state != NOT_STARTED)
 
     def __len__(self):
-        return len(self.statuses)
+        return self.started
+
+    def __contains__(self, task_names: list[str]) -> bool:
+        node_id = self.plan.index.get(tuple(task_names))
+        return node_id is not None and self.is_started(node_id)
+
+    def is_started(self, node_id: int) -> bool:
+        return node_id < len(self.states) and self.states[node_id] != NOT_STARTED
+
+    def is_done(self, node_id: int) -> bool:
+        return node_id < len(self.states) and self.states[node_id] == DONE
 
-    def append(self, status: Status):
-        tasks_names = [s.task_names for s in self.statuses]
-        if status.task_names in tasks_names:
-            raise ValueError(f"{status.task_names}はすでに追加されています")
-        self.statuses.append(status)
+    def start(self, node_id: int, remaining: int):
+        """ノードを開始する
+
+        Args:
+            node_id (int): ノードのid
+            remaining (int): 完了していない子タスクの数
+        """
+        self._grow(node_id)
+        if self.states[node_id] != NOT_STARTED:
+            raise ValueError(f"{self.plan.nodes[node_id].task_names}はすでに追加されています")
+        self.states[node_id] = STARTED
+        self.remaining[node_id] = remaining
+        self.started += 1
 
     def get_root_task(self):
         return self.find([])
 
     def find(self, task_names: list[str]) -> Status:
-        result = [status for status in self.statuses if status.task_names == task_names]
-        if result == []:
-            raise KeyError(f"{task_names}は登録されているstatusesの中に存在しませんでした")
-        return result[0]
+        return Status(self, self._id(task_names))
 
     def parent(self, task_names: list[str]) -> Optional[Status]:
         return self.find(task_names[:-1]) if task_names != [] else None
 
-    def done(self, task_names: list[str]):
+    def done(self, task_names: list[str]) -> Status:
         """指定したタスクを完了にする
 
         Args:
             task_names (list[str]): タスク名
-        """
-        status = self.find(task_names)
-
-        # これ自身をdoneにする
-        status.done = True
-
-        # これの子供のstatusが全て完了しているか確認する
-        flags = [s.done for s in self.statuses if s.task_names[:-1] == status.task_names]
-        if not all(flags):
-            raise RuntimeError(f"{task_names}の子供に完了していないtaskが存在します")
-
-        # 必要タスクが全て終わっているか確認する
-        sub = set(status.required_task_names) - set(status.done_task_names)
-        if sub != set():
-            raise RuntimeError(f"{sub}のタスクがまだ完了していません")
 
-        # 親のdone_task_namesにこれの完了を登録する
-        if task_names == []:
-            return
-        parent = self.find(task_names[:-1])
-        parent.done_task_names.append(task_names[-1])
-
-        # 親の全タスクが完了したか調べ、完了していたら親も完了にする
-        sub = set(parent.required_task_names) - set(parent.done_task_names)
-        if sub == set():
-            self.done(parent.task_names)
+        Returns:
+            Status: 完了にしたstatus
+        """
+        node_id = self._id(task_names)
+        self.finish(node_id)
+        return Status(self, node_id)
+
+    def finish(self, node_id: int):
+        """ノードのidを指定して完了にする"""
+        if not self.is_started(node_id):
+            raise KeyError(f"{self.plan.nodes[node_id].task_names}は登録されているstatusesの中に存在しませんでした")
+        if self.states[node_id] == DONE:
+            raise RuntimeError(f"{self.plan.nodes[node_id].task_names}はすでに完了しています")
+        if self.remaining[node_id] != 0:
+            raise RuntimeError(f"{self.plan.nodes[node_id].task_names}の子供に完了していないtaskが存在します")
+        self.states[node_id] = DONE
+
+    def executable_ids(self) -> list[int]:
+        """開始していて子タスクが全て完了している, 完了していないノードのid"""
+        return [
+            i
+            for i, state in enumerate(self.states)
+            if state == STARTED and self.remaining[i] == 0
+        ]
 
     def executable_statuses(self) -> list[Status]:
         """実行可能なstatusを見つける
@@ -88,8 +164,7 @@ class Statuses(BaseModel):
         Returns:
             list[Status]: 実行可能なstatus
         """
-        executables = [s for s in self.statuses if not s.done and s.required_task_names == []]
-        return executables
+        return [Status(self, i) for i in self.executable_ids()]
 
 
 T = TypeVar("T")
@@ -122,150 +197,175 @@ def list_sub(xs: list[T], ys: list[T]) -> list[T]:
     return xs[index : len(xs)]
 
 
-def update_parameters(base: list[Parameter], update: list[Parameter]) -> list[Parameter]:
-    base = {x.name: x for x in base}
-    update = {x.name: x for x in update}
-    base.update(update)
-    return [x for x in base.values()]
-
-
-def input_overwrite(inputs: list[Parameter], writes: list[Parameter]) -> list[Parameter]:
-    inputs = {x.name: x for x in inputs}
-    writes = {x.name: x for x in writes if x.name in list(inputs.keys())}
-    sub = set(inputs.keys()) - set(writes.keys())
-    if sub != set():
-        raise ValueError(f"{sub}のパラメータが初期化できていません. yamlを確認してください")
-    inputs.update(writes)
-    return [x for x in inputs.values()]
+class TreeTracer:
+    """実行計画に沿ってタスクの完了を追跡する
 
+    各ノードの未完了の依存タスク数(入次数)と未完了の子タスク数を数えておき,
+    タスクの完了時にはそのノードの後続と親だけを更新する.
+    値ごとのタスクに展開するノードは, 開始したときと値ごとのタスクが完了したときに
+    parallelismの数まで次の値のタスクを展開して開始する.
+    """
 
-class TreeTracer:
-    def __init__(self, wf: Workflow):
+    def __init__(self, wf: Workflow, plan: Optional[Plan] = None):
         self.wf = wf
-        # rootタスクを追加
-        self.statuses: Statuses = Statuses(
-            statuses=[
-                Status(
-                    template_name=wf.entrypoint,
-                    task_names=[],
-                    done_task_names=[],
-                    required_task_names=self.required_tasks[wf.entrypoint],
-                    parameters=wf.arguments.parameters,
-                )
-            ]
-        )
-        self.tasks = []
-        self.task_update()
+        self.plan = plan if plan is not None else Plan(wf)
+        self.statuses: Statuses = Statuses(self.plan)
+        self.indegree = array("l", [len(node.dependencies) for node in self.plan])
+        # 値ごとのタスクに展開するノードの次に開始する値の位置
+        self.cursors: dict[int, int] = {}
+        self._start(self.plan.root)
 
     @property
-    def required_tasks(self) -> dict[str, list[str]]:
-        dic: dict[str, list[str]] = {}
-        for t in self.wf.templates:
-            if t.type == "dag":
-                dic[t.name] = [task.name for task in t.dag.tasks]
-            elif t.type == "steps":
-                dic[t.name] = sum([[s.name for s in ss] for ss in t.steps], [])
-            else:
-                dic[t.name] = []
-        return dic
+    def queries(self):
+        return self.plan.queries
 
-    @property
-    def dags(self) -> list[tuple[str, DAGTask]]:
-        """stepsとdagを全てdagに変換する
+    def get_tasks(self) -> list[Query]:
+        return self._to_queries(self.statuses.executable_ids())
+
+    def _to_queries(self, ids: list[int]) -> list[Query]:
+        return [self.plan.query(self.plan.nodes[node_id]) for node_id in ids]
+
+    def task_done(self, task_names: list[str]) -> list[Query]:
+        """指定したタスクを完了にする
+
+        Args:
+            task_names (list[str]): 完了にしたいタスク名
 
         Returns:
-            list[tuple[str, DAGTask]]: [(テンプレート名, その中のDAGTask)]
+            list[Query]: この完了によって新たに実行可能になったタスク
         """
-        return sum([self._convert_dag(template) for template in self.wf.templates], [])
+        return self._to_queries(self._done(self.plan.find(task_names)))
 
-    @property
-    def queries(self) -> dict[str, Template]:
-        return {temp.name: temp for temp in self.wf.templates if temp.type in ["run", "script"]}
-
-    def get_tasks(self) -> list[Query]:
-        statuese = self.statuses.executable_statuses()
+    def unlocked(self, completed: list[list[str]]) -> list[Query]:
+        """指定したタスクが順に完了したときに新たに実行可能になるタスク
 
-        tasks: list[Query] = []
-        for status in statuese:
-            status.task_names
+        状態は変更しない. completedは依存関係の順に並んでいる必要がある.
 
-            temp = self.queries[status.template_name]
-            params = input_overwrite(temp.inputs.parameters, status.parameters)
+        Args:
+            completed (list[list[str]]): 完了を仮定するタスク名
 
-            if temp.run is None:
-                with open(temp.script, "r") as f:
-                    sql = f.read()
-            else:
-                sql = temp.run
+        Returns:
+            list[Query]: completedの完了によって実行可能になるタスク. completed自身は含まない
+        """
+        preview = _Preview(self)
+        for names in completed:
+            preview.done(self.plan.find(names))
+        keys = {tuple(names) for names in completed}
+        nodes = [self.plan.nodes[i] for i in preview.news]
+        return [self.plan.query(node) for node in nodes if node.key not in keys]
 
-            tasks.append(Query(name=status.task_names, sql=sql, parameters=params))
-        return tasks
+    def restore(self, completed: list[list[str]]):
+        """過去の実行で完了したタスクを完了済みにする
 
-    def task_done(self, task_names: list[str]):
-        """指定したタスクを完了にする
+        実行可能なタスクのうち完了済みのものを完了にする操作を, 進まなくなるまで繰り返す.
 
         Args:
-            task_names (list[str]): 完了にしたいタスク名
+            completed (list[list[str]]): 完了済みのタスク名
         """
-        self.statuses.done(task_names=task_names)
-        self.task_update()
-
-    def task_update(self):
-        """タスクの完了を反映し実行可能タスクを追加する"""
-        before_len = len(self.statuses)
-        self._task_update_helper()
-        while before_len != len(self.statuses):
-            self._task_update_helper()
-            before_len = len(self.statuses)
-
-    def _task_update_helper(self):
-        """一段階タスクを掘る"""
-        statuses = [status for status in self.statuses if not status.done]
-        tasks_names = [status.task_names for status in self.statuses]
-        root_param = self.wf.arguments.parameters
-
-        for status in statuses:
-            template_name = status.template_name
-            task_names = status.task_names
-            dones = status.done_task_names
-            for name, task in self.dags:
-                # すでに追加されているタスクは無視
-                if task_names + [task.name] in tasks_names:
-                    continue
-                #
-                if name != template_name or task.name in dones:
-                    continue
-                # 依存タスクが全て完了しているタスクを列挙
-                if len(set(task.dependencies) - set(dones)) == 0:
-                    param = update_parameters(root_param, task.arguments.parameters)
-                    self.statuses.append(
-                        Status(
-                            template_name=task.template,
-                            task_names=task_names + [task.name],
-                            done_task_names=[],
-                            required_task_names=self.required_tasks[task.template],
-                            parameters=param,
-                        )
-                    )
-
-    @staticmethod
-    def _convert_dag(template: Template) -> tuple[str, DAGTask]:
-        dags = []
-        if template.type == "steps":
-            deps = []
-            for steps in template.steps:
-                step_deps = []
-                for step in steps:
-                    task = DAGTask(
-                        name=step.name,
-                        template=step.template,
-                        dependencies=deps,
-                        arguments=step.arguments,
-                    )
-                    step_deps.append(step.name)
-                    dags.append((template.name, task))
-                deps = step_deps
-        elif template.type == "dag":
-            for task in template.dag.tasks:
-                dags.append((template.name, task))
-        return dags
+        keys = {tuple(names) for names in completed}
+        news = self.statuses.executable_ids()
+        while news:
+            restored = [self.plan.nodes[i] for i in news if self.plan.nodes[i].key in keys]
+            news = []
+            for node in restored:
+                news += self._done(node)
+
+    def _start(self, node: PlanNode) -> list[int]:
+        """依存タスクが全て完了したノードを開始する
+
+        Returns:
+            list[int]: 新たに実行可能になったクエリのノードのid
+        """
+        size = self.plan.size(node)
+        self.statuses.start(node.id, size)
+        if self.plan.is_query(node):
+            return [node.id]
+        if size == 0:
+            return self._done(node)
+        if self.plan.is_fanout(node):
+            return self._start_instances(node)
+
+        news: list[int] = []
+        for child in node.children:
+            if self.indegree[child] == 0:
+                news += self._start(self.plan.nodes[child])
+        return news
+
+    def _done(self, node: PlanNode) -> list[int]:
+        """ノードを完了にし, 後続と親に伝播させる
+
+        Returns:
+            list[int]: 新たに実行可能になったクエリのノードのid
+        """
+        self.statuses.finish(node.id)
+
+        news: list[int] = []
+        for dependent in node.dependents:
+            self.indegree[dependent] -= 1
+            if self.indegree[dependent] == 0:
+                news += self._start(self.plan.nodes[dependent])
+
+        if node.parent is not None:
+            parent = self.plan.nodes[node.parent]
+            remaining = self.statuses.remaining
+            remaining[parent.id] -= 1
+            if remaining[parent.id] == 0:
+                news += self._done(parent)
+            elif self.plan.is_fanout(parent):
+                news += self._start_instances(parent)
+        return news
+
+    def _start_instances(self, group: PlanNode) -> list[int]:
+        """実行中の値ごとのタスクがparallelismより少なければ次の値のタスクを開始する"""
+        size = len(group.fanout)
+        limit = group.fanout.parallelism or size
+        remaining = self.statuses.remaining
+        news: list[int] = []
+        # 開始したタスクがすぐに完了して再帰的に呼ばれることがあるので, 毎回数え直す
+        while self.cursors.get(group.id, 0) < size:
+            started = self.cursors.get(group.id, 0)
+            if started - (size - remaining[group.id]) >= limit:
+                break
+            self.cursors[group.id] = started + 1
+            node = self.plan.instance(group, started)
+            # 展開で追加されたノードの入次数
+            self.indegree.extend(len(n.dependencies) for n in self.plan.nodes[len(self.indegree) :])
+            news += self._start(node)
+        return news
+
+
+class _Preview:
+    """TreeTracerの状態を変えずにタスクの完了を伝播させる"""
+
+    def __init__(self, tt: TreeTracer):
+        self.tt = tt
+        self.plan = tt.plan
+        self.indegree: dict[int, int] = {}
+        self.remaining: dict[int, int] = {}
+        self.news: list[int] = []
+
+    def start(self, node: PlanNode):
+        self.remaining[node.id] = self.plan.size(node)
+        if self.plan.is_query(node):
+            self.news.append(node.id)
+        elif self.remaining[node.id] == 0:
+            self.done(node)
+        elif self.plan.is_fanout(node):
+            # 値ごとのタスクは実際に開始するときに展開する
+            return
+        for child in node.children:
+            if self.indegree.get(child, self.tt.indegree[child]) == 0:
+                self.start(self.plan.nodes[child])
+
+    def done(self, node: PlanNode):
+        for dependent in node.dependents:
+            self.indegree[dependent] = self.indegree.get(dependent, self.tt.indegree[dependent]) - 1
+            if self.indegree[dependent] == 0:
+                self.start(self.plan.nodes[dependent])
+        if node.parent is not None:
+            parent = self.plan.nodes[node.parent]
+            if parent.id not in self.remaining:
+                self.remaining[parent.id] = self.tt.statuses.remaining[parent.id]
+            self.remaining[parent.id] -= 1
+            if self.remaining[parent.id] == 0:
+                self.done(parent)
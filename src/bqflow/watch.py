@@ -0,0 +1,168 @@
+"""ワークフローのファイルを監視し, 変更されたタスクと下流のタスクだけを再実行する
+
+yamlと実行計画が読み込むscriptのファイルの更新時刻とサイズを定期的に確認し,
+変わっていれば実行計画を読み込み直す. 定義かSQLが変わったtemplateを使うタスクと,
+それらに依存するタスクだけを未完了に戻し, 他のタスクは前回までの完了状態のまま実行する.
+"""
+
+import time
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+import yaml
+
+from bqflow.cache import FileStamp
+from bqflow.load import load_plan
+from bqflow.plan import Plan
+from bqflow.report import TaskReport
+
+logger = getLogger(__name__)
+
+
+def changed_templates(old: Plan, new: Plan) -> set[str]:
+    """定義またはSQLが変わったtemplate名. ワークフローの引数が変わった場合は全てのtemplate"""
+    names = {t.name for t in new.wf.templates}
+    if old.wf.arguments != new.wf.arguments or old.wf.entrypoint != new.wf.entrypoint:
+        return names
+    before = {t.name: t for t in old.wf.templates}
+    used = {node.template_name for node in old}
+    changed = set()
+    for temp in new.wf.templates:
+        if before.get(temp.name) != temp:
+            changed.add(temp.name)
+        elif temp.name in new.queries and temp.name in used:
+            # scriptのファイルは変わっていても定義は同じなので, 読み込んだSQLを比べる
+            if old.sql(temp.name) != new.sql(temp.name):
+                changed.add(temp.name)
+    return changed
+
+
+def downstream(plan: Plan, templates: set[str], known: Iterable[tuple[str, ...]]) -> set[tuple]:
+    """templateを使うタスクと, それらに推移的に依存するタスクのキー
+
+    コンテナのタスクのキーは中のタスク全てを表す. 前回の実行計画になかったタスクも含める.
+
+    Args:
+        plan (Plan): 新しい実行計画
+        templates (set[str]): 変わったtemplate名
+        known (Iterable[tuple[str, ...]]): 前回の実行計画のタスクのキー
+    """
+    known = set(known)
+    stack = [n.id for n in plan if n.template_name in templates or n.key not in known]
+    seen: set[int] = set()
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen:
+            continue
+        seen.add(node_id)
+        node = plan.nodes[node_id]
+        stack += node.dependents
+        # 再実行するタスクを含むコンテナは完了が遅れるので, コンテナに依存するタスクも対象
+        parent = node.parent
+        while parent is not None:
+            stack += plan.nodes[parent].dependents
+            parent = plan.nodes[parent].parent
+    return {plan.nodes[i].key for i in seen}
+
+
+def invalidate(completed: list[list[str]], keys: set[tuple]) -> list[list[str]]:
+    """完了済みのタスクから, keysのタスクとkeysのコンテナの中のタスクを除く"""
+    return [
+        names
+        for names in completed
+        if not any(tuple(names[:i]) in keys for i in range(1, len(names) + 1))
+    ]
+
+
+class Watcher:
+    """ワークフローのファイルを監視し, 変更の影響を受けるタスクだけを再実行する
+
+    Args:
+        path (Path): ワークフローのyaml
+        run (Callable[[Plan, list[list[str]]], list[TaskReport]]):
+            実行計画と完了済みのタスクを受け取って実行し, レポートを返す
+        entrypoint (Optional[str]): entrypointの上書き
+        interval (float): ファイルの変更を確認する間隔の秒数
+        use_cache (bool): コンパイル済みの実行計画のキャッシュを使うか
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        run: Callable[[Plan, list[list[str]]], list[TaskReport]],
+        entrypoint: Optional[str] = None,
+        interval: float = 1.0,
+        use_cache: bool = True,
+    ):
+        self.path = path
+        self.run = run
+        self.entrypoint = entrypoint
+        self.interval = interval
+        self.use_cache = use_cache
+        self.plan: Optional[Plan] = None
+        self.stamps: list[FileStamp] = []
+        self.completed: list[list[str]] = []
+
+    def start(self) -> list[TaskReport]:
+        """実行計画を読み込んで全てのタスクを実行する"""
+        self.plan = self.load()
+        return self.execute(self.plan, [])
+
+    def watch(self, times: Optional[int] = None):
+        """ファイルの変更を待って再実行し続ける
+
+        Args:
+            times (Optional[int]): 変更を確認する回数. 省略すると止められるまで続ける
+        """
+        self.start()
+        while times is None or times > 0:
+            time.sleep(self.interval)
+            self.poll()
+            if times is not None:
+                times -= 1
+
+    def poll(self) -> Optional[list[TaskReport]]:
+        """ファイルが変わっていれば変更の影響を受けるタスクを再実行する
+
+        Returns:
+            Optional[list[TaskReport]]: 再実行したタスクのレポート. 再実行しなければNone
+        """
+        if all(stamp.is_fresh() for stamp in self.stamps):
+            return None
+        try:
+            plan = self.load()
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            # 編集途中のファイルは直されるまで待つ
+            print(f"実行計画を読み込めませんでした: {e}")
+            self.stamps = self.stamp([self.path] + self.plan.sources())
+            return None
+
+        templates = changed_templates(self.plan, plan)
+        keys = downstream(plan, templates, self.plan.index)
+        self.plan = plan
+        if not keys:
+            print("変更の影響を受けるタスクはありません")
+            return None
+        print(f"再実行: {', '.join(sorted(templates)) or '追加されたタスク'}")
+        return self.execute(plan, invalidate(self.completed, keys))
+
+    def load(self) -> Plan:
+        plan = load_plan(self.path, entrypoint=self.entrypoint, use_cache=self.use_cache)
+        self.stamps = self.stamp([self.path] + plan.sources())
+        return plan
+
+    def stamp(self, paths: list[Path]) -> list[FileStamp]:
+        stamps = []
+        for path in paths:
+            try:
+                stamps.append(FileStamp.of(path))
+            except OSError:
+                logger.warning(f"{path}を監視できませんでした")
+        return stamps
+
+    def execute(self, plan: Plan, completed: list[list[str]]) -> list[TaskReport]:
+        reports = self.run(plan, completed)
+        done = [r.name for r in reports if r.state in ["done", "cached"]]
+        self.completed = completed + done
+        return reports
@@ -0,0 +1,21 @@
+import pytest
+
+from bqflow.procon import ProCon
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path_factory, monkeypatch):
+    """実行計画のキャッシュをユーザーのディレクトリに書かない"""
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(path))
+    return path
+
+
+@pytest.fixture
+def run_procon():
+    """偽のBigQueryでワークフローを実行し, タスクのレポートを返す"""
+
+    def run(wf, bq, **kwargs):
+        return ProCon(wf, "fake-project", bq=bq, poll_interval=0.01, **kwargs).run()
+
+    return run
@@ -0,0 +1,57 @@
+import sqlparse
+
+from bqflow.batch import build_script, failed_index
+from bqflow.task import Query
+from bqflow.testing import FakeBQ, chain_workflow, fanout_workflow
+
+
+def test_build_script_lines():
+    tasks = [
+        Query(name=["a"], sql="CREATE TABLE ds.a AS\nSELECT 1", parameters=[]),
+        Query(name=["b"], sql="INSERT ds.a SELECT 2;\n", parameters=[]),
+    ]
+    script = build_script(tasks)
+    assert script.sql == "CREATE TABLE ds.a AS\nSELECT 1;\nINSERT ds.a SELECT 2;"
+    assert script.lines == [(1, 2), (3, 3)]
+    assert failed_index(script, [], "Syntax error: Unexpected keyword at [3:1]") == 1
+
+
+def test_build_script_keeps_terminator_out_of_comments():
+    tasks = [
+        Query(name=["a"], sql="INSERT t SELECT 1\n-- done", parameters=[]),
+        Query(name=["b"], sql="INSERT t SELECT 2 /* last */", parameters=[]),
+        Query(name=["c"], sql="INSERT t SELECT 3; -- already terminated", parameters=[]),
+    ]
+    script = build_script(tasks)
+    assert script.sql == (
+        "INSERT t SELECT 1\n-- done\n;\n"
+        "INSERT t SELECT 2 /* last */\n;\n"
+        "INSERT t SELECT 3; -- already terminated"
+    )
+    assert script.lines == [(1, 3), (4, 5), (6, 6)]
+    assert [s.strip() for s in sqlparse.split(script.sql)][:2] == [
+        "INSERT t SELECT 1\n-- done\n;",
+        "INSERT t SELECT 2 /* last */\n;",
+    ]
+
+
+def test_batch_chain_in_one_script(run_procon):
+    bq = FakeBQ(latency=0.01)
+    reports = run_procon(chain_workflow(5, batchable=True), bq, batch_size=10)
+    assert [r.name for r in reports] == [[f"t{i}"] for i in range(5)]
+    assert all(r.state == "done" and r.total_bytes_billed == bq.bytes_per_job for r in reports)
+    assert bq.calls["query"] == 1
+
+
+def test_batch_failure_in_the_middle(run_procon):
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: sql.startswith("SELECT 2"))
+    wf = chain_workflow(5, batchable=True, distinct=True)
+    reports = {r.name[0]: r.state for r in run_procon(wf, bq, batch_size=10)}
+    assert reports == {"t0": "done", "t1": "done", "t2": "failed", "t3": "skipped", "t4": "skipped"}
+
+
+def test_batch_independent_tasks(run_procon):
+    bq = FakeBQ(latency=0.01)
+    reports = run_procon(fanout_workflow(12, batchable=True), bq, max_size=2, batch_size=10)
+    assert len(reports) == 12 and all(r.state == "done" for r in reports)
+    assert bq.calls["query"] < 12
@@ -0,0 +1,44 @@
+from bqflow.fields import Workflow
+from bqflow.report import summarize_dedup
+from bqflow.testing import FakeBQ
+
+
+def param(value: int) -> dict:
+    return {"parameters": [{"name": "id", "type": "INT64", "value": value}]}
+
+
+def workflow(ids: list[int]) -> Workflow:
+    """同じtemplateを別々の経路から同じパラメータで呼ぶワークフロー"""
+    steps = [
+        [{"name": f"p{i}", "template": "query", "arguments": param(v)} for i, v in enumerate(ids)]
+        + [{"name": "nested", "template": "sub"}]
+    ]
+    templates = [
+        {"name": "main", "steps": steps},
+        {"name": "sub", "dag": {"tasks": [{"name": "q", "template": "query", "arguments": param(1)}]}},
+        {"name": "query", "run": "SELECT @id", "inputs": {"parameters": [{"name": "id"}]}},
+    ]
+    return Workflow.parse_obj({"entrypoint": "main", "templates": templates})
+
+
+def test_dedup_runs_identical_queries_once(run_procon):
+    bq = FakeBQ(latency=0.02, bytes_per_job=1024)
+    reports = run_procon(workflow([1, 2, 1]), bq, dedup=True)
+    assert bq.calls["query"] == 2
+    assert all(r.state == "done" for r in reports)
+    shared = [r for r in reports if r.shared_with is not None]
+    assert sorted(r.name[0] for r in shared) == ["nested", "p2"]
+    assert summarize_dedup(reports) == "dedup: 2 jobs, 2.0 KB saved"
+
+
+def test_dedup_is_opt_in(run_procon):
+    bq = FakeBQ(latency=0.01)
+    run_procon(workflow([1, 1]), bq)
+    assert bq.calls["query"] == 3
+
+
+def test_dedup_shares_failure(run_procon):
+    bq = FakeBQ(latency=0.02, fail_if=lambda sql: True)
+    reports = run_procon(workflow([1, 1]), bq, dedup=True, failure_policy="continue-independent-branches")
+    assert bq.calls["query"] == 1
+    assert [r.state for r in reports] == ["failed"] * 3
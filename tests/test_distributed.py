@@ -0,0 +1,142 @@
+import asyncio
+import sqlite3
+import subprocess
+import sys
+import threading
+
+from bqflow import jobs
+from bqflow.distributed import Coordinator, Worker
+from bqflow.plan import Plan
+from bqflow.sharedqueue import SharedQueue
+from bqflow.testing import FakeBQ, chain_workflow, diamond_workflow
+
+WORKER = """
+import asyncio, sys
+from pathlib import Path
+from bqflow.distributed import Worker
+from bqflow.sharedqueue import SharedQueue
+from bqflow.testing import FakeBQ
+
+bq = FakeBQ(latency=0.1)
+worker = Worker(
+    SharedQueue(Path(sys.argv[1])),
+    concurrency=2,
+    poll_interval=0.02,
+    bq=lambda project: bq,
+    job_poll_interval=0.01,
+)
+asyncio.run(worker.run(exit_when_idle=True))
+"""
+
+
+def run_with_worker(coordinator, queue, **kwargs):
+    """coordinatorを別のスレッドで待ちながらworkerを実行する"""
+    reports = []
+    thread = threading.Thread(target=lambda: reports.extend(coordinator.wait()))
+    thread.start()
+    worker = Worker(queue, poll_interval=0.01, job_poll_interval=0.01, **kwargs)
+    asyncio.run(worker.run(exit_when_idle=True))
+    thread.join()
+    return reports, worker
+
+
+def test_workers_in_separate_processes(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    wf = diamond_workflow(27, width=8)
+    coordinator = Coordinator(wf, "fake-project", SharedQueue(path), poll_interval=0.02)
+    run_id = coordinator.start()
+    workers = [
+        subprocess.Popen([sys.executable, "-c", WORKER, str(path)], stderr=subprocess.PIPE)
+        for _ in range(3)
+    ]
+    reports = coordinator.wait()
+    for worker in workers:
+        _, stderr = worker.communicate(timeout=30)
+        assert worker.returncode == 0, stderr.decode()
+
+    assert len(reports) == 27
+    assert {r.state for r in reports} == {"done"}
+    owners = sqlite3.connect(str(path)).execute(
+        "SELECT COUNT(DISTINCT owner) FROM tasks WHERE run_id = ?", (run_id,)
+    )
+    assert owners.fetchone()[0] > 1
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    coordinator = Coordinator(
+        chain_workflow(2), "fake-project", SharedQueue(path), poll_interval=0.01
+    )
+    coordinator.start()
+    # リースを取ったまま落ちたworker
+    queue = SharedQueue(path)
+    [lost] = queue.claim("crashed", 1, lease=0.2)
+
+    reports, worker = run_with_worker(
+        coordinator, queue, bq=lambda p: FakeBQ(latency=0.01), lease=1.0
+    )
+
+    assert worker.executed == 2
+    assert {r.state for r in reports} == {"done"}
+    assert not queue.complete(lost.seq, "crashed", reports[0])
+
+
+def test_failure_skips_queued_tasks(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: bq.calls["query"] == 2)
+    coordinator = Coordinator(
+        chain_workflow(4), "fake-project", SharedQueue(path), poll_interval=0.01
+    )
+    coordinator.start()
+    reports, _ = run_with_worker(coordinator, SharedQueue(path), bq=lambda p: bq)
+
+    states = {"/".join(r.name): r.state for r in reports}
+    assert states == {"t0": "done", "t1": "failed", "t2": "skipped", "t3": "skipped"}
+
+
+def test_rate_limited_task_fails_after_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "RATE_LIMIT_WAIT", 0.001)
+    path = tmp_path / "queue.sqlite"
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: True, error_reason="rateLimitExceeded")
+    coordinator = Coordinator(
+        chain_workflow(1), "fake-project", SharedQueue(path), poll_interval=0.01
+    )
+    coordinator.start()
+    reports, _ = run_with_worker(coordinator, SharedQueue(path), bq=lambda p: bq)
+
+    assert [r.state for r in reports] == ["failed"]
+    assert bq.calls["query"] == jobs.RATE_LIMIT_RETRIES + 1
+
+
+def test_maximum_bytes_billed_is_passed_to_workers(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    bq = FakeBQ(latency=0.01, bytes_per_job=100)
+    coordinator = Coordinator(
+        chain_workflow(2),
+        "fake-project",
+        SharedQueue(path),
+        poll_interval=0.01,
+        maximum_bytes_billed=50,
+    )
+    coordinator.start()
+    reports, _ = run_with_worker(coordinator, SharedQueue(path), bq=lambda p: bq)
+
+    states = {"/".join(r.name): r.state for r in reports}
+    assert states == {"t0": "failed", "t1": "skipped"}
+
+
+def test_resume_runs_only_unfinished_tasks(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: bq.calls["query"] == 3)
+    wf = chain_workflow(4)
+    queue = SharedQueue(path)
+    coordinator = Coordinator(wf, "fake-project", queue, plan=Plan(wf), poll_interval=0.01)
+    run_id = coordinator.start()
+    reports, _ = run_with_worker(coordinator, SharedQueue(path), bq=lambda p: bq)
+    assert [r.state for r in reports] == ["done", "done", "failed", "skipped"]
+
+    resumed = Coordinator(wf, "fake-project", queue, run_id=run_id, poll_interval=0.01)
+    resumed.start()
+    reports, _ = run_with_worker(resumed, SharedQueue(path), bq=lambda p: bq)
+    assert {r.state for r in reports} == {"done"}
+    assert bq.calls["query"] == 5
@@ -0,0 +1,55 @@
+import asyncio
+import csv
+import json
+
+import pytest
+
+from bqflow.export import export_result
+
+SCHEMA = {
+    "fields": [
+        {"name": "id", "type": "INTEGER", "mode": "NULLABLE"},
+        {"name": "tags", "type": "STRING", "mode": "REPEATED"},
+    ]
+}
+
+
+def row(i: int) -> dict:
+    return {"f": [{"v": str(i)}, {"v": [{"v": f"t{i}"}]}]}
+
+
+class FakeJob:
+    """2ページに分かれた結果を返すジョブ"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def get_query_result(self, maxResults=None, pageToken=None):
+        self.requests.append(pageToken)
+        if pageToken is None:
+            return {"schema": SCHEMA, "totalRows": "3", "rows": [row(1), row(2)], "pageToken": "p2"}
+        return {"schema": SCHEMA, "totalRows": "3", "rows": [row(3)]}
+
+
+@pytest.mark.parametrize("suffix", [".json", ".ndjson", ".csv"])
+def test_export_pages(tmp_path, suffix):
+    job = FakeJob()
+    output = tmp_path / f"out{suffix}"
+    assert asyncio.run(export_result(job, output)) == 3
+    assert job.requests == [None, "p2"]
+
+    with open(output) as f:
+        if suffix == ".json":
+            rows = json.load(f)
+        elif suffix == ".ndjson":
+            rows = [json.loads(line) for line in f]
+        else:
+            rows = [{"id": int(r["id"]), "tags": json.loads(r["tags"])} for r in csv.DictReader(f)]
+    assert rows == [{"id": i, "tags": [f"t{i}"]} for i in [1, 2, 3]]
+
+
+def test_export_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    output = tmp_path / "out.parquet"
+    asyncio.run(export_result(FakeJob(), output))
+    assert pq.read_table(str(output)).to_pylist()[2] == {"id": 3, "tags": ["t3"]}
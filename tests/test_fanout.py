@@ -0,0 +1,130 @@
+from datetime import date
+
+import pytest
+from pydantic import ValidationError
+
+from bqflow.fields import Workflow
+from bqflow.plan import Plan
+from bqflow.state import Fingerprints, StateStore
+from bqflow.testing import FakeBQ
+from bqflow.tracer import TreeTracer
+
+
+def make_workflow(fanout: dict, arguments: list[dict] = []) -> Workflow:
+    return Workflow.parse_obj(
+        {
+            "entrypoint": "main",
+            "arguments": {"parameters": arguments},
+            "templates": [
+                {
+                    "name": "main",
+                    "dag": {
+                        "tasks": [
+                            {"name": "daily", "template": "query", **fanout},
+                            {"name": "after", "template": "final", "dependencies": ["daily"]},
+                        ]
+                    },
+                },
+                {"name": "query", "run": "SELECT @item", "inputs": {"parameters": [{"name": "item"}]}},
+                {"name": "final", "run": "SELECT 1"},
+            ],
+        }
+    )
+
+
+def names(tasks):
+    return [tuple(t.name) for t in tasks]
+
+
+def test_range_is_expanded_lazily():
+    wf = make_workflow({"withRange": {"start": "2024-01-01", "end": "2024-12-31"}, "parallelism": 2})
+    plan = Plan(wf)
+    group = plan.find(["daily"])
+    assert len(group.fanout) == 366
+
+    tt = TreeTracer(wf, plan=plan)
+    first = tt.get_tasks()
+    assert names(first) == [("daily", "0"), ("daily", "1")]
+    assert first[1].parameters[0].value == date(2024, 1, 2)
+    # 開始した値のタスクだけが展開されている
+    assert len(plan) == 3 + 2
+
+    assert names(tt.task_done(["daily", "0"])) == [("daily", "2")]
+    done = 1
+    queue = [["daily", "1"], ["daily", "2"]]
+    while queue:
+        news = tt.task_done(queue.pop(0))
+        done += 1
+        queue += [t.name for t in news]
+    assert done == 367
+    assert tt.statuses.get_root_task().done
+
+
+def test_state_store_keeps_range_lazy(tmp_path, run_procon):
+    year = {"withRange": {"start": "2024-01-01", "end": "2024-12-31"}, "parallelism": 2}
+    wf = make_workflow(year)
+    plan = Plan(wf)
+    state = StateStore(tmp_path / "state.sqlite")
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: sql == "SELECT @item")
+    run_procon(wf, bq, plan=plan, state=state, incremental=True)
+    state.close()
+    assert len(plan) == 3 + 2
+
+    # 下流のタスクのfingerprintは展開する値の定義から計算する
+    fingerprint = Fingerprints(plan).get(("after",))
+    assert len(plan) == 3 + 2
+    shorter = Plan(make_workflow({**year, "withRange": {"start": "2024-01-01", "end": "2024-12-30"}}))
+    assert Fingerprints(shorter).get(("after",)) != fingerprint
+
+
+def test_items_run_with_parallelism(run_procon):
+    bq = FakeBQ(latency=0.02)
+    wf = make_workflow({"withItems": [1, 2, 3, 4, 5, 6], "parallelism": 2})
+    reports = run_procon(wf, bq)
+    assert len(reports) == 7
+    assert all(r.state == "done" for r in reports)
+    assert bq.peak_running == 2
+    assert reports[-1].name == ["after"]
+
+
+def test_nested_tasks_receive_item(run_procon):
+    wf = Workflow.parse_obj(
+        {
+            "entrypoint": "main",
+            "templates": [
+                {
+                    "name": "main",
+                    "steps": [[{"name": "each", "template": "inner", "withItems": [1, 2, 3]}]],
+                },
+                {"name": "inner", "steps": [[{"name": "q", "template": "query"}]]},
+                {"name": "query", "run": "SELECT @item", "inputs": {"parameters": [{"name": "item"}]}},
+            ],
+        }
+    )
+    plan = Plan(wf).expand_all()
+    values = {node.key: plan.query(node).parameters[0].value for node in plan.leaves()}
+    assert values == {("each", str(i), "q"): i + 1 for i in range(3)}
+
+    reports = run_procon(wf, FakeBQ(latency=0.01))
+    assert {r.state for r in reports} == {"done"}
+
+
+def test_with_param_uses_array_elements():
+    wf = make_workflow(
+        {"withParam": "ids"},
+        arguments=[
+            {"name": "ids", "type": "ARRAY<INT64>", "value": [10, 20]},
+        ],
+    )
+    plan = Plan(wf).expand_all()
+    queries = [plan.query(node) for node in plan.leaves()]
+    items = {tuple(q.name): q.parameters[0] for q in queries if q.name[0] == "daily"}
+    assert items[("daily", "1")].value == 20
+    assert items[("daily", "1")].type == "INT64"
+
+
+def test_fanout_fields_are_exclusive():
+    with pytest.raises(ValidationError):
+        make_workflow({"withItems": [1], "withRange": {"start": 1, "end": 3}})
+    with pytest.raises(ValidationError):
+        make_workflow({"parallelism": 2})
@@ -0,0 +1,16 @@
+from bqflow.journal import Journal
+
+
+def test_old_journals_are_pruned(tmp_path, monkeypatch):
+    ids = iter(f"20240101-0000{i:02d}-abcdef" for i in range(5))
+    monkeypatch.setattr("bqflow.journal.new_run_id", lambda: next(ids))
+    monkeypatch.setattr("bqflow.journal.KEEP_RUNS", 3)
+    for _ in range(5):
+        journal = Journal.create(tmp_path, workflow=tmp_path / "wf.yaml", entrypoint="main")
+    assert sorted(p.stem for p in tmp_path.glob("*.jsonl")) == [
+        f"20240101-0000{i:02d}-abcdef" for i in [2, 3, 4]
+    ]
+
+    # 成功した実行は再開しないので削除する
+    journal.remove()
+    assert not journal.path.exists()
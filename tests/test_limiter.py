@@ -0,0 +1,67 @@
+import asyncio
+
+from abq import QueryException
+from abq.bq import EndPoint
+
+from bqflow import jobs
+from bqflow.jobs import BigQueryError, is_rate_limited
+from bqflow.limiter import AIMDLimiter, ConcurrencyLimiter
+from bqflow.session import Session, SessionBQ, run
+from bqflow.testing import FakeBQ, FakeRESTServer, chain_workflow, fanout_workflow
+
+
+def test_limiter_blocks_over_limit():
+    async def run():
+        limiter = ConcurrencyLimiter(2)
+        await limiter.acquire()
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        limiter.release()
+        await asyncio.sleep(0)
+        assert waiter.done()
+
+    asyncio.run(run())
+
+
+def test_aimd_grows_with_backlog_and_backs_off():
+    limiter = AIMDLimiter(maximum=8, initial=2)
+    for _ in range(40):
+        limiter.active = limiter.level
+        limiter.on_complete(pending=0.1, backlog=True)
+    assert limiter.level == 8
+
+    limiter.on_rate_limited()
+    assert limiter.level == 4
+    # cooldown中は続けて下げない
+    limiter.on_complete(pending=60, backlog=True)
+    assert limiter.level == 4
+
+
+def test_more_than_five_jobs_run_at_once(monkeypatch, run_procon):
+    # プロジェクトに他のRUNNINGのジョブがあっても--concurrencyまで同時に投げる
+    with FakeRESTServer(latency=0.1, listed={"RUNNING": 8}) as server:
+        monkeypatch.setattr(EndPoint, "endpoint", server.endpoint)
+        session = Session()
+        bq = SessionBQ("fake-project", session=session)
+        reports = run_procon(fanout_workflow(8), bq, limiter=ConcurrencyLimiter(8))
+        run(session.aclose())
+
+    assert {r.state for r in reports} == {"done"}
+    assert server.peak_active == 8
+
+
+def test_rate_limit_is_matched_by_reason():
+    assert is_rate_limited(BigQueryError("Query Error: Exceeded rate limits", "rateLimitExceeded"))
+    # 待っても解消しないクォータ超過や, メッセージに含まれる数字は再実行しない
+    assert not is_rate_limited(BigQueryError("Query Error: Quota exceeded", "quotaExceeded"))
+    assert not is_rate_limited(QueryException("Query Error: rateLimitExceeded 429"))
+
+
+def test_rate_limited_task_fails_after_retries(monkeypatch, run_procon):
+    monkeypatch.setattr(jobs, "RATE_LIMIT_WAIT", 0.001)
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: True, error_reason="rateLimitExceeded")
+    reports = run_procon(chain_workflow(1), bq, limiter=AIMDLimiter(maximum=4))
+    assert [r.state for r in reports] == ["failed"]
+    assert bq.calls["query"] == jobs.RATE_LIMIT_RETRIES + 1
@@ -0,0 +1,59 @@
+from bqflow.fields import Workflow
+from bqflow.lineage import check_dependencies, inferred_plan, plan_lineage, table_lineage
+from bqflow.plan import Plan
+from bqflow.tracer import TreeTracer
+
+
+def test_table_lineage():
+    sql = """
+    CREATE TEMP TABLE tmp AS SELECT 1 AS x;
+    CREATE OR REPLACE TABLE `project.ds.a` AS
+    SELECT EXTRACT(DATE FROM t.ts) AS d
+    FROM ds.b AS t
+    LEFT JOIN ds.c USING (id), UNNEST(t.arr)
+    WHERE t.id IN (SELECT id FROM ds.d_*);
+    INSERT INTO ds.e (x) SELECT x FROM tmp;
+    MERGE ds.f T USING ds.g S ON T.id = S.id WHEN MATCHED THEN DELETE;
+    -- FROM ds.comment
+    DROP TABLE IF EXISTS ds.h
+    """
+    lineage = table_lineage(sql)
+    assert lineage.reads == {"ds.b", "ds.c", "ds.d_*", "ds.g"}
+    assert lineage.writes == {"ds.a", "ds.e", "ds.f", "ds.h"}
+
+
+def make_workflow() -> Workflow:
+    steps = [
+        [{"name": "a", "template": "a"}, {"name": "b", "template": "b"}],
+        [{"name": "c", "template": "c"}],
+        [{"name": "drop", "template": "drop"}],
+    ]
+    templates = [
+        {"name": "main", "steps": steps},
+        {"name": "a", "run": "CREATE TABLE ds.a AS SELECT 1 AS x"},
+        {"name": "b", "run": "CREATE TABLE ds.b AS SELECT * FROM ds.a"},
+        {"name": "c", "run": "CREATE TABLE ds.c AS SELECT * FROM ds.a"},
+        {"name": "drop", "run": "DROP TABLE ds.a"},
+    ]
+    return Workflow.parse_obj({"entrypoint": "main", "templates": templates})
+
+
+def test_check_dependencies():
+    plan = Plan(make_workflow())
+    warnings = check_dependencies(plan, plan_lineage(plan))
+    assert warnings == [
+        "bはaが書き込む['ds.a']を使いますが, 依存関係が書かれていません",
+        "cのbへの依存関係はテーブルの読み書きからは不要です",
+    ]
+
+
+def test_inferred_plan():
+    wf = make_workflow()
+    plan = Plan(wf)
+    tt = TreeTracer(wf, plan=inferred_plan(plan, plan_lineage(plan)))
+    assert [q.name for q in tt.get_tasks()] == [["a"]]
+    assert sorted(q.name for q in tt.task_done(["a"])) == [["b"], ["c"]]
+    assert tt.task_done(["b"]) == []
+    assert [q.name for q in tt.task_done(["c"])] == [["drop"]]
+    tt.task_done(["drop"])
+    assert tt.statuses.get_root_task().done
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import bqflow.load
+from bqflow.load import load_plan
+
+
+@pytest.fixture
+def workflow(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "q.sql").write_text("SELECT 1")
+    path = tmp_path / "wf.yaml"
+    path.write_text(
+        "entrypoint: main\n"
+        "templates:\n"
+        "- name: main\n"
+        "  steps:\n"
+        "  - - {name: a, template: q}\n"
+        "- name: q\n"
+        "  script: q.sql\n"
+    )
+    return path
+
+
+def sql(plan) -> str:
+    return plan.query(plan.leaves()[0]).sql
+
+
+def test_load_plan_uses_cache(workflow, monkeypatch):
+    assert sql(load_plan(workflow)) == "SELECT 1"
+
+    def fail(path):
+        raise AssertionError("キャッシュが使われていません")
+
+    monkeypatch.setattr(bqflow.load, "read_workflow", fail)
+    # 内容が同じなら更新時刻が変わってもキャッシュを使う
+    os.utime(workflow, (0, 0))
+    assert sql(load_plan(workflow)) == "SELECT 1"
+
+
+def test_load_plan_detects_changed_script(workflow):
+    load_plan(workflow)
+    (workflow.parent / "q.sql").write_text("SELECT 22")
+    assert sql(load_plan(workflow)) == "SELECT 22"
+    assert sql(load_plan(workflow, entrypoint="q")) == "SELECT 22"
+
+
+def test_cache_is_stored_per_user(workflow, cache_home):
+    load_plan(workflow)
+    assert not (workflow.parent / ".bqflow").exists()
+    directory = cache_home / "bqflow"
+    assert len(list(directory.glob("*.pickle"))) == 1
+    # 他のユーザーが書き込めない
+    assert directory.stat().st_mode & 0o777 == 0o700
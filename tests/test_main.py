@@ -0,0 +1,60 @@
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from bqflow.main import cmd
+
+
+def test_cli_import_does_not_load_google_sdk():
+    code = (
+        "import sys, bqflow.main; "
+        "print([m for m in ['abq', 'google.cloud.bigquery'] if m in sys.modules])"
+    )
+    res = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert res.stdout.strip() == "[]"
+
+
+def test_validate(tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(cmd, ["validate", "sample/complex.yaml"])
+    assert result.exit_code == 0
+    assert result.output.strip() == "OK"
+
+    path = tmp_path / "wf.yaml"
+    path.write_text(
+        "entrypoint: main\n"
+        "templates:\n"
+        "- name: main\n"
+        "  dag:\n"
+        "    tasks:\n"
+        "    - {name: a, template: q, dependencies: [b]}\n"
+        "    - {name: b, template: q, dependencies: [a]}\n"
+        "- name: q\n"
+        "  run: SELECT 1\n"
+    )
+    result = runner.invoke(cmd, ["validate", str(path)])
+    assert result.exit_code == 1
+    assert "循環" in result.output
+
+
+def test_default_command_is_run(tmp_path):
+    result = CliRunner().invoke(cmd, [str(tmp_path / "missing.yaml"), "-P", "project"])
+    assert isinstance(result.exception, FileNotFoundError)
+
+
+def test_submit_writes_to_spool(tmp_path):
+    spool = tmp_path / "spool"
+    result = CliRunner().invoke(
+        cmd, ["submit", "sample/complex.yaml", "--spool", str(spool), "--concurrency", "3"]
+    )
+    assert result.exit_code == 0
+    [path] = list((spool / "incoming").glob("*.json"))
+    assert result.output.strip() == f"submission id: {path.stem}"
+    assert '"concurrency": 3' in path.read_text()
+
+
+def test_watch_rejects_dry_run():
+    result = CliRunner().invoke(cmd, ["--watch", "sample/complex.yaml", "-P", "p", "--dry-run"])
+    assert result.exit_code == 2
+    assert "--watch" in result.output
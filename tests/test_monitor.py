@@ -0,0 +1,50 @@
+import asyncio
+
+from bqflow.monitor import JobMonitor
+
+
+class FakeJob:
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.project_id = "project"
+        self.state = None
+        self.info = None
+
+
+class FakeBQ:
+    def __init__(self):
+        self.done: set[str] = set()
+        self.list_calls = 0
+
+    def json(self, job_id: str) -> dict:
+        state = "DONE" if job_id in self.done else "RUNNING"
+        return {"jobReference": {"jobId": job_id}, "status": {"state": state}}
+
+    async def get_job(self, job_id, projectId=None):
+        return self.json(job_id)
+
+    async def get_job_list(self, **kwargs):
+        self.list_calls += 1
+        return {"jobs": [self.json(job_id) for job_id in self.done]}
+
+
+def test_monitor_resolves_jobs_with_shared_polls():
+    async def run():
+        bq = FakeBQ()
+        monitor = JobMonitor(bq, min_interval=0.01, max_interval=0.01)
+        loop = asyncio.create_task(monitor.run())
+        futures = [monitor.watch(FakeJob(f"job{i}")) for i in range(3)]
+        await asyncio.sleep(0.05)
+        assert not any(f.done() for f in futures)
+
+        bq.done |= {"job0", "job1", "job2"}
+        results = await asyncio.gather(*futures)
+        monitor.stop()
+        await loop
+        return bq, monitor, results
+
+    bq, monitor, results = asyncio.run(run())
+    assert [r["status"]["state"] for r in results] == ["DONE"] * 3
+    assert monitor.watches == {}
+    # 3つのジョブを1回の一覧取得でまとめて確認している
+    assert bq.list_calls == monitor.polls
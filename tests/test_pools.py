@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from abq.bq import EndPoint
+from pydantic import ValidationError
+
+from bqflow.fields import Workflow
+from bqflow.limiter import ConcurrencyLimiter
+from bqflow.lineage import inferred_plan, plan_lineage
+from bqflow.plan import Plan
+from bqflow.procon import ProCon
+from bqflow.session import Session, SessionBQ, run
+from bqflow.testing import FakeBQ, FakeRESTServer
+
+
+def workflow(heavy: int, light: int, **extra) -> Workflow:
+    steps = [{"name": f"h{i}", "template": "heavy"} for i in range(heavy)]
+    steps += [{"name": f"l{i}", "template": "light"} for i in range(light)]
+    templates = [
+        {"name": "main", "steps": [steps]},
+        {"name": "heavy", "run": "SELECT 'heavy'", "pool": "rebuild"},
+        {"name": "light", "run": "SELECT 'light'"},
+    ]
+    return Workflow.parse_obj({"entrypoint": "main", "templates": templates, **extra})
+
+
+def test_pools_must_be_declared():
+    with pytest.raises(ValidationError, match="rebuild"):
+        workflow(1, 1)
+    with pytest.raises(ValidationError, match="1以上"):
+        workflow(1, 1, pools={"rebuild": 0})
+
+
+def test_task_overrides_template_and_inherits_from_container():
+    wf = Workflow.parse_obj(
+        {
+            "entrypoint": "main",
+            "pools": {"a": 1, "b": 2},
+            "templates": [
+                {
+                    "name": "main",
+                    "dag": {
+                        "tasks": [
+                            {"name": "x", "template": "q"},
+                            {"name": "y", "template": "q", "pool": "b", "priority": "BATCH"},
+                            {"name": "z", "template": "inner", "priority": "BATCH"},
+                        ]
+                    },
+                },
+                {"name": "inner", "steps": [[{"name": "w", "template": "plain"}]], "pool": "b"},
+                {"name": "q", "run": "SELECT 1", "pool": "a"},
+                {"name": "plain", "run": "SELECT 2"},
+            ],
+        }
+    )
+    plan = Plan(wf)
+    # --lineage scheduleの実行計画でも親から受け継いだ指定を使う
+    for p in [plan, inferred_plan(plan, plan_lineage(plan))]:
+        queries = {"/".join(n.key): p.query(n) for n in p.leaves()}
+        assert (queries["x"].pool, queries["x"].priority) == ("a", None)
+        assert (queries["y"].pool, queries["y"].priority) == ("b", "BATCH")
+        assert (queries["z/w"].pool, queries["z/w"].priority) == ("b", "BATCH")
+
+
+def test_full_pool_does_not_block_other_tasks():
+    bq = FakeBQ(latency=lambda sql: 0.2 if "heavy" in sql else 0.02)
+    wf = workflow(3, 6, pools={"rebuild": 1})
+    procon = ProCon(wf, "fake-project", bq=bq, poll_interval=0.01, limiter=ConcurrencyLimiter(3))
+    reports = procon.run()
+
+    assert {r.state for r in reports} == {"done"}
+    heavy = sorted((j.start_time, j.end_time) for j in bq.jobs.values() if "heavy" in j.sql)
+    light = [j for j in bq.jobs.values() if "light" in j.sql]
+    # heavyは1つずつ実行され, lightは最初のheavyの完了を待たない
+    assert all(end <= start for (_, end), (start, _) in zip(heavy, heavy[1:]))
+    assert max(j.end_time for j in light) < heavy[0][1]
+    assert procon.pools.peak == {"rebuild": 1}
+
+
+def test_batch_priority_uses_jobs_insert(monkeypatch):
+    with FakeRESTServer() as server:
+        monkeypatch.setattr(EndPoint, "endpoint", server.endpoint)
+        session = Session()
+        bq = SessionBQ("fake-project", session=session)
+        job = run(bq.query(sql="SELECT 1", priority="BATCH", maximumBytesBilled=100))
+        run(bq.query(sql="SELECT 2"))
+        run(session.aclose())
+
+    assert job.state == "DONE"
+    [(path, body), (other, _)] = server.posts
+    assert path.endswith("/jobs")
+    assert body["configuration"]["query"]["priority"] == "BATCH"
+    assert body["configuration"]["query"]["maximumBytesBilled"] == "100"
+    assert other.endswith("/queries")
+
+
+def test_priority_is_passed_to_jobs(run_procon):
+    bq = FakeBQ(latency=0.01)
+    wf = workflow(1, 1, pools={"rebuild": 1})
+    wf.templates[1].priority = "BATCH"
+    run_procon(wf, bq)
+    priorities = {j.sql: j.priority for j in bq.jobs.values()}
+    assert priorities == {"SELECT 'heavy'": "BATCH", "SELECT 'light'": "INTERACTIVE"}
+
+
+def test_interactive_query_does_not_wait_for_pending_jobs(monkeypatch):
+    # BATCHのジョブがPENDINGのままでもINTERACTIVEのジョブを投げる
+    with FakeRESTServer(listed={"PENDING": 1}) as server:
+        monkeypatch.setattr(EndPoint, "endpoint", server.endpoint)
+        session = Session()
+        bq = SessionBQ("fake-project", session=session)
+        job = run(asyncio.wait_for(bq.query(sql="SELECT 1"), 5))
+        run(session.aclose())
+
+    assert job.state == "DONE"
+    [(path, _)] = server.posts
+    assert path.endswith("/queries")
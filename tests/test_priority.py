@@ -0,0 +1,55 @@
+import asyncio
+
+from bqflow.plan import Plan
+from bqflow.priority import ReadyQueue, critical_path_lengths, task_weights
+from bqflow.procon import ProCon
+from bqflow.state import open_state
+from bqflow.task import Query
+from bqflow.testing import FakeBQ
+from tests.test_tracer import make_workflow
+
+
+def test_critical_path_lengths():
+    plan = Plan(make_workflow())
+    lengths = critical_path_lengths(plan, task_weights(plan))
+    assert lengths == {
+        ("A",): 4,
+        ("B", "X"): 3,
+        ("B", "Y"): 2,
+        ("B", "Z"): 2,
+        ("B", "W"): 1,
+        ("C",): 1,
+    }
+
+    durations = {key: 1.0 for key in lengths}
+    durations[("C",)] = 10.0
+    weights = task_weights(plan, durations=durations)
+    lengths = critical_path_lengths(plan, weights)
+    assert lengths[("C",)] > lengths[("B", "X")]
+
+
+def test_durations_are_used_without_incremental(tmp_path):
+    workflow = tmp_path / "wf.yaml"
+    store = open_state(workflow, incremental=True)
+    for name in [["A"], ["B", "X"], ["B", "Y"], ["B", "Z"], ["B", "W"]]:
+        store.record(name, "x", 1.0, 0)
+    store.record(["C"], "x", 10.0, 0)
+    store.close()
+
+    # --incrementalでなくても状態ストアがあれば前回までの実行時間を使う
+    state = open_state(workflow, incremental=False)
+    procon = ProCon(make_workflow(), "fake-project", bq=FakeBQ(), state=state)
+    state.close()
+    assert procon.priorities[("C",)] > procon.priorities[("B", "X")]
+
+
+def test_ready_queue_pops_longest_first():
+    async def run():
+        q = ReadyQueue({("short",): 1, ("long",): 5})
+        for name in ["short", "long"]:
+            q.put_nowait(Query(name=[name], sql="", parameters=[]))
+        q.put_nowait(None)
+        return [(await q.get()) for _ in range(3)]
+
+    long, short, sentinel = asyncio.run(run())
+    assert (long.name, short.name, sentinel) == (["long"], ["short"], None)
@@ -0,0 +1,37 @@
+from bqflow.testing import FakeBQ, chain_workflow, diamond_workflow, fanout_workflow
+
+
+def states(reports) -> dict[str, str]:
+    return {"/".join(r.name): r.state for r in reports}
+
+
+def test_procon_runs_all_tasks(run_procon):
+    bq = FakeBQ(latency=0.01)
+    reports = run_procon(diamond_workflow(18, width=8), bq)
+    assert len(reports) == 18
+    assert set(states(reports).values()) == {"done"}
+    assert bq.calls["query"] == 18
+
+
+def test_procon_respects_concurrency(run_procon):
+    bq = FakeBQ(latency=0.02)
+    reports = run_procon(fanout_workflow(20), bq, max_size=4)
+    assert len(reports) == 20
+    assert bq.peak_running <= 4
+
+
+def test_procon_fail_fast_skips_downstream(run_procon):
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: bq.calls["query"] == 3)
+    reports = states(run_procon(chain_workflow(5), bq))
+    assert reports["t2"] == "failed"
+    assert reports["t3"] == "skipped"
+    assert reports["t4"] == "skipped"
+    assert bq.calls["query"] == 3
+
+
+def test_procon_continue_independent_branches(run_procon):
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: bq.calls["query"] == 1)
+    wf = fanout_workflow(6)
+    reports = states(run_procon(wf, bq, max_size=1, failure_policy="continue-independent-branches"))
+    assert list(reports.values()).count("failed") == 1
+    assert list(reports.values()).count("done") == 5
@@ -0,0 +1,117 @@
+import pytest
+from abq import QueryException
+from pydantic import ValidationError
+
+from bqflow.fields import Backoff, RetryStrategy, Workflow
+from bqflow.jobs import BigQueryError, JobTimeout, is_retryable
+from bqflow.plan import Plan
+from bqflow.testing import FakeBQ, chain_workflow, fanout_workflow
+
+FAST = RetryStrategy(limit=2, backoff=Backoff(duration=0.01))
+
+
+def by_name(reports) -> dict:
+    return {"/".join(r.name): r for r in reports}
+
+
+def test_retry_delay_grows_and_caps():
+    strategy = RetryStrategy(limit=5, backoff=Backoff(duration=1, factor=3, maxDuration=5))
+    assert [strategy.delay(i) for i in range(1, 4)] == [1, 3, 5]
+
+
+def test_is_retryable():
+    assert is_retryable(BigQueryError("Query Error: Backend error", reason="backendError"))
+    assert is_retryable(JobTimeout(10))
+    assert not is_retryable(BigQueryError("Query Error: Syntax error", reason="invalidQuery"))
+    assert not is_retryable(BigQueryError("Query Error: cancelled", reason="stopped"))
+    # 理由はメッセージではなくreasonで判定する
+    assert not is_retryable(QueryException("Query Error: invalidQuery: near backendError: x"))
+    assert not is_retryable(
+        BigQueryError("Query Error: column backendError: not found", reason="invalidQuery")
+    )
+
+
+def test_transient_error_is_retried(run_procon):
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: bq.calls["query"] == 2, error_reason="backendError")
+    reports = by_name(run_procon(chain_workflow(3), bq, retry=FAST))
+    assert {r.state for r in reports.values()} == {"done"}
+    assert reports["t1"].retries == 1
+    assert reports["t1"].lost > 0
+    assert reports["t0"].retries == 0
+    assert bq.calls["query"] == 4
+
+
+def test_fatal_error_is_not_retried(run_procon):
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: bq.calls["query"] == 2)
+    reports = by_name(run_procon(chain_workflow(3), bq, retry=FAST))
+    assert reports["t1"].state == "failed"
+    assert reports["t1"].retries == 0
+    assert bq.calls["query"] == 2
+
+
+def test_retries_stop_at_limit(run_procon):
+    bq = FakeBQ(latency=0.01, fail_if=lambda sql: True, error_reason="backendError")
+    reports = by_name(run_procon(chain_workflow(2), bq, retry=FAST))
+    assert reports["t0"].state == "failed"
+    assert reports["t0"].retries == 2
+    assert reports["t1"].state == "skipped"
+    assert bq.calls["query"] == 3
+
+
+def test_timeout_cancels_job_and_frees_slot(run_procon):
+    bq = FakeBQ(latency=lambda sql: 10 if bq.calls["query"] == 1 else 0.01)
+    reports = run_procon(
+        fanout_workflow(4),
+        bq,
+        max_size=1,
+        timeout=0.1,
+        failure_policy="continue-independent-branches",
+    )
+    states = sorted(r.state for r in reports)
+    assert states == ["done", "done", "done", "failed"]
+    failed = next(r for r in reports if r.state == "failed")
+    assert failed.error.startswith("timeout")
+    assert bq.calls["post"] == 1
+    assert bq.jobs["job_0"].error["reason"] == "stopped"
+
+
+def test_timed_out_task_is_retried(run_procon):
+    bq = FakeBQ(latency=lambda sql: 10 if bq.calls["query"] == 1 else 0.01)
+    reports = run_procon(chain_workflow(2), bq, timeout=0.1, retry=FAST)
+    assert {r.state for r in reports} == {"done"}
+    assert by_name(reports)["t0"].retries == 1
+
+
+def test_template_settings_override_defaults():
+    wf = Workflow.parse_obj(
+        {
+            "entrypoint": "main",
+            "templates": [
+                {"name": "main", "steps": [[{"name": "a", "template": "q"}]]},
+                {
+                    "name": "q",
+                    "run": "SELECT 1",
+                    "timeout": 30,
+                    "retryStrategy": {"limit": 3, "backoff": {"duration": 2}},
+                },
+            ],
+        }
+    )
+    plan = Plan(wf)
+    query = plan.query(next(n for n in plan if plan.is_query(n)))
+    assert query.timeout == 30
+    assert query.retry.limit == 3
+    assert query.retry.delay(2) == 4
+
+
+def test_retry_settings_only_for_queries():
+    with pytest.raises(ValidationError):
+        Workflow.parse_obj(
+            {
+                "entrypoint": "main",
+                "templates": [
+                    {"name": "main", "steps": [[{"name": "a", "template": "q"}]], "timeout": 5},
+                    {"name": "q", "run": "SELECT 1"},
+                ],
+            }
+        )
@@ -0,0 +1,116 @@
+import asyncio
+
+from bqflow.limiter import SharedPool
+from bqflow.serve import Server
+from bqflow.spool import Spool, Submission
+from bqflow.testing import FakeBQ
+
+
+def test_shared_pool_prefers_member_with_fewer_slots():
+    async def scenario():
+        pool = SharedPool(2)
+        a, b = pool.limiter(), pool.limiter(1)
+        await a.admit()
+        await a.admit()
+        order = []
+
+        async def take(member, name):
+            await member.admit()
+            order.append(name)
+
+        waiting = [asyncio.create_task(take(a, "a")), asyncio.create_task(take(b, "b"))]
+        await asyncio.sleep(0)
+        pool.release(a)
+        await asyncio.sleep(0)
+        assert order == ["b"]
+        pool.release(a)
+        await asyncio.gather(*waiting)
+        assert order == ["b", "a"]
+        assert pool.peak == 2
+        assert b.level == 1
+
+    asyncio.run(scenario())
+
+
+def write_workflow(path, sql: str, size: int):
+    steps = "".join(f"    - {{name: t{i}, template: q}}\n" for i in range(size))
+    path.write_text(
+        "entrypoint: main\n"
+        "templates:\n"
+        "- name: main\n"
+        "  steps:\n"
+        "  -\n" + steps + "- name: q\n"
+        f"  run: {sql}\n"
+    )
+
+
+def test_server_runs_submissions_on_shared_pool(tmp_path):
+    write_workflow(tmp_path / "a.yaml", "SELECT 'a'", 8)
+    write_workflow(tmp_path / "b.yaml", "SELECT 'b'", 4)
+    spool = Spool(tmp_path / "spool")
+    submissions = [
+        Submission.create(tmp_path / "a.yaml"),
+        Submission.create(tmp_path / "b.yaml", concurrency=1),
+    ]
+    for submission in submissions:
+        spool.submit(submission)
+
+    bq = FakeBQ(latency=0.03)
+    server = Server(
+        spool, 2, project="fake-project", poll_interval=0.01, bq=lambda p: bq, job_poll_interval=0.01
+    )
+    asyncio.run(server.serve(once=True))
+
+    results = [spool.result(s.id) for s in submissions]
+    assert all(r.ok for r in results)
+    assert [len(r.reports) for r in results] == [8, 4]
+    assert bq.peak_running <= 2
+    # 後から投入したワークフローも先のワークフローが終わるのを待たずに枠を使う
+    jobs = list(bq.jobs.values())
+    first_b = min(j.start_time for j in jobs if "'b'" in j.sql)
+    last_a = max(j.end_time for j in jobs if "'a'" in j.sql)
+    assert first_b < last_a
+    assert not list(spool.running.glob("*.json"))
+
+
+def test_server_reports_load_errors(tmp_path):
+    (tmp_path / "bad.yaml").write_text("entrypoint: missing\ntemplates: []\n")
+    spool = Spool(tmp_path / "spool")
+    submission = Submission.create(tmp_path / "bad.yaml")
+    spool.submit(submission)
+    server = Server(spool, 2, project="fake-project", poll_interval=0.01, bq=lambda p: FakeBQ())
+    asyncio.run(server.serve(once=True))
+    result = spool.result(submission.id)
+    assert not result.ok
+    assert "entrypoint" in result.error
+
+
+def test_runs_of_same_workflow_expand_their_own_plan(tmp_path):
+    (tmp_path / "wf.yaml").write_text(
+        "entrypoint: main\n"
+        "templates:\n"
+        "- name: main\n"
+        "  steps:\n"
+        "  - - {name: each, template: q, withItems: [1, 2, 3], parallelism: 1}\n"
+        "- name: q\n"
+        "  run: SELECT @item\n"
+        "  inputs: {parameters: [{name: item}]}\n"
+    )
+    spool = Spool(tmp_path / "spool")
+    submissions = [Submission.create(tmp_path / "wf.yaml") for _ in range(2)]
+    for submission in submissions:
+        spool.submit(submission)
+
+    bq = FakeBQ(latency=0.02)
+    server = Server(
+        spool, 4, project="fake-project", poll_interval=0.01, bq=lambda p: bq, job_poll_interval=0.01
+    )
+    asyncio.run(server.serve(once=True))
+
+    results = [spool.result(s.id) for s in submissions]
+    assert [sorted("/".join(r.name) for r in result.reports) for result in results] == [
+        ["each/0", "each/1", "each/2"]
+    ] * 2
+    # 使い回す実行計画は実行で展開したタスクを持たない
+    [(_, plan)] = server.plans.values()
+    assert ("each", "2") not in plan.index
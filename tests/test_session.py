@@ -0,0 +1,59 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from abq.bq import EndPoint
+
+from bqflow.session import Session, SessionBQ, SessionJobResult, TokenCache, run
+from bqflow.testing import FakeRESTServer
+
+
+class FakeCredentials:
+    access_token = None
+    token_expiry = None
+    invalid = False
+
+    def __init__(self, lifetime: float):
+        self.lifetime = lifetime
+        self.refreshed = 0
+
+    def refresh(self, http):
+        self.refreshed += 1
+        self.access_token = f"token-{self.refreshed}"
+        self.token_expiry = datetime.utcnow() + timedelta(seconds=self.lifetime)
+
+
+def test_token_is_refreshed_once_before_expiry():
+    credentials = FakeCredentials(lifetime=3600)
+    tokens = TokenCache(lambda: credentials, margin=300)
+
+    async def scenario():
+        return await asyncio.gather(*[tokens.headers() for _ in range(10)])
+
+    headers = run(scenario())
+    assert {h["Authorization"] for h in headers} == {"Bearer token-1"}
+    assert tokens.refreshes == 1
+
+    # 期限まで5分を切ったら期限切れの前に更新する
+    credentials.token_expiry = datetime.utcnow() + timedelta(seconds=60)
+    assert run(tokens.headers())["Authorization"] == "Bearer token-2"
+    assert run(tokens.headers())["Authorization"] == "Bearer token-2"
+
+
+def test_session_reuses_connections_across_runs(monkeypatch):
+    tokens = TokenCache(lambda: FakeCredentials(lifetime=3600))
+    session = Session(tokens)
+    with FakeRESTServer() as server:
+        monkeypatch.setattr(EndPoint, "endpoint", server.endpoint)
+        bq = SessionBQ("fake-project", session=session)
+
+        async def queries(n: int):
+            return [await bq.query(sql="SELECT 1") for _ in range(n)]
+
+        jobs = run(queries(5)) + run(queries(5))
+        run(session.aclose())
+
+    assert all(isinstance(job, SessionJobResult) and job.state == "DONE" for job in jobs)
+    # 1クエリあたりjobs.queryとjobs.getを1回ずつ
+    assert server.requests == session.requests == 20
+    assert server.connections == 1
+    assert server.authorizations == {"Bearer token-1"}
@@ -0,0 +1,59 @@
+from bqflow.fields import Workflow
+from bqflow.plan import Plan
+from bqflow.state import StateStore, compute_fingerprints, open_state
+
+
+def make_workflow(sql_a: str) -> Workflow:
+    return Workflow.parse_obj(
+        {
+            "entrypoint": "main",
+            "templates": [
+                {
+                    "name": "main",
+                    "dag": {
+                        "tasks": [
+                            {"name": "A", "template": "a"},
+                            {"name": "B", "template": "b", "dependencies": ["A"]},
+                            {"name": "C", "template": "b"},
+                        ]
+                    },
+                },
+                {"name": "a", "run": sql_a},
+                {"name": "b", "run": "SELECT 2"},
+            ],
+        }
+    )
+
+
+def test_fingerprint_changes_only_downstream():
+    before = compute_fingerprints(Plan(make_workflow("SELECT 1")))
+    after = compute_fingerprints(Plan(make_workflow("SELECT 10")))
+
+    assert before[("A",)] != after[("A",)]
+    assert before[("B",)] != after[("B",)]
+    assert before[("C",)] == after[("C",)]
+
+
+def test_state_store(tmp_path):
+    store = StateStore(tmp_path / "state.sqlite")
+    assert store.fingerprint(["A"]) is None
+    store.record(["A"], "x", 1.0, 10)
+    assert store.is_fresh(["A"], "x")
+    assert not store.is_fresh(["A"], "y")
+    store.close()
+
+
+def test_open_state(tmp_path):
+    workflow = tmp_path / "wf.yaml"
+    # --incrementalでなければ作らない
+    assert open_state(workflow, incremental=False) is None
+    assert not (tmp_path / "wf.bqflow.sqlite").exists()
+
+    store = open_state(workflow, incremental=True)
+    store.record(["A"], "x", 2.0, 10)
+    store.close()
+
+    # 前回までの記録があれば--incrementalでなくても開く
+    store = open_state(workflow, incremental=False)
+    assert store.durations() == {("A",): 2.0}
+    store.close()
@@ -0,0 +1,43 @@
+from bqflow.testing import FakeBQ, chain_workflow, diamond_workflow
+from bqflow.trace import chrome_trace, lanes, otlp_trace
+
+
+def test_lanes_do_not_overlap():
+    intervals = [(0, 2), (1, 3), (2, 4), (0.5, 1), (3, 5)]
+    assigned = lanes(intervals)
+    assert max(assigned) + 1 == 2
+    for lane in set(assigned):
+        spans = sorted(iv for iv, la in zip(intervals, assigned) if la == lane)
+        assert all(a[1] <= b[0] for a, b in zip(spans, spans[1:]))
+
+
+def test_reports_record_timeline(run_procon):
+    reports = run_procon(diamond_workflow(18, width=8), FakeBQ(latency=0.01), max_size=4)
+    for r in reports:
+        t = r.timing
+        assert t.ready <= t.dequeued <= t.submitted <= t.finished
+        assert t.started <= t.ended
+        assert t.worker in range(1, 5)
+        assert t.slot_ms is not None
+
+    events = chrome_trace(reports)["traceEvents"]
+    tasks = [e for e in events if e.get("pid") == 1 and e.get("cat") == "done"]
+    assert len(tasks) == 18
+    # 同時実行数を超える行は使わない
+    assert max(e["tid"] for e in tasks) < 4
+    assert {e["name"] for e in events if e.get("cat") == "phase"} == {
+        "submit",
+        "pending",
+        "running",
+        "finish",
+    }
+
+
+def test_batched_reports_use_statement_times(run_procon):
+    reports = run_procon(chain_workflow(6, batchable=True), FakeBQ(latency=0.01), batch_size=3)
+    assert all(r.timing.started is not None and r.timing.slot_ms for r in reports)
+
+    spans = otlp_trace(reports)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    root = spans[0]
+    tasks = [s for s in spans if s.get("parentSpanId") == root["spanId"]]
+    assert sorted(s["name"] for s in tasks) == [f"t{i}" for i in range(6)]
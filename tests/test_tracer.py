@@ -0,0 +1,71 @@
+import pytest
+
+from bqflow.fields import Workflow
+from bqflow.tracer import TreeTracer
+
+
+def make_workflow() -> Workflow:
+    return Workflow.parse_obj(
+        {
+            "entrypoint": "main",
+            "templates": [
+                {
+                    "name": "main",
+                    "steps": [
+                        [{"name": "A", "template": "query"}],
+                        [{"name": "B", "template": "diamond"}, {"name": "C", "template": "query"}],
+                    ],
+                },
+                {
+                    "name": "diamond",
+                    "dag": {
+                        "tasks": [
+                            {"name": "X", "template": "query"},
+                            {"name": "Y", "template": "query", "dependencies": ["X"]},
+                            {"name": "Z", "template": "query", "dependencies": ["X"]},
+                            {"name": "W", "template": "query", "dependencies": ["Y", "Z"]},
+                        ]
+                    },
+                },
+                {"name": "query", "run": "SELECT 1"},
+            ],
+        }
+    )
+
+
+def names(tasks):
+    return sorted(tuple(t.name) for t in tasks)
+
+
+def test_task_done_returns_new_tasks():
+    tt = TreeTracer(make_workflow())
+    assert names(tt.get_tasks()) == [("A",)]
+
+    assert names(tt.task_done(["A"])) == [("B", "X"), ("C",)]
+    assert names(tt.task_done(["C"])) == []
+    assert names(tt.task_done(["B", "X"])) == [("B", "Y"), ("B", "Z")]
+    assert names(tt.task_done(["B", "Y"])) == []
+    assert names(tt.task_done(["B", "Z"])) == [("B", "W")]
+    assert not tt.statuses.get_root_task().done
+    assert names(tt.task_done(["B", "W"])) == []
+    assert tt.statuses.get_root_task().done
+
+
+def test_recursive_template_is_rejected():
+    wf = Workflow.parse_obj(
+        {
+            "entrypoint": "main",
+            "templates": [
+                {"name": "main", "steps": [[{"name": "A", "template": "loop"}]]},
+                {"name": "loop", "steps": [[{"name": "B", "template": "main"}]]},
+            ],
+        }
+    )
+    with pytest.raises(ValueError):
+        TreeTracer(wf)
+
+
+def test_restore_completed_tasks():
+    tt = TreeTracer(make_workflow())
+    tt.restore([["A"], ["B", "X"], ["B", "Y"]])
+    assert names(tt.get_tasks()) == [("B", "Z"), ("C",)]
@@ -0,0 +1,76 @@
+from bqflow.procon import ProCon
+from bqflow.testing import FakeBQ
+from bqflow.watch import Watcher
+
+WORKFLOW = """
+entrypoint: main
+templates:
+- name: main
+  dag:
+    tasks:
+    - {{name: a, template: load}}
+    - {{name: b, template: agg, dependencies: [a]}}
+    - {{name: c, template: other}}
+    - {{name: d, template: report, dependencies: [b]}}
+    - {{name: e, template: each, dependencies: [c]}}
+- name: each
+  steps:
+  - - {{name: x, template: report, withItems: [1, 2]}}
+- name: load
+  script: load.sql
+- name: agg
+  run: SELECT 'agg'
+- name: other
+  run: {other}
+- name: report
+  run: SELECT 'report'
+"""
+
+
+def make_watcher(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "wf.yaml").write_text(WORKFLOW.format(other="SELECT 'other'"))
+    (tmp_path / "load.sql").write_text("SELECT 1")
+    bq = FakeBQ(latency=0.01)
+
+    def run(plan, completed):
+        procon = ProCon(
+            plan.wf, "fake-project", bq=bq, poll_interval=0.01, plan=plan, completed=completed
+        )
+        return procon.run()
+
+    return Watcher(tmp_path / "wf.yaml", run, use_cache=False), bq
+
+
+def executed(reports) -> list[str]:
+    return sorted("/".join(r.name) for r in reports if r.state == "done")
+
+
+def test_edited_script_reruns_downstream_only(tmp_path, monkeypatch):
+    watcher, bq = make_watcher(tmp_path, monkeypatch)
+    assert len(executed(watcher.start())) == 6
+
+    assert watcher.poll() is None
+    (tmp_path / "load.sql").write_text("SELECT 1000")
+    assert executed(watcher.poll()) == ["a", "b", "d"]
+    assert bq.calls["query"] == 9
+    assert watcher.poll() is None
+
+
+def test_edited_template_reruns_its_tasks_and_containers(tmp_path, monkeypatch):
+    watcher, bq = make_watcher(tmp_path, monkeypatch)
+    watcher.start()
+
+    (tmp_path / "wf.yaml").write_text(WORKFLOW.format(other="SELECT 'changed'"))
+    assert executed(watcher.poll()) == ["c", "e/x/0", "e/x/1"]
+
+
+def test_broken_yaml_waits_for_next_change(tmp_path, monkeypatch):
+    watcher, bq = make_watcher(tmp_path, monkeypatch)
+    watcher.start()
+
+    (tmp_path / "wf.yaml").write_text("entrypoint: [")
+    assert watcher.poll() is None
+    assert watcher.poll() is None
+    (tmp_path / "wf.yaml").write_text(WORKFLOW.format(other="SELECT 'fixed'"))
+    assert executed(watcher.poll()) == ["c", "e/x/0", "e/x/1"]